@@ -0,0 +1,278 @@
+"""
+A small response cache for read only AWS calls. Entries are keyed by account,
+region, operation and (normalized) parameters and kept in an in-memory LRU or
+an on-disk backend with per operation time to live values.
+"""
+from __future__ import absolute_import
+import os
+import time
+import json
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    # Import as part of the aws_aware project
+    from aws_aware.outputclass import OUTPUT
+except ImportError:
+    # Otherwise import locally and define out ouput stream manually
+    from outputclass import Output as outstream
+    OUTPUT = outstream()
+
+# Seconds each operation is cached for unless configured otherwise (0 disables caching)
+DEFAULT_CACHE_TTLS = {
+    'describe_subnets': 60,
+    'list_objects_v2': 300,
+    'head_object': 300,
+    'get_access_key_last_used': 86400,
+}
+
+# Seconds for operations without their own ttl
+DEFAULT_CACHE_TTL = 60
+
+# Most entries a backend keeps before evicting the least recently used ones
+DEFAULT_CACHE_ENTRIES = 10000
+
+
+class MemoryCache(object):
+    """In-memory LRU cache backend holding at most maxentries entries"""
+
+    def __init__(self, maxentries=DEFAULT_CACHE_ENTRIES):
+        self.maxentries = maxentries
+        self.evictions = 0
+        # key -> (expires, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns (True, value) for an unexpired entry, otherwise (False, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return False, None
+            # Mark as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.maxentries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Forget an entry"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget all entries"""
+        with self._lock:
+            self._entries = OrderedDict()
+
+
+class DiskCache(object):
+    """
+    On-disk cache backend, one pickle file per entry in cachepath. Reads refresh
+    the file modification time so the least recently used entries are evicted
+    once there are more than maxentries.
+    """
+
+    def __init__(self, cachepath, maxentries=DEFAULT_CACHE_ENTRIES):
+        self.cachepath = cachepath
+        self.maxentries = maxentries
+        self.evictions = 0
+        self._count = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._list_files())
+
+    def _get_filename(self, key):
+        return os.path.join(self.cachepath, '{0}.cache'.format(key))
+
+    def _list_files(self):
+        if not os.path.isdir(self.cachepath):
+            return []
+        return [os.path.join(self.cachepath, name) for name in os.listdir(self.cachepath) if name.endswith('.cache')]
+
+    def get(self, key):
+        """Returns (True, value) for an unexpired entry, otherwise (False, None)"""
+        filename = self._get_filename(key)
+        try:
+            with open(filename, 'rb') as cachefile:
+                expires, value = pickle.load(cachefile)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False, None
+        if expires <= time.time():
+            self.delete(key)
+            return False, None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return True, value
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds"""
+        filename = self._get_filename(key)
+        with self._lock:
+            try:
+                if not os.path.isdir(self.cachepath):
+                    os.makedirs(self.cachepath)
+                if self._count is None:
+                    self._count = len(self._list_files())
+                if not os.path.isfile(filename):
+                    self._count += 1
+                # Responses can hold account details, keep them readable by the owner only
+                with os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as cachefile:
+                    pickle.dump((time.time() + ttl, value), cachefile, 2)
+            except (IOError, OSError, pickle.PicklingError) as e:
+                OUTPUT.warning('Unable to write aws cache file: {0}'.format(e))
+                return
+            if self._count > self.maxentries:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files until 90% of maxentries are left"""
+        files = sorted(self._list_files(), key=lambda filename: os.path.getmtime(filename))
+        excess = len(files) - int(self.maxentries * 0.9)
+        for filename in files[:max(0, excess)]:
+            try:
+                os.remove(filename)
+                self.evictions += 1
+            except OSError:
+                pass
+        self._count = len(files) - max(0, excess)
+
+    def delete(self, key):
+        """Forget an entry"""
+        try:
+            os.remove(self._get_filename(key))
+            if self._count:
+                self._count -= 1
+        except OSError:
+            pass
+
+    def clear(self):
+        """Forget all entries"""
+        for filename in self._list_files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._count = 0
+
+
+class ResponseCache(object):
+    """
+    Caches read only AWS call results in a MemoryCache or DiskCache backend,
+    keyed by (account, region, operation, normalized params). Each operation is
+    cached for its own ttl (see DEFAULT_CACHE_TTLS) and counts its hits and
+    misses. Disabling the cache (ie. --no-cache) sends every call to AWS.
+    """
+
+    def __init__(self, backend=None, ttls=None, defaultttl=DEFAULT_CACHE_TTL, enabled=True):
+        self.backend = backend if backend is not None else MemoryCache()
+        self.ttls = DEFAULT_CACHE_TTLS.copy()
+        self.ttls.update(ttls or {})
+        self.defaultttl = defaultttl
+        self.enabled = enabled
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def configure(self, backend=None, ttls=None, enabled=None):
+        """Change the backend, override operation ttls and/or enable or disable the cache"""
+        if backend is not None:
+            self.backend = backend
+        if ttls:
+            self.ttls.update(dict((operation, float(ttl)) for operation, ttl in ttls.items()))
+        if enabled is not None:
+            self.enabled = enabled
+
+    def get_ttl(self, operation):
+        """Seconds results of operation are cached for"""
+        return self.ttls.get(operation, self.defaultttl)
+
+    def get_key(self, account, region, operation, params=None):
+        """Returns a cache key, params are normalized (sorted keys, lists kept in order)"""
+        normalized = json.dumps([account, region, operation, params], sort_keys=True, default=str)
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def _count(self, operation, counter):
+        with self._lock:
+            counters = self._counters.setdefault(operation, {'hits': 0, 'misses': 0})
+            counters[counter] += 1
+
+    def get(self, account, region, operation, params=None, maxage=None):
+        """Returns (True, value) on a cache hit, otherwise (False, None). With maxage
+        only values stored less than maxage seconds ago are hits."""
+        if not self.enabled or not self.get_ttl(operation):
+            return False, None
+        found, entry = self.backend.get(self.get_key(account, region, operation, params))
+        if found and maxage is not None and (time.time() - entry[0]) >= maxage:
+            found = False
+        self._count(operation, 'hits' if found else 'misses')
+        return found, entry[1] if found else None
+
+    def set(self, account, region, operation, params, value, ttl=None):
+        """Store value for ttl (or the operation ttl) seconds"""
+        ttl = self.get_ttl(operation) if ttl is None else ttl
+        if self.enabled and ttl:
+            self.backend.set(self.get_key(account, region, operation, params), (time.time(), value), ttl)
+
+    def delete(self, account, region, operation, params=None):
+        """Forget a cached value"""
+        self.backend.delete(self.get_key(account, region, operation, params))
+
+    def clear(self):
+        """Forget all cached values"""
+        self.backend.clear()
+
+    def cached(self, account, region, operation, params, loader, maxage=None):
+        """Returns the cached value for the key (no older than maxage seconds when
+        passed), otherwise caches and returns loader()"""
+        if maxage is not None and not maxage:
+            return loader()
+        found, value = self.get(account, region, operation, params, maxage)
+        if found:
+            return value
+        value = loader()
+        self.set(account, region, operation, params, value)
+        return value
+
+    def stats(self):
+        """Returns hit/miss counters per operation plus totals and evictions"""
+        with self._lock:
+            stats = dict((operation, dict(counters)) for operation, counters in self._counters.items())
+        hits = sum(counters['hits'] for counters in stats.values())
+        misses = sum(counters['misses'] for counters in stats.values())
+        return {
+            'enabled': self.enabled,
+            'backend': self.backend.__class__.__name__,
+            'entries': len(self.backend),
+            'evictions': self.backend.evictions,
+            'hits': hits,
+            'misses': misses,
+            'operations': stats,
+        }
+
+    def reset_stats(self):
+        """Reset the hit/miss counters"""
+        with self._lock:
+            self._counters = {}
+
+
+# Process wide AWS response cache
+RESPONSE_CACHE = ResponseCache()
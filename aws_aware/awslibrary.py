@@ -2,21 +2,1108 @@
 A few wrapper methods to make working with AWS boto3 library easier.
 """
 from __future__ import absolute_import
+import os
+import io
 import time
+import calendar
+import hashlib
+import json
 import string
 import random
 import re
+import fnmatch
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 import boto3
-from botocore.exceptions import ClientError
+import botocore.session
+from boto3.s3.transfer import TransferConfig
+from botocore import xform_name
+from botocore.loaders import Loader
+from botocore.config import Config
+from botocore.exceptions import ClientError, DataNotFoundError
+from botocore.response import StreamingBody
 
 try:
     # Import as part of the aws_aware project
     from aws_aware.outputclass import OUTPUT
+    from aws_aware.awscache import RESPONSE_CACHE
+    from aws_aware.compat import string_types
 except ImportError:
     # Otherwise import locally and define out ouput stream manually
     from outputclass import Output as outstream
+    from awscache import RESPONSE_CACHE
+    from compat import string_types
     OUTPUT = outstream()
 
+# Upper bound on concurrent regional polls when none is passed in
+DEFAULT_MAX_WORKERS = 8
+
+# botocore client settings used when none (or only some) are passed in
+DEFAULT_CLIENT_CONFIG = {
+    'max_pool_connections': 50,
+    # None picks standard while the rate governor is enabled, adaptive otherwise
+    'retry_mode': None,
+    'max_attempts': 10,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+}
+
+# s3 transfer settings (bytes/threads) used when none (or only some) are passed in
+DEFAULT_TRANSFER_CONFIG = {
+    'multipart_threshold': 8 * 1024 * 1024,
+    'multipart_chunksize': 8 * 1024 * 1024,
+    'max_concurrency': 10,
+}
+
+# Seconds cached s3 objects are used without revalidating them
+S3_OBJECT_TTL = 300
+
+# Seconds an s3 object that was not found is remembered as missing
+S3_MISSING_TTL = 300
+
+# Most objects the s3 object cache keeps before evicting the least recently used ones
+S3_OBJECT_ENTRIES = 1000
+
+# Supported aws_instances_brief scan segment (shard) keys
+SEGMENT_KEYS = ('availability-zone', 'instance-state-name', 'instance-type-family')
+
+# All ec2 instance states (used to shard by instance-state-name)
+INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped', 'terminated']
+
+# Most instances a single ssm send_command call accepts
+SSM_MAX_INSTANCES = 50
+
+# ssm command invocation statuses that will not change anymore
+SSM_FINAL_STATUSES = ('Success', 'Failed', 'Cancelled', 'TimedOut', 'Undeliverable', 'Terminated')
+
+# Seconds an InstanceIndex answers lookups before it is rebuilt
+INSTANCE_INDEX_TTL = 300
+
+# Tags that hold the role of an instance within a cluster, by cluster kind
+CLUSTER_ROLE_TAGS = {
+    'cdh': 'Cloudera-Director-Template-Name',
+    'emr': 'aws:elasticmapreduce:instance-group-role',
+}
+
+# Service models loaded ahead of time by prewarm_service_models
+PREWARM_SERVICES = ['ec2', 's3', 'ssm', 'iam']
+
+# Instance attributes aws_instances_brief collects by default
+BRIEF_ATTRIBUTES = ['instance_type', 'private_ip_address', 'public_ip_address', 'launch_time']
+
+# describe_instances attribute projections keyed by attribute list
+_ATTRIBUTE_PROJECTIONS = {}
+
+# Attributes (and their describe_instance_status members) the 'tags' engine can return
+TAG_ENGINE_ATTRIBUTES = {'instance_id': 'InstanceId', 'state': 'InstanceState'}
+
+# Non tag filters the 'tags' engine can pass on to describe_instance_status
+TAG_ENGINE_FILTERS = ('availability-zone', 'instance-state-name', 'instance-state-code')
+
+# Rough response bytes per instance of a describe_instances item, a
+# describe_instance_status item and a describe_tags item (used by engine 'auto')
+INSTANCE_PAYLOAD_BYTES = 6000
+STATUS_PAYLOAD_BYTES = 700
+TAG_PAYLOAD_BYTES = 200
+
+
+class CredentialCache(object):
+    """Caches temporary STS credentials in memory and (optionally) on disk
+    until shortly before they expire. Shared by every AWSAPI connection in
+    the process so repeat runs and daemon cycles skip AssumeRole.
+    """
+
+    def __init__(self, cachepath=None, refreshmargin=300):
+        self.cachepath = cachepath
+        # Seconds before expiration at which credentials are treated as stale
+        self.refreshmargin = refreshmargin
+        self._credentials = {}
+        self._lock = threading.Lock()
+
+    def set_cachepath(self, cachepath=None):
+        """Update the on-disk cache location (None disables disk caching)"""
+        self.cachepath = cachepath
+
+    def get_key(self, *args):
+        """Returns a cache key for a set of assume role arguments"""
+        return hashlib.sha1(json.dumps([str(arg) for arg in args]).encode('utf-8')).hexdigest()
+
+    def _is_valid(self, credentials):
+        return credentials and (credentials['Expiration'] - self.refreshmargin) > time.time()
+
+    def _get_filename(self, key):
+        return os.path.join(self.cachepath, '{0}.json'.format(key))
+
+    def get(self, key):
+        """Return cached credentials for key if they have not expired"""
+        with self._lock:
+            credentials = self._credentials.get(key)
+            if self._is_valid(credentials):
+                return credentials
+
+            if self.cachepath and os.path.isfile(self._get_filename(key)):
+                try:
+                    with open(self._get_filename(key)) as cachefile:
+                        credentials = json.load(cachefile)
+                except (IOError, ValueError):
+                    credentials = None
+                if self._is_valid(credentials):
+                    self._credentials[key] = credentials
+                    return credentials
+
+        return None
+
+    def set(self, key, credentials):
+        """Store credentials returned by sts assume_role"""
+        credentials = {
+            'AccessKeyId': credentials['AccessKeyId'],
+            'SecretAccessKey': credentials['SecretAccessKey'],
+            'SessionToken': credentials['SessionToken'],
+            'Expiration': calendar.timegm(credentials['Expiration'].utctimetuple()),
+        }
+        with self._lock:
+            self._credentials[key] = credentials
+            if self.cachepath:
+                try:
+                    if not os.path.isdir(self.cachepath):
+                        os.makedirs(self.cachepath)
+                    filename = self._get_filename(key)
+                    # Credentials are secrets, keep them readable by the owner only
+                    with os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cachefile:
+                        json.dump(credentials, cachefile)
+                except (IOError, OSError) as e:
+                    OUTPUT.warning('Unable to write credential cache file: {0}'.format(e))
+        return credentials
+
+
+# Process wide STS credential cache
+CREDENTIAL_CACHE = CredentialCache()
+
+# Account ids looked up with sts get_caller_identity, keyed by access key id
+ACCOUNT_IDS = {}
+_ACCOUNT_IDS_LOCK = threading.Lock()
+
+
+class S3ObjectCache(object):
+    """Caches small s3 objects (ie. cluster response files) in memory and (optionally)
+    on disk. Content is stored by ETag and an index maps each bucket/key to the
+    ETag last seen, so a later fetch can be revalidated with IfNoneMatch instead of
+    being downloaded again. Objects that were not found are remembered for
+    missingmaxage seconds and at most maxentries objects are kept. Shared by every
+    AWSAPI connection in the process.
+    """
+
+    def __init__(self, cachepath=None, maxage=S3_OBJECT_TTL, missingmaxage=S3_MISSING_TTL, maxentries=S3_OBJECT_ENTRIES):
+        self.cachepath = cachepath
+        # Seconds an object is used without revalidating it
+        self.maxage = maxage
+        self.missingmaxage = missingmaxage
+        self.maxentries = maxentries
+        self.evictions = 0
+        # s3://bucket/key -> (etag, last validated time)
+        self._index = {}
+        # s3://bucket/key -> time it was last found missing
+        self._missing = {}
+        # etag -> content, least recently used first
+        self._content = OrderedDict()
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def set_cachepath(self, cachepath=None):
+        """Update the on-disk cache location (None disables disk caching)"""
+        with self._lock:
+            self.cachepath = cachepath
+            self._loaded = False
+
+    def _get_url(self, bucket, key):
+        return 's3://{0}/{1}'.format(bucket, key)
+
+    def _get_index_filename(self):
+        return os.path.join(self.cachepath, 'index.json')
+
+    def _get_missing_filename(self):
+        return os.path.join(self.cachepath, 'missing.json')
+
+    def _get_object_path(self):
+        return os.path.join(self.cachepath, 'objects')
+
+    def _get_filename(self, etag):
+        return os.path.join(self._get_object_path(), etag)
+
+    def _load_index(self):
+        """Read the on-disk index once (objects from it are revalidated before use)"""
+        if self._loaded or not self.cachepath:
+            return
+        self._loaded = True
+        for filename, entries, load in (
+                (self._get_index_filename(), self._index, lambda value: (value, 0)),
+                (self._get_missing_filename(), self._missing, float)):
+            try:
+                with open(filename) as indexfile:
+                    index = json.load(indexfile)
+            except (IOError, ValueError):
+                continue
+            for url, value in index.items():
+                entries.setdefault(url, load(value))
+
+    def _save_index(self):
+        """Write the index and the (unexpired) missing objects to disk"""
+        if not self.cachepath:
+            return
+        now = time.time()
+        self._missing = dict((url, seen) for url, seen in self._missing.items() if now - seen < self.missingmaxage)
+        try:
+            if not os.path.isdir(self._get_object_path()):
+                os.makedirs(self._get_object_path())
+            with open(self._get_index_filename(), 'w') as indexfile:
+                json.dump(dict((url, entry[0]) for url, entry in self._index.items()), indexfile)
+            with open(self._get_missing_filename(), 'w') as missingfile:
+                json.dump(self._missing, missingfile)
+        except (IOError, OSError) as e:
+            OUTPUT.warning('Unable to write s3 object cache index: {0}'.format(e))
+
+    def lookup(self, bucket, key):
+        """Returns the cached (etag, content, fresh) of an object, (None, None, False) if unknown"""
+        with self._lock:
+            self._load_index()
+            etag, validated = self._index.get(self._get_url(bucket, key), (None, 0))
+            if etag is None:
+                return None, None, False
+            content = self._content.pop(etag, None)
+            if content is None and self.cachepath:
+                try:
+                    with open(self._get_filename(etag), 'rb') as objectfile:
+                        content = objectfile.read()
+                except (IOError, OSError):
+                    content = None
+            if content is None:
+                return None, None, False
+            # Mark as most recently used, on disk through the modification time
+            self._content[etag] = content
+            if self.cachepath:
+                try:
+                    os.utime(self._get_filename(etag), None)
+                except OSError:
+                    pass
+            fresh = (time.time() - validated) < self.maxage
+            if fresh:
+                self.hits += 1
+            return etag, content, fresh
+
+    def is_missing(self, bucket, key):
+        """True if the object was not found less than missingmaxage seconds ago"""
+        with self._lock:
+            self._load_index()
+            seen = self._missing.get(self._get_url(bucket, key))
+            if seen is not None and (time.time() - seen) < self.missingmaxage:
+                self.hits += 1
+                return True
+            return False
+
+    def missing(self, bucket, key):
+        """Remember that an object was not found (ie. after a 404)"""
+        with self._lock:
+            self._load_index()
+            url = self._get_url(bucket, key)
+            self.misses += 1
+            self._index.pop(url, None)
+            self._missing[url] = time.time()
+            self._save_index()
+
+    def validated(self, bucket, key):
+        """Mark a cached object as current (ie. after a 304 Not Modified)"""
+        with self._lock:
+            url = self._get_url(bucket, key)
+            self.revalidations += 1
+            if url in self._index:
+                self._index[url] = (self._index[url][0], time.time())
+
+    def store(self, bucket, key, etag, content):
+        """Store the content of an object by its etag"""
+        with self._lock:
+            self._load_index()
+            url = self._get_url(bucket, key)
+            self.misses += 1
+            self._index[url] = (etag, time.time())
+            self._missing.pop(url, None)
+            self._content.pop(etag, None)
+            self._content[etag] = content
+            if self.cachepath:
+                try:
+                    if not os.path.isdir(self._get_object_path()):
+                        os.makedirs(self._get_object_path())
+                    with open(self._get_filename(etag), 'wb') as objectfile:
+                        objectfile.write(content)
+                except (IOError, OSError) as e:
+                    OUTPUT.warning('Unable to write s3 object cache file: {0}'.format(e))
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """Remove the least recently used objects until 90% of maxentries are left"""
+        if self.cachepath and os.path.isdir(self._get_object_path()):
+            files = [self._get_filename(etag) for etag in os.listdir(self._get_object_path())]
+        else:
+            files = None
+        count = len(files) if files is not None else len(self._content)
+        if count <= self.maxentries:
+            return
+        excess = count - int(self.maxentries * 0.9)
+        if files is not None:
+            evicted = set()
+            for filename in sorted(files, key=os.path.getmtime)[:excess]:
+                try:
+                    os.remove(filename)
+                    evicted.add(os.path.basename(filename))
+                except OSError:
+                    pass
+        else:
+            evicted = set(list(self._content)[:excess])
+        for etag in evicted:
+            self._content.pop(etag, None)
+        self._index = dict((url, entry) for url, entry in self._index.items() if entry[0] not in evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """
+        Returns the cache counters: hits (fresh objects and objects known to be
+        missing, no s3 call), revalidations (unchanged objects, one conditional
+        call), misses (objects downloaded or found missing), entries and evictions.
+        """
+        with self._lock:
+            return {
+                'backend': 'disk' if self.cachepath else 'memory',
+                'entries': len(self._index),
+                'missing': len(self._missing),
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+            }
+
+    def reset_stats(self):
+        """Reset the hit/miss counters"""
+        with self._lock:
+            self.hits = 0
+            self.revalidations = 0
+            self.misses = 0
+
+
+# Process wide s3 object cache
+S3_OBJECT_CACHE = S3ObjectCache()
+
+
+# The owner of an iam access key as returned by AWSAPI.resolve_access_keys.
+# status is found, denied (not in this account or not allowed) or failed.
+AccessKeyOwner = namedtuple('AccessKeyOwner', [
+    'access_key_id', 'user_name', 'status', 'last_used', 'service_name', 'region', 'error', 'cached'])
+
+
+# Error codes AWS services use when a caller is being throttled
+THROTTLE_ERROR_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'BandwidthLimitExceeded',
+    'EC2ThrottledException', 'PriorRequestNotComplete', 'TransactionInProgressException',
+])
+
+
+class TokenBucket(object):
+    """Token bucket for a single account/region/api. The refill rate is adjusted
+    with AIMD: halved (multiplicative decrease) on every throttle and raised by
+    about `increase` requests per second for every second of successful calls."""
+
+    def __init__(self, rate=20, burst=40, minrate=1, maxrate=100, increase=1, decrease=0.5):
+        if float(rate) <= 0:
+            raise ValueError('Token bucket rate must be greater than 0, not {0}'.format(rate))
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.minrate = float(minrate)
+        self.maxrate = float(maxrate)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take one token, waiting for it if the bucket is empty. Returns the seconds waited."""
+        with self._lock:
+            self._refill(time.time())
+            # Reserve the token now so concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """Multiplicative decrease after a throttling error"""
+        with self._lock:
+            self.rate = max(self.minrate, self.rate * self.decrease)
+            # Drain the burst so the new rate takes effect right away
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        """Additive increase after a successful call"""
+        with self._lock:
+            self.rate = min(self.maxrate, self.rate + self.increase / self.rate)
+
+
+class RateGovernor(object):
+    """
+    Rate limits every AWS API call made through AWSAPI clients with a token
+    bucket per account, region and api (service operation). Hooks into the
+    botocore event system of each client, so retries are governed too.
+    Shared by every AWSAPI connection in the process.
+    """
+
+    def __init__(self, rate=20, burst=40, minrate=1, maxrate=100, enabled=True):
+        self.settings = {'rate': rate, 'burst': burst, 'minrate': minrate, 'maxrate': maxrate}
+        self.enabled = enabled
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def configure(self, rate=None, burst=None, minrate=None, maxrate=None, enabled=None):
+        """Update the settings used for buckets created from now on (None keeps the current
+        value). A rate of 0 (or less) disables the governor."""
+        if enabled is not None:
+            self.enabled = enabled
+        if rate not in (None, '') and float(rate) <= 0:
+            self.enabled = False
+            rate = None
+        for key, val in (('rate', rate), ('burst', burst), ('minrate', minrate), ('maxrate', maxrate)):
+            if val not in (None, ''):
+                self.settings[key] = float(val)
+        with self._lock:
+            self._buckets = {}
+
+    def reset_stats(self):
+        """Zero all counters"""
+        with self._lock:
+            self.started = time.time()
+            self.counters = {'requests': 0, 'throttles': 0, 'waits': 0, 'waitseconds': 0.0}
+            self.apicounters = {}
+
+    def get_bucket(self, key):
+        """Returns (creating it if needed) the token bucket for an (account, region, service, api) key"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(**self.settings)
+                    self._buckets[key] = bucket
+        return bucket
+
+    def _count(self, key, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+            apicounters = self.apicounters.setdefault(key, {'requests': 0, 'throttles': 0, 'waits': 0, 'waitseconds': 0.0})
+            apicounters[counter] += amount
+
+    def register(self, client, account, region):
+        """Route every request of a botocore client through the governor. account is an account id or a
+        callable returning it (resolved when the first call is made)"""
+        def get_key(event_name):
+            # Event names look like before-send.ec2.DescribeInstances
+            parts = event_name.split('.')
+            return (str(account() if callable(account) else account), region, parts[1] if len(parts) > 1 else '*', parts[2] if len(parts) > 2 else '*')
+
+        def before_send(event_name=None, **kwargs):
+            if self.enabled:
+                key = get_key(event_name)
+                waited = self.get_bucket(key).acquire()
+                self._count(key, 'requests')
+                if waited:
+                    self._count(key, 'waits')
+                    self._count(key, 'waitseconds', waited)
+
+        def needs_retry(event_name=None, response=None, **kwargs):
+            if self.enabled and response is not None:
+                key = get_key(event_name)
+                code = response[1].get('Error', {}).get('Code') if response[1] else None
+                if code in THROTTLE_ERROR_CODES or response[0].status_code == 429:
+                    self._count(key, 'throttles')
+                    self.get_bucket(key).throttled()
+                elif response[0].status_code < 400:
+                    self.get_bucket(key).succeeded()
+            # Never influence the retry decision itself
+            return None
+
+        client.meta.events.register('before-send.*.*', before_send)
+        client.meta.events.register('needs-retry.*.*', needs_retry)
+
+    def stats(self):
+        """
+        Returns the governor counters: requests, throttles, waits, waitseconds,
+        effective requests per second since the last reset and the same
+        counters (plus the current rate) per account/region/service/api.
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            results = dict(self.counters)
+            results['rps'] = round(results['requests'] / elapsed, 2)
+            results['apis'] = {}
+            for key, counters in self.apicounters.items():
+                apistats = dict(counters)
+                apistats['rps'] = round(counters['requests'] / elapsed, 2)
+                bucket = self._buckets.get(key)
+                apistats['rate'] = round(bucket.rate, 2) if bucket else None
+                results['apis']['/'.join(key)] = apistats
+        return results
+
+
+# Process wide AWS API rate governor
+RATE_GOVERNOR = RateGovernor()
+
+
+# Upper bounds (milliseconds) of the AWS call latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class CallStats(object):
+    """
+    Records per account, region, service and operation: call count, errors,
+    retries, throttles, response bytes and a latency histogram. Hooks into the
+    botocore event system of each client. Shared by every AWSAPI connection
+    in the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero all counters"""
+        with self._lock:
+            self.started = time.time()
+            self._operations = {}
+
+    def _get_operation(self, key):
+        operation = self._operations.get(key)
+        if operation is None:
+            operation = {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'bytes': 0,
+                'latencyms': 0.0,
+                'maxlatencyms': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+            self._operations[key] = operation
+        return operation
+
+    def _record(self, key, context, http_response=None, parsed=None, error=False):
+        started = context.pop('awsaware_started', None) if context is not None else None
+        latency = (time.time() - started) * 1000 if started else 0.0
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        size = 0
+        if http_response is not None:
+            size = int(getattr(http_response, 'headers', {}).get('content-length') or 0)
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = index
+                break
+        with self._lock:
+            operation = self._get_operation(key)
+            operation['calls'] += 1
+            operation['retries'] += int(metadata.get('RetryAttempts') or 0)
+            operation['bytes'] += size
+            operation['latencyms'] += latency
+            operation['maxlatencyms'] = max(operation['maxlatencyms'], latency)
+            operation['histogram'][bucket] += 1
+            if error or (parsed or {}).get('Error'):
+                operation['errors'] += 1
+
+    def register(self, client, account, region):
+        """Record every call made by a botocore client. account is an account id or a
+        callable returning it (resolved when the first call is made)"""
+        def get_key(event_name):
+            # Event names look like after-call.ec2.DescribeInstances
+            parts = event_name.split('.')
+            return (str(account() if callable(account) else account), region, parts[1] if len(parts) > 1 else '*', parts[2] if len(parts) > 2 else '*')
+
+        def before_call(context=None, **kwargs):
+            if context is not None:
+                context['awsaware_started'] = time.time()
+
+        def after_call(event_name=None, context=None, http_response=None, parsed=None, **kwargs):
+            self._record(get_key(event_name), context, http_response, parsed)
+
+        def after_call_error(event_name=None, context=None, **kwargs):
+            self._record(get_key(event_name), context, error=True)
+
+        def needs_retry(event_name=None, response=None, **kwargs):
+            if response is not None and response[1]:
+                if response[1].get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+                    with self._lock:
+                        self._get_operation(get_key(event_name))['throttles'] += 1
+            return None
+
+        client.meta.events.register('before-call.*.*', before_call)
+        client.meta.events.register('after-call.*.*', after_call)
+        client.meta.events.register('after-call-error.*.*', after_call_error)
+        client.meta.events.register('needs-retry.*.*', needs_retry)
+
+    def stats(self):
+        """
+        Returns totals plus per account/region/service/operation counters:
+        calls, errors, retries, throttles, bytes, average and max latency,
+        latency percentiles (histogram bucket bounds) and the histogram itself.
+        """
+        labels = ['<={0}ms'.format(bound) for bound in LATENCY_BUCKETS] + ['>{0}ms'.format(LATENCY_BUCKETS[-1])]
+        totals = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'bytes': 0, 'latencyms': 0.0}
+        operations = {}
+        with self._lock:
+            elapsed = time.time() - self.started
+            for key, operation in self._operations.items():
+                for counter in totals:
+                    totals[counter] += operation[counter]
+                result = dict((counter, operation[counter]) for counter in ('calls', 'errors', 'retries', 'throttles', 'bytes'))
+                result['avglatencyms'] = round(operation['latencyms'] / operation['calls'], 1) if operation['calls'] else 0
+                result['maxlatencyms'] = round(operation['maxlatencyms'], 1)
+                for percentile in (50, 90, 99):
+                    result['p{0}ms'.format(percentile)] = self._percentile(operation['histogram'], percentile)
+                result['histogram'] = dict((label, count) for label, count in zip(labels, operation['histogram']) if count)
+                operations['/'.join(key)] = result
+        totals['latencyms'] = round(totals['latencyms'], 1)
+        totals['seconds'] = round(elapsed, 1)
+        totals['operations'] = operations
+        return totals
+
+    def _percentile(self, histogram, percentile):
+        """Returns the bucket bound (ms) the percentile falls in, None above the last bound"""
+        total = sum(histogram)
+        if not total:
+            return 0
+        target = total * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None
+        return None
+
+
+# Process wide AWS call instrumentation
+CALL_STATS = CallStats()
+
+
+class _SearchPathList(list):
+    """Loader search path list that ignores paths it already has. boto3 appends
+    its own data path every time a Session is created on top of a loader."""
+
+    def append(self, path):
+        if path not in self:
+            super(_SearchPathList, self).append(path)
+
+
+_SHARED_LOADER = None
+_SHARED_LOADER_LOCK = threading.Lock()
+
+
+def get_shared_loader():
+    """
+    Returns the process wide botocore data loader. Loaded and parsed service
+    models are cached on the loader so every session sharing it only pays the
+    JSON load once.
+    """
+    global _SHARED_LOADER
+    if _SHARED_LOADER is None:
+        with _SHARED_LOADER_LOCK:
+            if _SHARED_LOADER is None:
+                _SHARED_LOADER = Loader(extra_search_paths=_SearchPathList())
+    return _SHARED_LOADER
+
+
+def prewarm_service_models(services=None):
+    """Load the service models (and boto3 resource models) we use into the shared loader"""
+    loader = get_shared_loader()
+    loader.search_paths.append(os.path.join(os.path.dirname(boto3.__file__), 'data'))
+    loader.load_data('endpoints')
+    for service in services or PREWARM_SERVICES:
+        OUTPUT.info('Pre-loading {0} service model'.format(service), suppress=True)
+        loader.load_service_model(service, 'service-2')
+        loader.load_service_model(service, 'paginators-1')
+        try:
+            # Only present (and needed) in newer botocore releases
+            loader.load_service_model(service, 'endpoint-rule-set-1')
+        except DataNotFoundError:
+            pass
+        # Only some services have a boto3 resource model
+        if service in ('ec2', 's3', 'iam'):
+            loader.load_service_model(service, 'resources-1')
+
+
+class InstanceIndex(object):
+    """
+    An in-memory index over raw describe_instances records, built once per
+    inventory snapshot. Maps private ip addresses (of every network interface),
+    tag key/values and cluster roles (see CLUSTER_ROLE_TAGS) to instances so
+    many lookups can be answered without another describe_instances call. Like
+    the tag:Name filter of the live lookups, ip and role lookups only return
+    instances with a Name tag. namedonly marks an index built from a scan that
+    only returned instances with a Name tag (see aws_instances_brief).
+    """
+
+    def __init__(self, instances, namedonly=False):
+        self.created = time.time()
+        self.namedonly = namedonly
+        self.instances = []
+        self._byip = {}
+        self._bytag = {}
+        for instance in instances:
+            self.add(instance)
+
+    def add(self, instance):
+        """Index a single describe_instances instance"""
+        self.instances.append(instance)
+        addresses = set([instance.get('PrivateIpAddress')])
+        for interface in instance.get('NetworkInterfaces', []):
+            addresses.add(interface.get('PrivateIpAddress'))
+            for address in interface.get('PrivateIpAddresses', []):
+                addresses.add(address.get('PrivateIpAddress'))
+        addresses.discard(None)
+        for address in addresses:
+            self._byip.setdefault(address, []).append(instance)
+        for tag in instance.get('Tags', []):
+            self._bytag.setdefault((tag['Key'], tag['Value']), []).append(instance)
+
+    def age(self):
+        """Seconds since the index was built"""
+        return time.time() - self.created
+
+    def by_private_ip(self, ipaddress):
+        """Returns the named instances with ipaddress on any of their interfaces"""
+        return [instance for instance in self._byip.get(ipaddress, []) if get_instance_name(instance) is not None]
+
+    def by_tag(self, key, value):
+        """Returns the instances with a key tag set to value"""
+        return list(self._bytag.get((key, value), []))
+
+    def by_role(self, kind, role, namefilter='*'):
+        """Returns the instances of a cdh or emr cluster role whose name starts with namefilter"""
+        namepattern = namefilter + '*'
+        return [instance for instance in self.by_tag(CLUSTER_ROLE_TAGS[kind], role)
+                if get_instance_name(instance) is not None and fnmatch.fnmatchcase(get_instance_name(instance), namepattern)]
+
+
+def get_instance_name(instance):
+    """Returns the Name tag of a describe_instances instance (None without one)"""
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return None
+
+
+def get_instance_ips(instances):
+    """Returns the private ip address of every network interface of instances"""
+    return [interface['PrivateIpAddress']
+            for instance in instances
+            for interface in instance.get('NetworkInterfaces', [])
+            if interface.get('PrivateIpAddress')]
+
+
+class TagProjection(object):
+    """Projects the wanted tags out of an instance tag list into a flat dictionary.
+
+    tags is a list of tag keys. An entry can also be a [key, alias] list in which
+    case the tag value is stored under alias instead of the tag key.
+    """
+
+    def __init__(self, tags=None):
+        self.aliases = {}
+        for tag in tags or []:
+            if isinstance(tag, (list, tuple)):
+                key = str(tag[0])
+                alias = str(tag[1]) if len(tag) > 1 and tag[1] else key
+            else:
+                key = alias = str(tag)
+            self.aliases[key] = alias
+        self.wantedkeys = frozenset(self.aliases)
+        # Every wanted tag shows up in the results, even when missing on an instance
+        self.emptytags = dict((alias, None) for alias in self.aliases.values())
+
+    def project(self, instancetags):
+        """Returns the Name tag and a new dictionary of wanted tags for one instance"""
+        name = None
+        taginfo = self.emptytags.copy()
+        for tag in instancetags or []:
+            key = tag['Key']
+            # always grab the name
+            if key == 'Name':
+                name = tag['Value']
+            # then grab any other defined tags we want
+            if key in self.wantedkeys:
+                taginfo[self.aliases[key]] = tag['Value']
+        return name, taginfo
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an AWS call is attempted after the deadline of its thread has passed"""
+
+
+# Deadline (epoch seconds) of the AWS calls made by each thread, see set_deadline
+_DEADLINES = threading.local()
+
+
+def get_deadline():
+    """Returns the deadline of AWS calls made by the current thread (None if there is none)"""
+    return getattr(_DEADLINES, 'deadline', None)
+
+
+def set_deadline(deadline=None):
+    """
+    Make AWS calls made by the current thread fail with DeadlineExceeded once
+    deadline (epoch seconds) has passed. Returns the previous deadline so it
+    can be restored afterwards.
+    """
+    previous = get_deadline()
+    _DEADLINES.deadline = deadline
+    return previous
+
+
+def with_deadline(func):
+    """Wraps func so it runs with the deadline of the current thread in whichever
+    thread calls it (ie. a pool worker)"""
+    deadline = get_deadline()
+
+    def run(*args, **kwargs):
+        previous = set_deadline(deadline)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_deadline(previous)
+    return run
+
+
+class NotCacheable(Exception):
+    """Raised by a cached_call loader to return value without caching it (ie. after an error)"""
+
+    def __init__(self, value=None):
+        super(NotCacheable, self).__init__('Not cacheable')
+        self.value = value
+
+
+def _uncached(loader):
+    """Returns loader() for a disabled response cache"""
+    try:
+        return loader()
+    except NotCacheable as e:
+        return e.value
+
+
+def get_tag_filters(filters):
+    """Returns (tag key, values) pairs for the tag:<key> entries of ec2 filters"""
+    return [(flt['Name'][4:], flt['Values']) for flt in filters or [] if flt['Name'].startswith('tag:')]
+
+
+def match_tag_filters(instancetags, tagfilters):
+    """True if an instance tag list matches every (tag key, wildcard values) pair like an ec2 tag filter would"""
+    tagvalues = dict((tag['Key'], tag['Value']) for tag in instancetags or [])
+    return all(key in tagvalues and any(fnmatch.fnmatchcase(tagvalues[key], pattern) for pattern in values)
+               for key, values in tagfilters)
+
+
+def _run_regions(apis, regions, maxworkers, worker, deadline=None, timeout=None, failures=None):
+    """
+    Call worker(api) once per account/region pair from one bounded thread pool.
+    api is the (cached) connection bound to that region. Results are returned
+    in account/region order.
+
+    deadline (epoch seconds) bounds the whole run and timeout (seconds) each
+    pair. Pairs still running at the deadline are abandoned and stop at their
+    next AWS call. Deadlines belong to the worker threads, the shared connections
+    and later calls through them are not affected. Without a failures list the first error is raised, with one
+    every failed pair is appended to it as an account_id/region/error dictionary
+    and left out of the results.
+    """
+    jobs = []
+    for api in apis:
+        for region in api.resolve_regions(regions):
+            jobs.append((api, region))
+
+    if not jobs:
+        return []
+
+    workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(jobs)))
+    OUTPUT.info('Polling {0} account/region pair(s) with {1} worker(s)'.format(len(jobs), workers))
+
+    def run(api, region):
+        regionapi = api.get_region_api(region)
+        scopedeadline = deadline
+        if timeout:
+            scopedeadline = min(deadline or float('inf'), time.time() + float(timeout))
+        previous = set_deadline(scopedeadline)
+        try:
+            return worker(regionapi)
+        finally:
+            set_deadline(previous)
+
+    # Not used as a context manager, that would wait on pairs past the deadline
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(run, api, region) for api, region in jobs]
+        wait(futures, timeout=max(0, deadline - time.time()) if deadline else None)
+    finally:
+        executor.shutdown(wait=False)
+
+    results = []
+    for (api, region), future in zip(jobs, futures):
+        if future.done() and future.exception() is None:
+            results.append(future.result())
+            continue
+        if future.done():
+            error = future.exception()
+        else:
+            future.cancel()
+            error = DeadlineExceeded('Deadline reached before {0} finished'.format(region))
+        if failures is None:
+            raise error
+        regionapi = api._regionapis.get(region, api)
+        OUTPUT.warning('Polling {0} in account {1} failed: {2}'.format(region, regionapi.accountid or api.accountid, error))
+        failures.append({
+            'account_id': regionapi.accountid or api.accountid,
+            'region': region,
+            'error': str(error),
+        })
+    return results
+
+
+def aws_instances_brief_all(apis, regions=None, maxworkers=DEFAULT_MAX_WORKERS, deadline=None, timeout=None, failures=None, **kwargs):
+    """
+    Run aws_instances_brief against several connections (accounts) and regions at
+    once from one bounded thread pool and merge the results. Every record gets
+    the region and account_id it was found in. deadline, timeout and failures
+    are explained in _run_regions. Remaining keyword arguments are passed to
+    aws_instances_brief.
+    """
+    results = []
+    for regionresults in _run_regions(apis, regions, maxworkers, lambda api: api.aws_instances_brief(**kwargs), deadline, timeout, failures):
+        results.extend(regionresults)
+    return results
+
+
+def aws_instances_changes_all(apis, known, since, regions=None, maxworkers=DEFAULT_MAX_WORKERS, deadline=None, timeout=None, failures=None, healthmap=None, **kwargs):
+    """
+    Run aws_instances_changes against several connections (accounts) and regions
+    at once. known is the full list of previously collected instance records,
+    each account/region pair only gets the records it owns. Returns the merged
+    (upserts, removed) results. A healthmap dictionary is filled with the health
+    of every instance of the pairs that succeeded. Remaining keyword arguments
+    are passed to aws_instances_changes.
+    """
+    scopes = {}
+    for instance in known or []:
+        scope = (instance.get('account_id'), instance.get('region'))
+        scopes.setdefault(scope, {})[instance['id']] = instance
+
+    def worker(api):
+        regionhealth = {} if healthmap is not None else None
+        regionupserts, regionremoved = api.aws_instances_changes(
+            scopes.get((api.get_account_id(), api.region), {}), since, healthmap=regionhealth, **kwargs)
+        return regionupserts, regionremoved, regionhealth
+
+    upserts = []
+    removed = set()
+    for regionupserts, regionremoved, regionhealth in _run_regions(apis, regions, maxworkers, worker, deadline, timeout, failures):
+        upserts.extend(regionupserts)
+        removed.update(regionremoved)
+        if regionhealth:
+            healthmap.update(regionhealth)
+    return upserts, removed
+
+
+def aws_auto_scaling_map_all(apis, regions=None, maxworkers=DEFAULT_MAX_WORKERS, deadline=None, timeout=None, failures=None):
+    """
+    Returns one instance id -> auto scaling group name map for several connections
+    (accounts) and regions, built from one paginated describe_auto_scaling_instances
+    scan per account/region pair. deadline, timeout and failures are explained in
+    _run_regions.
+    """
+    asgmap = {}
+    for regionmap in _run_regions(apis, regions, maxworkers, lambda api: api.get_auto_scaling_map(), deadline, timeout, failures):
+        asgmap.update(regionmap)
+    return asgmap
+
+
+def aws_instance_health_all(apis, regions=None, maxworkers=DEFAULT_MAX_WORKERS, deadline=None, timeout=None, failures=None):
+    """
+    Returns one instance id -> health (see get_instance_health) map for several
+    connections (accounts) and regions, built from paginated describe_instance_status
+    scans (1000 instances per call) per account/region pair. deadline, timeout and
+    failures are explained in _run_regions.
+    """
+    healthmap = {}
+    for regionmap in _run_regions(apis, regions, maxworkers, lambda api: api.get_instance_health_map(), deadline, timeout, failures):
+        healthmap.update(regionmap)
+    return healthmap
+
+
+def get_instance_health(status):
+    """
+    Returns the system_status, instance_status and scheduled_events (event codes of
+    events that are not completed or canceled) of a describe_instance_status entry.
+    """
+    events = [event['Code'] for event in status.get('Events', [])
+              if not str(event.get('Description', '')).startswith(('[Completed]', '[Canceled]'))]
+    return {
+        'system_status': status.get('SystemStatus', {}).get('Status'),
+        'instance_status': status.get('InstanceStatus', {}).get('Status'),
+        'scheduled_events': events,
+    }
+
+
+def launch_time_patterns(since, until=None):
+    """
+    Returns ec2 launch-time filter values (wildcards) covering every hour from
+    since to until (epoch seconds). Windows longer than two days are covered
+    by whole days instead.
+    """
+    until = time.time() if until is None else until
+    if until - since > 172800:
+        fmt, step = '%Y-%m-%dT*', 86400
+    else:
+        fmt, step = '%Y-%m-%dT%H:*', 3600
+    patterns = []
+    current = int(since) - int(since) % step
+    while current <= until:
+        pattern = time.strftime(fmt, time.gmtime(current))
+        if pattern not in patterns:
+            patterns.append(pattern)
+        current += step
+    return patterns
+
+
+def file_etag(path, partsize=None):
+    """
+    Returns the s3 ETag a local file would get when uploaded. Without partsize
+    (single part uploads) this is the md5 of the content, otherwise it is the md5
+    of the concatenated part md5s followed by -<partcount>.
+    """
+    if not partsize:
+        digest = hashlib.md5()
+        with open(path, 'rb') as localfile:
+            for chunk in iter(lambda: localfile.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    partdigests = []
+    with open(path, 'rb') as localfile:
+        for chunk in iter(lambda: localfile.read(partsize), b''):
+            partdigests.append(hashlib.md5(chunk).digest())
+    return '{0}-{1}'.format(hashlib.md5(b''.join(partdigests)).hexdigest(), len(partdigests))
+
 
 class AWSAPI(object):
     """AWSAPI wrapper library for boto3 based operations
@@ -24,18 +1111,41 @@ class AWSAPI(object):
         About: A few wrapper methods to make working with AWS boto3 library easier.
     """
 
-    def __init__(self, awsid=None, awssecret=None, profileid=None, region='us-east-1'):
+    def __init__(self, awsid=None, awssecret=None, profileid=None, region='us-east-1', awstoken=None, accountid=None, clientconfig=None, sharedloader=True, rategovernor=None, callstats=None, transferconfig=None, responsecache=None):
         # AWS authentication information
         self.awsid = awsid
         self.secret = awssecret
+        self.token = awstoken
         self.profileid = profileid
         self.region = region
+        self.accountid = accountid
+        self.clientconfig = clientconfig
+        self.transferconfig = transferconfig
+        self._transferconfig = None
+        self.sharedloader = sharedloader
+        # Every client is rate limited by this governor (False disables it)
+        self.rategovernor = RATE_GOVERNOR if rategovernor is None else rategovernor
+        # Every client call is recorded here (False disables it)
+        self.callstats = CALL_STATS if callstats is None else callstats
+        # Read only call results are cached here (False disables it)
+        self.responsecache = RESPONSE_CACHE if responsecache is None else responsecache
         self.session = None
+        # Clients and resources built once per session, keyed by (service, region)
+        self._clients = {}
+        self._resources = {}
+        self._clientlock = threading.Lock()
+        # Connections to other regions, keyed by region
+        self._regionapis = {}
         self.ec2resource = None
         self.ec2 = None
         # Used in our subnet search functions (thanks to Bill!)
         self._foundsubnet = None
         self._desiredsubnetcount = 1
+        # (bucket, prefix) of every get_s3_listing call (see clear_s3_listings)
+        self._s3listings = set()
+        # Instance lookups are answered from this index until it is indexmaxage seconds old
+        self._instanceindex = None
+        self.indexmaxage = INSTANCE_INDEX_TTL
 
         # Setup a general connection
         self.connect_session()
@@ -55,18 +1165,25 @@ class AWSAPI(object):
     def connect_session(self):
         """Connect with current profile or id/secret"""
         try:
+            botocoresession = botocore.session.get_session()
+            if self.sharedloader:
+                # Reuse already loaded service models instead of parsing them per session
+                botocoresession.register_component('data_loader', get_shared_loader())
             if self.profileid:
                 OUTPUT.info('Using passed in profile - {0}'.format(self.profileid))
                 self.session = boto3.Session(
                     profile_name=self.profileid,
-                    region_name=self.region
+                    region_name=self.region,
+                    botocore_session=botocoresession
                 )
             else:
                 self._add_log('Connecting to AWS with key id - {0}'.format(self.awsid))
                 self.session = boto3.Session(
                     aws_access_key_id=self.awsid,
                     aws_secret_access_key=self.secret,
-                    region_name=self.region
+                    aws_session_token=self.token,
+                    region_name=self.region,
+                    botocore_session=botocoresession
                 )
         except ClientError as e:
             self._add_log(e, 'error')
@@ -76,12 +1193,253 @@ class AWSAPI(object):
         """Attempt to connect session to ec2 resources"""
         self._add_log('Connecting to AWS ec2 resources with existing session.')
         try:
-            self.ec2resource = self.session.resource('ec2')
-            self.ec2 = self.session.client('ec2')
+            self.ec2resource = self.get_resource('ec2')
+            self.ec2 = self.get_client('ec2')
         except ClientError as e:
             self._add_log(e, 'error')
             raise e
 
+    def get_botocore_config(self):
+        """Returns the botocore Config used for every client of this connection"""
+        settings = DEFAULT_CLIENT_CONFIG.copy()
+        settings.update(dict((key, val) for key, val in (self.clientconfig or {}).items() if val not in (None, '')))
+        retrymode = settings['retry_mode']
+        if not retrymode:
+            # adaptive mode adds a client side rate limiter of its own on top of the governor
+            retrymode = 'standard' if self.rategovernor and self.rategovernor.enabled else 'adaptive'
+        return Config(
+            max_pool_connections=int(settings['max_pool_connections']),
+            connect_timeout=int(settings['connect_timeout']),
+            read_timeout=int(settings['read_timeout']),
+            retries={
+                'mode': str(retrymode),
+                'max_attempts': int(settings['max_attempts'])
+            })
+
+    def get_transfer_config(self):
+        """Returns the boto3 TransferConfig shared by every s3 download of this connection"""
+        if self._transferconfig is None:
+            settings = DEFAULT_TRANSFER_CONFIG.copy()
+            settings.update(dict((key, val) for key, val in (self.transferconfig or {}).items() if val not in (None, '')))
+            self._transferconfig = TransferConfig(
+                multipart_threshold=int(settings['multipart_threshold']),
+                multipart_chunksize=int(settings['multipart_chunksize']),
+                max_concurrency=int(settings['max_concurrency']))
+        return self._transferconfig
+
+    def get_client(self, service, region=None):
+        """
+        Returns a shared boto3 client for service/region. Each client is built once
+        per session (endpoint resolution, connection pool) and is safe to share
+        across threads.
+        """
+        key = (service, region or self.region)
+        client = self._clients.get(key)
+        if client is None:
+            # boto3 sessions are not thread safe so build clients one at a time
+            with self._clientlock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self.session.client(service, region_name=key[1], config=self.get_botocore_config())
+                    self._register_client(client, key[1])
+                    self._clients[key] = client
+        return client
+
+    def get_resource(self, service, region=None):
+        """Returns a shared boto3 resource for service/region (see get_client)"""
+        key = (service, region or self.region)
+        resource = self._resources.get(key)
+        if resource is None:
+            with self._clientlock:
+                resource = self._resources.get(key)
+                if resource is None:
+                    resource = self.session.resource(service, region_name=key[1], config=self.get_botocore_config())
+                    self._register_client(resource.meta.client, key[1])
+                    self._resources[key] = resource
+        return resource
+
+    def _register_client(self, client, region):
+        """
+        Hook a new client up to our deadline, call stats and the rate governor.
+        Stats and rate limits are kept per account id, which is looked up before
+        the first call is made rather than when the client is created.
+        """
+        client.meta.events.register('before-call.*.*', self._resolve_account)
+        if self.callstats:
+            self.callstats.register(client, self.get_account_id, region)
+        if self.rategovernor:
+            self.rategovernor.register(client, self.get_account_id, region)
+        # After the governor, a request that waited for a token past the deadline is not sent
+        client.meta.events.register('before-send.*.*', self._check_deadline)
+
+    def _resolve_account(self, **kwargs):
+        """botocore before-call hook, makes sure the account id is known before a request goes out"""
+        self.get_account_id()
+
+    def cached_call(self, operation, params, loader, maxage=None, region=None):
+        """
+        Returns loader() through the response cache, keyed by the account id
+        (see get_account_id), region, operation and params (see ResponseCache.cached).
+        The disk cache outlives the process, so entries are never keyed by the
+        credentials in use. loader may raise NotCacheable(value) to return a value
+        without caching it.
+        """
+        if not self.responsecache:
+            return _uncached(loader)
+        try:
+            return self.responsecache.cached(self.get_account_id(), region or self.region, operation, params, loader, maxage)
+        except NotCacheable as e:
+            return e.value
+
+    def _check_deadline(self, **kwargs):
+        """botocore before-send hook, fails calls (and retries) made after the deadline
+        of the calling thread (see set_deadline)"""
+        deadline = get_deadline()
+        if deadline and time.time() > deadline:
+            raise DeadlineExceeded('{0} deadline reached ({1})'.format(self.region, kwargs.get('event_name')))
+
+    def stats(self):
+        """Returns the AWS call stats (see CallStats.stats)"""
+        return self.callstats.stats() if self.callstats else {}
+
+    def get_rate_stats(self):
+        """Returns the rate governor counters (see RateGovernor.stats)"""
+        return self.rategovernor.stats() if self.rategovernor else {}
+
+    def for_region(self, region):
+        """Return a new connection of the same class bound to another region.
+        The new connection gets its own session and clients."""
+        return self.__class__(
+            awsid=self.awsid,
+            awssecret=self.secret,
+            awstoken=self.token,
+            profileid=self.profileid,
+            region=region,
+            accountid=self.accountid,
+            clientconfig=self.clientconfig,
+            transferconfig=self.transferconfig,
+            sharedloader=self.sharedloader,
+            rategovernor=self.rategovernor,
+            callstats=self.callstats,
+            responsecache=self.responsecache)
+
+    def get_region_api(self, region):
+        """Returns this connection for its own region, otherwise a (cached) connection
+        bound to region created with for_region"""
+        if not region or region == self.region:
+            return self
+        api = self._regionapis.get(region)
+        if api is None:
+            with self._clientlock:
+                api = self._regionapis.get(region)
+                if api is None:
+                    api = self.for_region(region)
+                    self._regionapis[region] = api
+        return api
+
+    def get_account_id(self):
+        """Returns the account id of the current credentials, looked up once per
+        access key id with sts get_caller_identity"""
+        if not self.accountid:
+            credentials = self.session.get_credentials()
+            accesskey = credentials.access_key if credentials else None
+            with _ACCOUNT_IDS_LOCK:
+                accountid = ACCOUNT_IDS.get(accesskey)
+                if not accountid:
+                    # Not through get_client, those clients need the account id for their first call
+                    sts = self.session.client('sts', region_name=self.region, config=self.get_botocore_config())
+                    accountid = sts.get_caller_identity()['Account']
+                    if accesskey:
+                        ACCOUNT_IDS[accesskey] = accountid
+            self.accountid = accountid
+        return self.accountid
+
+    def assume_role(self, rolearn, externalid=None, sessionname='aws-aware', duration=3600, credentialcache=None):
+        """
+        Return a new connection of the same class using temporary credentials for rolearn.
+        Credentials are reused from the credential cache until they expire.
+        """
+        if credentialcache is None:
+            credentialcache = CREDENTIAL_CACHE
+        cachekey = credentialcache.get_key(self.awsid or self.profileid, rolearn, externalid, sessionname)
+        credentials = credentialcache.get(cachekey)
+
+        if credentials:
+            self._add_log('Using cached credentials for role - {0}'.format(rolearn))
+        else:
+            self._add_log('Assuming role - {0}'.format(rolearn))
+            kwargs = {
+                'RoleArn': rolearn,
+                'RoleSessionName': sessionname,
+                'DurationSeconds': int(duration)
+            }
+            if externalid:
+                kwargs['ExternalId'] = externalid
+            try:
+                response = self.get_client('sts').assume_role(**kwargs)
+            except ClientError as e:
+                self._add_log(e, 'error')
+                raise e
+            credentials = credentialcache.set(cachekey, response['Credentials'])
+
+        return self.__class__(
+            awsid=credentials['AccessKeyId'],
+            awssecret=credentials['SecretAccessKey'],
+            awstoken=credentials['SessionToken'],
+            region=self.region,
+            accountid=rolearn.split(':')[4],
+            clientconfig=self.clientconfig,
+            transferconfig=self.transferconfig,
+            sharedloader=self.sharedloader,
+            rategovernor=self.rategovernor,
+            callstats=self.callstats,
+            responsecache=self.responsecache)
+
+    def assume_roles(self, accounts, maxworkers=DEFAULT_MAX_WORKERS, failures=None):
+        """
+        Assume several roles at once. accounts is a list of dictionaries with a
+        role_arn and an optional external_id. Returns connections in the same order.
+        With a failures list, accounts whose role cannot be assumed are appended
+        to it (as account_id/region/error dictionaries, region None) and skipped
+        instead of raising.
+        """
+        if not accounts:
+            return []
+        workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(accounts)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.assume_role, account['role_arn'], account.get('external_id'))
+                for account in accounts]
+            if failures is None:
+                return [future.result() for future in futures]
+            apis = []
+            for account, future in zip(accounts, futures):
+                if future.exception() is None:
+                    apis.append(future.result())
+                else:
+                    failures.append({
+                        'account_id': account['role_arn'].split(':')[4],
+                        'region': None,
+                        'error': str(future.exception()),
+                    })
+            return apis
+
+    def get_regions(self):
+        """Returns all region names enabled for this account"""
+        regions = self.ec2.describe_regions()['Regions']
+        return [region['RegionName'] for region in regions]
+
+    def resolve_regions(self, regions=None):
+        """Normalize a region definition ('all', a comma separated string or a list)
+        into a list of region names"""
+        if not regions:
+            return [self.region]
+        if isinstance(regions, string_types):
+            if regions.strip().lower() == 'all':
+                return self.get_regions()
+            regions = regions.split(',')
+        return [str(region).strip() for region in regions if str(region).strip()]
+
     def getbotoclientconnection(self):
         # Returns the ec2 connection for direct use
         return self.ec2
@@ -91,135 +1449,260 @@ class AWSAPI(object):
         return self.ec2resource
 
     def getavailablesubnet(self, desiredsubnetcount, subnetstosearch):
+        """
+        Returns the first subnet (in search order) with more than desiredsubnetcount
+        available ip addresses. subnetstosearch is a comma separated list of subnet
+        ids and/or CIDR blocks, all of them are looked up in one batched call.
+        """
         self._desiredsubnetcount = int(desiredsubnetcount)
-        subnets = subnetstosearch.split(',')
+        queries = [query.strip() for query in subnetstosearch.split(',') if query.strip()]
 
         self._add_log("Desired subnet count: {0}".format(self._desiredsubnetcount))
 
-        for subnet in subnets:
-            self._add_log("Searching subnet - {0}".format(subnet))
-            lookup = self._show_subnet_usage(subnet)
-            if lookup == 'found':
+        subnets = self.get_subnets(queries)
+        for query in queries:
+            self._add_log("Searching subnet - {0}".format(query))
+            subnet = self._match_subnet(query, subnets)
+            if subnet is None:
+                continue
+            actual = int(subnet['AvailableIpAddressCount'])
+            self._add_log("Actual subnets in {0}: {1}".format(subnet['SubnetId'], actual))
+
+            if self._desiredsubnetcount < actual:
+                self._add_log("Desired subnets = {0}, available subnets = {1}".format(self._desiredsubnetcount, actual))
+                self._foundsubnet = subnet['SubnetId']
                 return self._foundsubnet
 
-    def _show_subnet_usage(self, query):
-        # Really the main section it calls all the sub functions
-        #  and all is passed back into this
-        subnet = self._find_subnet(query)
-        actual = int(subnet['AvailableIpAddressCount'])
-        self._add_log("Actual subnets in {0}: {1}".format(subnet['SubnetId'], actual))
-
-        if self._desiredsubnetcount < actual:
-            self._add_log("Desired subnets = {0}, available subnets = {1}".format(self._desiredsubnetcount, actual))
-
-            self._foundsubnet = subnet['SubnetId']
-            return('found')
+    def get_subnets(self, queries=None, vpcids=None, maxage=None):
+        """
+        Returns describe_subnets entries for subnet ids and/or CIDR blocks (queries),
+        optionally limited to (or, without queries, all subnets in) vpcids. Uses
+        one paginated describe_subnets call per 200 ids or CIDR blocks. Results
+        come from the response cache when they are no older than maxage seconds
+        (the describe_subnets ttl by default).
+        """
+        queries = list(queries or [])
+        vpcids = list(vpcids or [])
+        params = {'queries': sorted(queries), 'vpcids': sorted(vpcids)}
+        return self.cached_call('describe_subnets', params, lambda: self._describe_subnets(queries, vpcids), maxage)
+
+    def _describe_subnets(self, queries, vpcids):
+        """get_subnets without the cache, raises NotCacheable with partial results on errors"""
+        subnetids = []
+        cidrs = []
+        for query in queries:
+            if re.match(r'^subnet-[a-fA-F0-9]+$', query):
+                subnetids.append(query)
+            elif '/' in query:
+                cidrs.append(query)
+            else:
+                self._add_log("ERROR: {0} does not look like a subnet ID or CIDR block".format(query))
 
-    def _find_subnet(self, query):
-        # Finds the subnet based on subnet id
-        #"""find a subnet by query (subnet ID or CIDR block)"""
-        if re.match(r'^subnet-[a-fA-F0-9]+$', query):
-            subnet = self._find_subnet_by_id(query)
-        else:
-            self._add_log("ERROR: {0} does not look like a subnet ID or CIDR block".format(query))
+        basefilters = [{'Name': 'vpc-id', 'Values': vpcids}] if vpcids else []
+        lookups = []
+        for filtername, values in (('subnet-id', subnetids), ('cidr-block', cidrs)):
+            for index in range(0, len(values), 200):
+                lookups.append(basefilters + [{'Name': filtername, 'Values': values[index:index + 200]}])
+        if not queries and vpcids:
+            lookups.append(basefilters)
 
-        return subnet
+        results = []
+        seen = set()
+        failed = False
+        paginator = self.ec2.get_paginator('describe_subnets')
+        for filters in lookups:
+            try:
+                for page in paginator.paginate(Filters=filters):
+                    for subnet in page['Subnets']:
+                        if subnet['SubnetId'] not in seen:
+                            seen.add(subnet['SubnetId'])
+                            results.append(subnet)
+            except (ClientError, DeadlineExceeded) as e:
+                self._add_log(e, 'error')
+                failed = True
+
+        if failed:
+            raise NotCacheable(results)
+        return results
 
-    def _find_subnet_by_id(self, subnet_id):
-        # Formats the subnetid into a kwarg
-        #"""find a subnet by subnet ID"""
-        kwargs = {
-            'SubnetIds': [subnet_id]
-        }
-        return self._find_classic_subnet(kwargs)
+    def _match_subnet(self, query, subnets):
+        """Returns the subnet matching a subnet id or CIDR block query from a get_subnets result"""
+        for subnet in subnets:
+            if query in (subnet['SubnetId'], subnet.get('CidrBlock')):
+                return subnet
+        self._add_log("Subnet not found - {0}".format(query), 'warning')
+        return None
 
-    def _find_classic_subnet(self, kwargs):
-        # Searches AWS for the subnet infomration
-        #"""call describe_subnets passing kwargs"""
-        try:
-            subnets = self.ec2.describe_subnets(**kwargs)['Subnets']
-        except ClientError:
-            return ''
-        return subnets[0]
+    def _find_subnet(self, query):
+        """find a subnet by query (subnet ID or CIDR block)"""
+        return self._match_subnet(query, self.get_subnets([query]))
 
-    def aws_instances(self, namefilter='*', otherfilters=None, asEC2resource=False):
+    def _name_filters(self, namefilter='*', otherfilters=None):
+        """Returns describe_instances filters for a name prefix plus any other filters"""
         filters = [{'Name': 'tag:Name',
                     'Values': [namefilter + '*']}]
         if otherfilters:
             filters = filters + otherfilters
+        return filters
+
+    def iter_instance_pages(self, filters=None, page_size=None, hedgeafter=None):
+        """
+        Yields describe_instances pages one at a time, following NextToken.
+        Stopping iteration early skips the remaining pages.
+
+        With hedgeafter (seconds) a page request that has not answered by then
+        is sent a second time and whichever answers first is used.
+        """
+        if not hedgeafter:
+            paginator = self.ec2.get_paginator('describe_instances')
+            kwargs = {'Filters': filters or []}
+            if page_size:
+                kwargs['PaginationConfig'] = {'PageSize': int(page_size)}
+            for page in paginator.paginate(**kwargs):
+                yield page
+            return
+
+        kwargs = {'Filters': filters or []}
+        if page_size:
+            kwargs['MaxResults'] = int(page_size)
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            while True:
+                page = self._hedged_call(executor, self.ec2.describe_instances, dict(kwargs), hedgeafter)
+                yield page
+                if not page.get('NextToken'):
+                    break
+                kwargs['NextToken'] = page['NextToken']
+        finally:
+            # Never wait on a losing (slow) request
+            executor.shutdown(wait=False)
+
+    def _hedged_call(self, executor, call, kwargs, hedgeafter):
+        """Returns call(**kwargs), sending a second identical request if the first is slower than hedgeafter seconds"""
+        call = with_deadline(call)
+        first = executor.submit(call, **kwargs)
+        if wait([first], timeout=float(hedgeafter)).done:
+            return first.result()
+        self._add_log('{0} request slower than {1}s, sending a hedged request'.format(getattr(call, '__name__', 'AWS'), hedgeafter))
+        error = None
+        for future in as_completed([first, executor.submit(call, **kwargs)]):
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        raise error
+
+    def iter_instances(self, filters=None, page_size=None, hedgeafter=None):
+        """
+        Yields raw instance dictionaries matching filters page by page without
+        building the full reservation list in memory.
+        """
+        for page in self.iter_instance_pages(filters=filters, page_size=page_size, hedgeafter=hedgeafter):
+            for reservation in page.get('Reservations', []):
+                for instance in reservation['Instances']:
+                    yield instance
+
+    def aws_instances(self, namefilter='*', otherfilters=None, asEC2resource=False, page_size=None):
+        filters = self._name_filters(namefilter, otherfilters)
 
         self._add_log('aws_instances filters: {0}'.format(str(filters)))
         results = []
 
-        reservations = self.ec2.describe_instances(Filters=filters)
-
-        for r in reservations.get('Reservations'):
-            for i in r['Instances']:
-                if asEC2resource:
-                    res = boto3.resource('ec2')
-                    thisinstance = res.Instance(i['InstanceId'])
-                    results.append(thisinstance)
-                else:
-                    results.append(i)
+        for i in self.iter_instances(filters=filters, page_size=page_size):
+            if asEC2resource:
+                results.append(self.ec2resource.Instance(i['InstanceId']))
+            else:
+                results.append(i)
 
         return results
-        # return reservations.get('Reservations')
+
+    def aws_first_instance(self, namefilter='*', otherfilters=None):
+        """Returns the first instance matching the filters (or None) without reading further pages"""
+        filters = self._name_filters(namefilter, otherfilters)
+        self._add_log('aws_first_instance filters: {0}'.format(str(filters)))
+        return next(self.iter_instances(filters=filters), None)
 
     def aws_instances_brief(self, 
                             namefilter='*', 
                             otherfilters=None, 
                             attributes=['instance_type', 'private_ip_address', 'public_ip_address', 'launch_time'], 
-                            tags=[]):
+                            tags=[],
+                            engine='client',
+                            page_size=None,
+                            segmentkey=None,
+                            segmentvalues=None,
+                            segmentworkers=DEFAULT_MAX_WORKERS,
+                            hedgeafter=None):
         """
-        Same as aws_instances but at a much higher level 
-        (using just boto3.resource instead of boto3.client)
+        Same as aws_instances but at a much higher level. Returns a list of flat
+        instance dictionaries with only the requested attributes and tags.
+
+        engine 'client' (default) projects attributes straight out of the raw
+        describe_instances pages. engine 'resource' uses boto3.resource Instance
+        objects instead (slower, same output). engine 'tags' joins a lean
+        describe_instance_status scan with bulk describe_tags results, it only
+        supports the TAG_ENGINE_ATTRIBUTES attributes and tag or
+        TAG_ENGINE_FILTERS filters, other requests fall back to 'client' with a
+        warning. engine 'auto' picks 'tags' when it can serve the request and its
+        projected payload (see get_projected_payload) is the smaller one, and
+        'client' otherwise.
+
+        tags entries are tag keys or [key, alias] lists (value stored under alias).
+
+        segmentkey splits the scan into independent shards (availability-zone,
+        instance-state-name or instance-type-family) that are scanned concurrently
+        with up to segmentworkers threads. segmentvalues overrides the shard
+        values that would otherwise be looked up. Segmented scans always use the
+        client engine since resource objects are not thread safe.
+
+        hedgeafter (seconds) re-sends page requests of the client engine that
+        are slower than that and uses whichever answer arrives first.
+
+        A client engine scan without filters (other than the default name filter)
+        sees every named instance, its raw records become the instance index so
+        later ip and role lookups need no describe_instances call of their own
+        (see get_instance_index).
         """
         # filters = [{'Name': 'tag:Name',
         #             'Values': [namefilter + '*']}]
-        filters = [{'Name': 'tag:Name',
-                    'Values': [namefilter + '*']}]
-        # Add any additional filters
-        if otherfilters:
-            filters = filters + otherfilters
+        filters = self._name_filters(namefilter, otherfilters)
 
         # Log our filter used
         self._add_log('aws_instances_brief filters: {0}'.format(str(filters)))
 
+        engine = str(engine).lower()
+        if engine in ('auto', 'tags'):
+            engine = self.pick_engine(engine, filters, attributes, tags)
+
+        # Raw records of an unfiltered scan, kept as the instance index
+        rawinstances = [] if engine == 'client' and namefilter == '*' and not otherfilters else None
+
         # Get all instances matching our filters
-        instances = self.ec2resource.instances.filter(Filters=filters)
+        if engine == 'tags':
+            instances = self._iter_brief_tags(filters, attributes, tags, page_size)
+        elif segmentkey:
+            instances = self._scan_segments(filters, attributes, page_size, segmentkey, segmentvalues, segmentworkers, hedgeafter, rawinstances)
+        elif engine == 'resource':
+            instances = self._iter_brief_resource(filters, attributes)
+        else:
+            instances = self._iter_brief_client(filters, attributes, page_size, hedgeafter, rawinstances)
 
         results = []
-        taginfo = {}
-        # Create a base dictionary of empty tags
-        for tag in tags:
-            if isinstance(tag, str):
-                taginfo[tag] = None
-            elif isinstance(tag, list):
-                # If we have a list then only the first on matters
-                taginfo[tag[0]] = None
+        accountid = self.get_account_id()
+        tagprojection = TagProjection(tags)
 
         # Loop through all instances and pull any info
-        for instance in instances:
-            name = None
+        for instanceid, state, instancetags, attrvalues in instances:
+            name, taginfo = tagprojection.project(instancetags)
             inst = {
-                'id': instance.id,
+                'id': instanceid,
                 'name': name,
-                'state': instance.state['Name']
+                'state': state,
+                'region': self.region,
+                'account_id': accountid
             }
 
-            # Loop through tags for info
-            for tag in instance.tags:
-                # always grab the name
-                if tag['Key'] == 'Name':
-                    inst['name'] = tag['Value']
-
-                # then grab any other defined tags we want
-                if tag['Key'] in tags:
-                    taginfo[tag['Key']] = tag['Value']
-
             # Update any attributes found
-            for attr in attributes:
-                inst[attr] = getattr(instance, attr)
+            inst.update(attrvalues)
 
             # Add any found tags to the instance results
             inst.update(taginfo)
@@ -227,50 +1710,710 @@ class AWSAPI(object):
             # Add final instance info to our results list
             results.append(inst)
 
+        if rawinstances is not None:
+            self.set_instance_index(rawinstances, namedonly=True)
         return results
 
-    def aws_instance_by_private_ip(self, ipaddress):
-        filters = [{
-            'Name': 'private-ip-address',
-            'Values': [ipaddress]
-        }]
-        result = self.aws_instances(otherfilters=filters)
-        return result
+    def get_segment_filters(self, filters, segmentkey, segmentvalues=None):
+        """
+        Returns one filter list per shard for a segmented scan. Each shard is the
+        passed in filters plus (or narrowed by) a single segment filter value.
+        """
+        segmentkey = str(segmentkey).lower()
+        if segmentkey not in SEGMENT_KEYS:
+            raise ValueError('Unknown scan segment key: {0} (expected one of {1})'.format(segmentkey, ', '.join(SEGMENT_KEYS)))
+
+        filtername = 'instance-type' if segmentkey == 'instance-type-family' else segmentkey
+        basefilters = [flt for flt in filters if flt['Name'] != filtername]
+        existing = [flt for flt in filters if flt['Name'] == filtername]
+
+        if existing:
+            # Never widen a filter we were given, shard its values instead
+            values = existing[0]['Values']
+            if segmentkey == 'instance-type-family':
+                families = {}
+                for value in values:
+                    families.setdefault(value.split('.')[0], []).append(value)
+                shardvalues = list(families.values())
+            else:
+                shardvalues = [[value] for value in values]
+        else:
+            if segmentvalues:
+                values = segmentvalues
+            elif segmentkey == 'availability-zone':
+                values = [zone['ZoneName'] for zone in self.ec2.describe_availability_zones()['AvailabilityZones']]
+            elif segmentkey == 'instance-state-name':
+                values = INSTANCE_STATES
+            else:
+                values = self.get_instance_type_families()
+            if segmentkey == 'instance-type-family':
+                shardvalues = [['{0}.*'.format(value)] for value in values]
+            else:
+                shardvalues = [[value] for value in values]
 
-    def aws_node_count(self, namefilter='*'):
-        """Report nodes found in AWS"""
-        self._add_log("Looking for nodes matching: {0}".format(namefilter))
-        nodes = self.aws_instances(namefilter=namefilter)
-        return len(nodes)
+        return [basefilters + [{'Name': filtername, 'Values': shard}] for shard in shardvalues]
+
+    def get_instance_type_families(self):
+        """Returns all instance type families (ie. m5, r3) offered in this region"""
+        families = set()
+        paginator = self.ec2.get_paginator('describe_instance_type_offerings')
+        for page in paginator.paginate(LocationType='region'):
+            for offering in page['InstanceTypeOfferings']:
+                families.add(offering['InstanceType'].split('.')[0])
+        return sorted(families)
 
-    def s3_folder_exists(self, bucket, folderpath):
-        """Check for s3 folder"""
+    def _scan_segments(self, filters, attributes, page_size, segmentkey, segmentvalues=None, segmentworkers=DEFAULT_MAX_WORKERS, hedgeafter=None, rawinstances=None):
+        """
+        Scan all shards concurrently against the shared ec2 client and return the
+        (id, state, tags, attributes) results de-duplicated by instance id. The
+        raw records are appended to a rawinstances list (de-duplicated as well).
+        """
+        shards = self.get_segment_filters(filters, segmentkey, segmentvalues)
+        if not shards:
+            return []
+        workers = max(1, min(int(segmentworkers or DEFAULT_MAX_WORKERS), len(shards)))
+        self._add_log('Segmented scan by {0}: {1} shard(s), {2} worker(s)'.format(segmentkey, len(shards), workers))
+
+        def scan(shardfilters):
+            shardinstances = [] if rawinstances is not None else None
+            return list(self._iter_brief_client(shardfilters, attributes, page_size, hedgeafter, shardinstances)), shardinstances
+
+        results = []
+        seen = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for shardresults, shardinstances in executor.map(with_deadline(scan), shards):
+                for index, result in enumerate(shardresults):
+                    if result[0] not in seen:
+                        seen.add(result[0])
+                        results.append(result)
+                        if rawinstances is not None:
+                            rawinstances.append(shardinstances[index])
+        return results
+
+    def _iter_brief_resource(self, filters, attributes):
+        """Yields (id, state, tags, attributes) using boto3 resource Instance objects"""
+        for instance in self.ec2resource.instances.filter(Filters=filters):
+            attrvalues = {}
+            for attr in attributes:
+                attrvalues[attr] = getattr(instance, attr)
+            yield instance.id, instance.state['Name'], instance.tags, attrvalues
+
+    def _iter_brief_client(self, filters, attributes, page_size=None, hedgeafter=None, rawinstances=None):
+        """Yields (id, state, tags, attributes) projected straight from raw describe_instances pages,
+        the raw records are also appended to a rawinstances list"""
+        projection = self._get_attribute_projection(attributes)
+        for instance in self.iter_instances(filters=filters, page_size=page_size, hedgeafter=hedgeafter):
+            if rawinstances is not None:
+                rawinstances.append(instance)
+            attrvalues = {}
+            for attr, member in projection:
+                attrvalues[attr] = instance.get(member)
+            yield instance['InstanceId'], instance['State']['Name'], instance.get('Tags'), attrvalues
+
+    def can_use_tag_engine(self, filters, attributes):
+        """True if the 'tags' engine can serve these filters and attributes"""
+        if any(attr not in TAG_ENGINE_ATTRIBUTES for attr in attributes):
+            return False
+        return all(flt['Name'].startswith('tag:') or flt['Name'] in TAG_ENGINE_FILTERS for flt in filters)
+
+    def get_projected_payload(self, engine, filters, tags):
+        """
+        Returns the rough response bytes per instance of the 'client' or 'tags'
+        engine. The tags engine pays for a status item plus one describe_tags
+        item per wanted (or filtered on) tag key, the client engine for a full
+        describe_instances item whatever it projects out of it.
+        """
+        if engine != 'tags':
+            return INSTANCE_PAYLOAD_BYTES
+        keys = set(TagProjection(tags).wantedkeys) | set(key for key, _ in get_tag_filters(filters)) | set(['Name'])
+        return STATUS_PAYLOAD_BYTES + TAG_PAYLOAD_BYTES * len(keys)
+
+    def pick_engine(self, engine, filters, attributes, tags):
+        """
+        Resolves engine 'tags' or 'auto' for a request. 'tags' falls back to
+        'client' (with a warning) when it cannot serve the attributes or filters,
+        'auto' picks 'tags' only when it can and its projected payload is smaller.
+        """
+        tagengine = self.can_use_tag_engine(filters, attributes)
+        if engine == 'tags' and not tagengine:
+            self._add_log('The tags engine only supports the {0} attributes and tag or {1} filters, using the client engine'.format(
+                ', '.join(sorted(TAG_ENGINE_ATTRIBUTES)), ', '.join(TAG_ENGINE_FILTERS)), 'warning')
+            engine = 'client'
+        elif engine == 'auto':
+            tagpayload = self.get_projected_payload('tags', filters, tags) if tagengine else None
+            clientpayload = self.get_projected_payload('client', filters, tags)
+            engine = 'tags' if tagengine and tagpayload < clientpayload else 'client'
+        self._add_log('aws_instances_brief engine: {0}'.format(engine))
+        return engine
+
+    def _iter_brief_tags(self, filters, attributes, tags, page_size=None):
+        """
+        Yields (id, state, tags, attributes) from a describe_instance_status scan
+        joined by instance id with the wanted (and filtered on) tags from bulk
+        describe_tags pages. Tag filters are applied on our side.
+        """
+        tagfilters = get_tag_filters(filters)
+        keys = set(TagProjection(tags).wantedkeys) | set(key for key, _ in tagfilters) | set(['Name'])
+        instancetags = {}
+        for instanceid, key, value in self.iter_instance_tags(keys=sorted(keys), page_size=page_size):
+            instancetags.setdefault(instanceid, []).append({'Key': key, 'Value': value})
+
+        statusfilters = [flt for flt in filters if not flt['Name'].startswith('tag:')]
+        for status in self.iter_instance_statuses(filters=statusfilters, page_size=page_size):
+            itags = instancetags.get(status['InstanceId'])
+            if not match_tag_filters(itags, tagfilters):
+                continue
+            attrvalues = {}
+            for attr in attributes:
+                attrvalues[attr] = status.get(TAG_ENGINE_ATTRIBUTES[attr])
+            yield status['InstanceId'], status['InstanceState']['Name'], itags, attrvalues
+
+    def _get_attribute_projection(self, attributes):
+        """
+        Returns a list of (attribute, describe_instances member) pairs that map boto3
+        resource style attribute names (ie. private_ip_address) onto raw
+        describe_instances output. Built once per attribute set.
+        """
+        cachekey = tuple(attributes)
+        projection = _ATTRIBUTE_PROJECTIONS.get(cachekey)
+        if projection is None:
+            # Resource attributes are the snake_case names of the Instance shape members
+            members = self.ec2.meta.service_model.shape_for('Instance').members
+            attributemap = dict((xform_name(member), member) for member in members)
+            projection = []
+            for attr in attributes:
+                if attr not in attributemap:
+                    raise AttributeError("ec2.Instance has no attribute '{0}'".format(attr))
+                projection.append((attr, attributemap[attr]))
+            _ATTRIBUTE_PROJECTIONS[cachekey] = projection
+        return projection
+
+    def iter_instance_statuses(self, filters=None, page_size=None):
+        """
+        Yields describe_instance_status entries (instance id, state, status checks)
+        for instances in any state. Much leaner than describe_instances when only
+        the state is needed.
+        """
+        paginator = self.ec2.get_paginator('describe_instance_status')
+        kwargs = {'IncludeAllInstances': True, 'Filters': filters or []}
+        if page_size:
+            kwargs['PaginationConfig'] = {'PageSize': int(page_size)}
+        for page in paginator.paginate(**kwargs):
+            for status in page.get('InstanceStatuses', []):
+                yield status
+
+    def get_instance_health_map(self, page_size=1000):
+        """Returns an instance id -> health (see get_instance_health) map for every instance in this region"""
+        return dict((status['InstanceId'], get_instance_health(status))
+                    for status in self.iter_instance_statuses(page_size=page_size))
+
+    def iter_instance_tags(self, keys=None, page_size=None):
+        """Yields (instance id, key, value) for every instance tag, optionally only for some tag keys"""
+        paginator = self.ec2.get_paginator('describe_tags')
+        filters = [{'Name': 'resource-type', 'Values': ['instance']}]
+        if keys:
+            filters.append({'Name': 'key', 'Values': list(keys)})
+        kwargs = {'Filters': filters}
+        if page_size:
+            kwargs['PaginationConfig'] = {'PageSize': int(page_size)}
+        for page in paginator.paginate(**kwargs):
+            for tag in page.get('Tags', []):
+                yield tag['ResourceId'], tag['Key'], tag['Value']
+
+    def aws_instances_changes(self,
+                              known,
+                              since,
+                              namefilter='*',
+                              otherfilters=None,
+                              attributes=['instance_type', 'private_ip_address', 'public_ip_address', 'launch_time'],
+                              tags=[],
+                              engine='client',
+                              page_size=None,
+                              launchskew=300,
+                              hedgeafter=None,
+                              healthmap=None):
+        """
+        Returns what changed in this region since an earlier aws_instances_brief
+        run as (upserts, removed). known is a dictionary of the earlier records
+        by instance id, since is the epoch time that run started.
+
+        When a healthmap dictionary is passed the describe_instance_status scan
+        covers every instance and fills it with instance id -> health (see
+        get_instance_health), so health checks need no scan of their own.
+
+        upserts are full records for instances launched (or started, which
+        resets the launch time) since then plus known records with a changed
+        state or changed tags. removed are the ids of known instances that were
+        terminated, left the filtered states or no longer match the tag filters.
+
+        Instances that start matching the tag filters without being (re)launched
+        are only picked up by the next full poll.
+        """
+        filters = self._name_filters(namefilter, otherfilters)
+        launchsince = since - int(launchskew or 0)
+        changed = {}
+        removed = set()
+
+        # New launches (and restarts) within the launch-time window
+        launchfilter = {'Name': 'launch-time', 'Values': launch_time_patterns(launchsince)}
+        launched = {}
+        for instance in self.aws_instances_brief(
+                namefilter=namefilter,
+                otherfilters=(otherfilters or []) + [launchfilter],
+                attributes=attributes,
+                tags=tags,
+                engine=engine,
+                page_size=page_size,
+                hedgeafter=hedgeafter):
+            launchtime = instance.get('launch_time')
+            if launchtime is not None and hasattr(launchtime, 'utctimetuple'):
+                # The filter matches whole hours (or days), trim to the real window
+                if calendar.timegm(launchtime.utctimetuple()) < launchsince and instance['id'] in known:
+                    continue
+            launched[instance['id']] = instance
+
+        if known or healthmap is not None:
+            # State transitions. With a single wanted state only instances in other
+            # states need looking at, otherwise (or for health) look at every state.
+            wantedstates = None
+            for flt in filters:
+                if flt['Name'] == 'instance-state-name':
+                    wantedstates = set(flt['Values'])
+            statusfilters = []
+            if healthmap is None and wantedstates and len(wantedstates) == 1:
+                statusfilters = [{'Name': 'instance-state-name', 'Values': [state for state in INSTANCE_STATES if state not in wantedstates]}]
+            for status in self.iter_instance_statuses(filters=statusfilters, page_size=page_size):
+                instanceid = status['InstanceId']
+                if healthmap is not None:
+                    healthmap[instanceid] = get_instance_health(status)
+                if instanceid not in known:
+                    continue
+                state = status['InstanceState']['Name']
+                if wantedstates and state not in wantedstates:
+                    removed.add(instanceid)
+                elif state != known[instanceid].get('state'):
+                    changed.setdefault(instanceid, dict(known[instanceid]))['state'] = state
+
+        if known:
+            # Tag changes for the tags we project plus the ones we filter on
+            tagprojection = TagProjection(tags)
+            tagfilters = get_tag_filters(filters)
+            keys = set(tagprojection.wantedkeys) | set(key for key, _ in tagfilters) | set(['Name'])
+            currenttags = {}
+            for instanceid, key, value in self.iter_instance_tags(keys=sorted(keys), page_size=page_size):
+                if instanceid in known:
+                    currenttags.setdefault(instanceid, []).append({'Key': key, 'Value': value})
+
+            for instanceid, instance in known.items():
+                if instanceid in removed:
+                    continue
+                instancetags = currenttags.get(instanceid, [])
+                # Gone instances have no tags left and fail the Name filter too
+                if not match_tag_filters(instancetags, tagfilters):
+                    removed.add(instanceid)
+                    continue
+                name, taginfo = tagprojection.project(instancetags)
+                if name != instance.get('name') or any(instance.get(key) != val for key, val in taginfo.items()):
+                    record = changed.setdefault(instanceid, dict(instance))
+                    record['name'] = name
+                    record.update(taginfo)
+
+        # A fresh describe_instances record wins over anything else
+        removed.difference_update(launched)
+        upserts = list(launched.values())
+        upserts.extend(record for instanceid, record in changed.items() if instanceid not in launched and instanceid not in removed)
+        self._add_log('Changes in {0}: {1} new or changed, {2} removed'.format(self.region, len(upserts), len(removed)))
+        return upserts, removed
+
+    def aws_instances_brief_regions(self, regions=None, maxworkers=DEFAULT_MAX_WORKERS, **kwargs):
+        """
+        Run aws_instances_brief against several regions at once and merge the results.
+        Each region is polled from a bounded thread pool with its own session and
+        clients. regions can be a list, a comma separated string or 'all'.
+        Remaining keyword arguments are passed to aws_instances_brief.
+        """
+        return aws_instances_brief_all([self], regions=regions, maxworkers=maxworkers, **kwargs)
+
+    def get_instance_index(self, maxage=None, build=True, named=False):
+        """
+        Returns the InstanceIndex of this connection. It is built from one full
+        describe_instances scan, or kept from the last unfiltered aws_instances_brief
+        scan, and rebuilt once it is older than maxage seconds (indexmaxage by
+        default, 0 always rebuilds). With build False None is returned instead of
+        scanning when there is no fresh index. Lookups that only return named
+        instances (named) can also use an index of named instances only.
+        """
+        maxage = self.indexmaxage if maxage is None else maxage
+        index = self._instanceindex
+        if index is None or index.age() >= float(maxage) or (index.namedonly and not named):
+            if not build:
+                return None
+            self._add_log('Building instance index')
+            index = InstanceIndex(self.iter_instances())
+            self._instanceindex = index
+        return index
+
+    def set_instance_index(self, instances, namedonly=False):
+        """Use already collected describe_instances instances as the instance index"""
+        self._instanceindex = InstanceIndex(instances, namedonly)
+        return self._instanceindex
+
+    def aws_instance_by_private_ip(self, ipaddress, maxage=None):
+        """
+        Returns the (named) instances with a private ip address. Answered from the
+        instance index when a fresh one exists (see get_instance_index), a single
+        lookup is not worth a full scan so it is a filtered call otherwise.
+        """
+        index = self.get_instance_index(maxage, build=False, named=True)
+        if index is None:
+            return self.aws_instances(otherfilters=[{'Name': 'network-interface.addresses.private-ip-address', 'Values': [ipaddress]}])
+        return index.by_private_ip(ipaddress)
+
+    def aws_instances_by_private_ips(self, ipaddresses, maxage=None):
+        """Returns an OrderedDict of private ip address -> instances for many addresses at once"""
+        index = self.get_instance_index(maxage, named=True)
+        return OrderedDict((ipaddress, index.by_private_ip(ipaddress)) for ipaddress in ipaddresses)
+
+    def aws_instances_by_tag(self, key, values, maxage=None):
+        """Returns an OrderedDict of tag value -> instances with a key tag set to that value"""
+        index = self.get_instance_index(maxage)
+        return OrderedDict((value, index.by_tag(key, value)) for value in values)
+
+    def aws_instances_by_role(self, kind, role, namefilter='*', maxage=None):
+        """
+        Returns the (named) instances of a cdh or emr cluster role whose name starts
+        with namefilter, from a fresh instance index when there is one and a filtered
+        describe_instances call otherwise (see aws_instance_by_private_ip).
+        """
+        index = self.get_instance_index(maxage, build=False, named=True)
+        if index is None:
+            rolefilter = [{'Name': 'tag:{0}'.format(CLUSTER_ROLE_TAGS[kind]), 'Values': [role]}]
+            return self.aws_instances(namefilter=namefilter, otherfilters=rolefilter)
+        return index.by_role(kind, role, namefilter)
+
+    def get_auto_scaling_map(self, page_size=50):
+        """
+        Returns an instance id -> auto scaling group name map for every auto scaling
+        instance in this region. Uses paginated describe_auto_scaling_instances calls
+        (at most 50 records each) instead of a lookup per instance.
+        """
+        paginator = self.get_client('autoscaling').get_paginator('describe_auto_scaling_instances')
+        asgmap = {}
+        for page in paginator.paginate(PaginationConfig={'PageSize': int(page_size)}):
+            for asginstance in page.get('AutoScalingInstances', []):
+                asgmap[asginstance['InstanceId']] = asginstance['AutoScalingGroupName']
+        return asgmap
+
+    def aws_node_count(self, namefilter='*', maxcount=None, otherfilters=None):
+        """Report nodes found in AWS. Only instance ids are kept while paging. If
+        maxcount is passed then counting (and paging) stops as soon as that many
+        nodes have been found."""
+        self._add_log("Looking for nodes matching: {0}".format(namefilter))
+        count = 0
+        for _ in self.iter_instance_ids(namefilter, otherfilters):
+            count += 1
+            if maxcount and count >= maxcount:
+                break
+        return count
+
+    def iter_instance_ids(self, namefilter='*', otherfilters=None, page_size=None):
+        """
+        Yields the ids of instances matching a name prefix (and filters) page by
+        page. Without other filters only the Name tags are read (describe_tags),
+        otherwise describe_instances pages are streamed and only ids are kept.
+        """
+        if otherfilters:
+            for instance in self.iter_instances(filters=self._name_filters(namefilter, otherfilters), page_size=page_size):
+                yield instance['InstanceId']
+        else:
+            for instanceid, _ in self.iter_instance_names(namefilter, page_size=page_size):
+                yield instanceid
+
+    def iter_instance_names(self, namefilter='*', page_size=None):
+        """Yields (instance id, Name tag) for every instance with a Name starting with namefilter"""
+        paginator = self.ec2.get_paginator('describe_tags')
+        filters = [
+            {'Name': 'resource-type', 'Values': ['instance']},
+            {'Name': 'key', 'Values': ['Name']},
+            {'Name': 'value', 'Values': [namefilter + '*']},
+        ]
+        kwargs = {'Filters': filters}
+        if page_size:
+            kwargs['PaginationConfig'] = {'PageSize': int(page_size)}
+        for page in paginator.paginate(**kwargs):
+            for tag in page.get('Tags', []):
+                yield tag['ResourceId'], tag['Value']
+
+    def s3_folder_exists(self, bucket, folderpath, cacheprefix=None):
+        """Check for s3 folder (any key under folderpath). With cacheprefix the answer
+        comes from a cached listing of that prefix (see get_s3_listing)."""
         self._add_log("Validating if {0} exists in {1}".format(folderpath, bucket))
-        s3 = self.session.client('s3')
-        result = s3.list_objects(Bucket=bucket, Prefix=folderpath)
-        exists = False
-        if result:
-            exists = True
-        return exists
-
-    def s3_file_exists(self, bucket, filepath):
-        """Check for s3 file"""
+        if cacheprefix is not None and folderpath.startswith(cacheprefix):
+            return any(key.startswith(folderpath) for key in self.get_s3_listing(bucket, cacheprefix))
+
+        def check():
+            try:
+                result = self.get_client('s3').list_objects_v2(Bucket=bucket, Prefix=folderpath, MaxKeys=1)
+            except ClientError as e:
+                self._add_log(e, 'error')
+                raise NotCacheable(False)
+            return result.get('KeyCount', 0) > 0
+        return self.cached_call('list_objects_v2', {'Bucket': bucket, 'Prefix': folderpath, 'MaxKeys': 1}, check)
+
+    def s3_file_exists(self, bucket, filepath, cacheprefix=None):
+        """Check for s3 file (head_object). With cacheprefix the answer comes from
+        a cached listing of that prefix (see get_s3_listing)."""
         self._add_log("Validating if {0} exists in {1}".format(filepath, bucket))
-        s3 = self.session.client('s3')
-        result = s3.list_objects(Bucket=bucket, Prefix=filepath)
-        exists = False
-        if result:
-            exists = True
-        return exists
+        if cacheprefix is not None and filepath.startswith(cacheprefix):
+            return filepath in self.get_s3_listing(bucket, cacheprefix)
+
+        def check():
+            try:
+                self.get_client('s3').head_object(Bucket=bucket, Key=filepath)
+            except ClientError as e:
+                if not self._is_s3_not_found(e):
+                    self._add_log(e, 'error')
+                    raise NotCacheable(False)
+                return False
+            return True
+        return self.cached_call('head_object', {'Bucket': bucket, 'Key': filepath}, check)
+
+    def get_s3_listing(self, bucket, prefix='', maxage=None):
+        """
+        Returns all objects under prefix as a dictionary of key -> list_objects_v2
+        entry (Size, ETag, LastModified...). The paginated listing comes from the
+        response cache when it is no older than maxage seconds (the list_objects_v2
+        ttl by default) so many existence checks under one root cost one listing.
+        """
+        self._s3listings.add((bucket, prefix))
+        return self.cached_call('list_objects_v2', {'Bucket': bucket, 'Prefix': prefix}, lambda: self._list_s3_objects(bucket, prefix), maxage)
+
+    def _list_s3_objects(self, bucket, prefix):
+        """get_s3_listing without the cache, raises NotCacheable with partial results on errors"""
+        self._add_log("Listing s3://{0}/{1}".format(bucket, prefix))
+        listing = {}
+        paginator = self.get_client('s3').get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for entry in page.get('Contents', []):
+                    listing[entry['Key']] = entry
+        except ClientError as e:
+            self._add_log(e, 'error')
+            raise NotCacheable(listing)
+        return listing
+
+    def clear_s3_listings(self):
+        """Forget all cached s3 prefix listings"""
+        if self.responsecache:
+            for bucket, prefix in self._s3listings:
+                self.responsecache.delete(self.get_account_id(), self.region, 'list_objects_v2', {'Bucket': bucket, 'Prefix': prefix})
+        self._s3listings = set()
+
+    def _is_s3_not_found(self, error):
+        """True if a ClientError is a missing key or bucket (404)"""
+        code = str(error.response.get('Error', {}).get('Code'))
+        return code in ('404', 'NoSuchKey', 'NotFound', 'NoSuchBucket')
 
     def download_s3_file(self, bucket, path, destpath):
-        s3resource = self.session.resource('s3')
-        self._add_log('downloading file: bucket - {0} ; file - {1}; desination - {2}'.format(bucket, path, destpath))
+        """Download an s3 file, returns False if it does not exist (or cannot be downloaded)"""
+        result = self.download_s3_files([(bucket, path, destpath)], skipexisting=False)[0]
+        return result['status'] in ('downloaded', 'skipped')
+
+    def download_s3_files(self, manifest, maxworkers=DEFAULT_MAX_WORKERS, skipexisting=True, sizeonly=False, cacheprefix=None):
+        """
+        Download several s3 files at once. manifest is a list of (bucket, key, destpath)
+        tuples (or dictionaries with bucket/key/destpath). Every file goes through the
+        same TransferConfig (see get_transfer_config) so large files are fetched in
+        concurrent parts as well.
+
+        With skipexisting, files already on disk with the same size and ETag are not
+        downloaded again (sizeonly skips on a matching size alone). The remote size
+        and ETag come from head_object, or from a cached listing when the key is under
+        cacheprefix (see get_s3_listing).
+
+        Returns one dictionary per manifest entry, in the same order, with bucket, key,
+        destpath, status (downloaded, skipped, missing or failed), bytes, seconds and error.
+        """
+        entries = []
+        for entry in manifest:
+            if isinstance(entry, dict):
+                entries.append((entry['bucket'], entry['key'], entry['destpath']))
+            else:
+                entries.append(tuple(entry))
+        if not entries:
+            return []
+
+        results = [None] * len(entries)
+        workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(entries)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(self._download_s3_entry, bucket, key, destpath, skipexisting, sizeonly, cacheprefix), index)
+                for index, (bucket, key, destpath) in enumerate(entries))
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def _download_s3_entry(self, bucket, key, destpath, skipexisting=True, sizeonly=False, cacheprefix=None):
+        """Download (or skip) a single download_s3_files manifest entry"""
+        result = {
+            'bucket': bucket,
+            'key': key,
+            'destpath': destpath,
+            'status': 'failed',
+            'bytes': 0,
+            'seconds': 0.0,
+            'error': None
+        }
+        start = time.time()
+        s3 = self.get_client('s3')
         try:
-            download = s3resource.Bucket(bucket).download_file(path, destpath)
-            return True
-        except:
+            if skipexisting and os.path.isfile(destpath):
+                remote = self._get_s3_object_info(bucket, key, cacheprefix)
+                if remote is None:
+                    result['status'] = 'missing'
+                elif self._local_file_matches(destpath, remote, sizeonly):
+                    result['status'] = 'skipped'
+                    result['bytes'] = remote['size']
+            if result['status'] == 'failed':
+                self._add_log('downloading file: bucket - {0} ; file - {1}; desination - {2}'.format(bucket, key, destpath))
+                destfolder = os.path.dirname(os.path.abspath(destpath))
+                if not os.path.isdir(destfolder):
+                    os.makedirs(destfolder)
+                s3.download_file(bucket, key, destpath, Config=self.get_transfer_config())
+                result['status'] = 'downloaded'
+                result['bytes'] = os.path.getsize(destpath)
+        except ClientError as e:
+            if self._is_s3_not_found(e):
+                result['status'] = 'missing'
+            else:
+                self._add_log(e, 'error')
+                result['error'] = str(e)
+        except (IOError, OSError) as e:
+            self._add_log(e, 'error')
+            result['error'] = str(e)
+        if result['status'] == 'missing':
+            self._add_log('File not found: s3://{0}/{1}'.format(bucket, key), 'warning')
+            result['error'] = 'Not found'
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    def _get_s3_object_info(self, bucket, key, cacheprefix=None):
+        """Returns the size and ETag of an s3 object, None if it does not exist"""
+        if cacheprefix is not None and key.startswith(cacheprefix):
+            entry = self.get_s3_listing(bucket, cacheprefix).get(key)
+            if entry is None:
+                return None
+            return {'size': entry['Size'], 'etag': entry['ETag'].strip('"')}
+        try:
+            response = self.get_client('s3').head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if self._is_s3_not_found(e):
+                return None
+            raise
+        return {'size': response['ContentLength'], 'etag': response['ETag'].strip('"')}
+
+    def _local_file_matches(self, path, remote, sizeonly=False):
+        """True if a local file has the size (and ETag) of an s3 object"""
+        if os.path.getsize(path) != remote['size']:
             return False
+        if sizeonly:
+            return True
+        etag = remote['etag']
+        if '-' not in etag:
+            # Single part upload, the ETag is the md5 of the content
+            return file_etag(path) == etag
+        # Multipart upload, only comparable when we can guess the part size it was uploaded with
+        parts = int(etag.split('-')[1])
+        megabyte = 1024 * 1024
+        partsizes = [
+            self.get_transfer_config().multipart_chunksize,
+            int(-(-remote['size'] // (parts * megabyte))) * megabyte
+        ]
+        return any(file_etag(path, partsize) == etag for partsize in partsizes)
+
+    def get_s3_object_cached(self, bucket, key, objectcache=None):
+        """
+        Returns the content of a (small) s3 object through the s3 object cache. A
+        cached object is revalidated with IfNoneMatch once it is older than the
+        cache maxage, so unchanged objects are never downloaded twice.
+
+        Returns a dictionary with bucket, key, etag, body (bytes), status (cached,
+        notmodified, downloaded, missing or failed), seconds and error.
+        """
+        if objectcache is None:
+            objectcache = S3_OBJECT_CACHE
+        result = {
+            'bucket': bucket,
+            'key': key,
+            'etag': None,
+            'body': None,
+            'status': 'failed',
+            'seconds': 0.0,
+            'error': None
+        }
+        start = time.time()
+        # A disabled response cache (ie. --no-cache) bypasses the object cache as well
+        usecache = bool(self.responsecache and self.responsecache.enabled)
+        etag, content, fresh = objectcache.lookup(bucket, key) if usecache else (None, None, False)
+        if fresh:
+            result.update({'etag': etag, 'body': content, 'status': 'cached'})
+            return result
+        if usecache and objectcache.is_missing(bucket, key):
+            result.update({'status': 'missing', 'error': 'Not found'})
+            return result
+
+        kwargs = {'Bucket': bucket, 'Key': key}
+        if etag:
+            kwargs['IfNoneMatch'] = '"{0}"'.format(etag)
+        try:
+            response = self.get_client('s3').get_object(**kwargs)
+            body = response['Body'].read()
+            result.update({'etag': response['ETag'].strip('"'), 'body': body, 'status': 'downloaded'})
+            if usecache:
+                objectcache.store(bucket, key, result['etag'], body)
+        except ClientError as e:
+            code = str(e.response.get('Error', {}).get('Code'))
+            if etag and code in ('304', 'NotModified'):
+                objectcache.validated(bucket, key)
+                result.update({'etag': etag, 'body': content, 'status': 'notmodified'})
+            elif self._is_s3_not_found(e):
+                result.update({'status': 'missing', 'error': 'Not found'})
+                if usecache:
+                    objectcache.missing(bucket, key)
+            else:
+                self._add_log(e, 'error')
+                result['error'] = str(e)
+        except DeadlineExceeded as e:
+            self._add_log(e, 'warning')
+            result['error'] = str(e)
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    def prefetch_s3_objects(self, objects, maxworkers=DEFAULT_MAX_WORKERS, objectcache=None):
+        """
+        Fetch several (bucket, key) objects at once through the s3 object cache
+        (see get_s3_object_cached). Returns results in the same order. Objects
+        not fetched before the deadline of the calling thread are failed results.
+        """
+        objects = list(objects)
+        if not objects:
+            return []
+        results = [None] * len(objects)
+        workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(objects)))
+        fetch = with_deadline(self.get_s3_object_cached)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(fetch, bucket, key, objectcache), index)
+                for index, (bucket, key) in enumerate(objects))
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def get_ssm_document_name(self, os='linux'):
+        """Returns the AWS provided ssm document that runs commands for an os"""
+        if str(os).lower() == 'windows':
+            return 'AWS-RunPowerShellScript'
+        return 'AWS-RunShellScript'
 
     def execute_commands_on_instances(self, commands, instance_ids, os='linux'):
         """Runs commands on remote linux instances
@@ -279,28 +2422,200 @@ class AWSAPI(object):
         :param instance_ids: a list of instance_id strings, of the instances on which to execute the command
         :return: the response from the send_command function (check the boto3 docs for ssm client.send_command() )
         """
-        if str(os).lower() == 'windows':
-            documentname = 'AWS-RunPowerShellScript'
-        else:
-            documentname = 'AWS-RunShellScript'
-        ssm = self.session.client('ssm')
+        ssm = self.get_client('ssm')
         resp = ssm.send_command(
-            DocumentName=documentname,  # One of AWS' preconfigured documents
+            DocumentName=self.get_ssm_document_name(os),  # One of AWS' preconfigured documents
             Parameters={'commands': commands},
             InstanceIds=instance_ids
         )
         return resp
 
+    def execute_commands_batch(self, commands, instance_ids, os='linux', chunksize=SSM_MAX_INSTANCES, maxworkers=DEFAULT_MAX_WORKERS,
+                               timeout=600, pollinterval=2, maxpollinterval=30, comment=None):
+        """
+        Run commands on any number of instances and yield each instance result as
+        soon as it is known. Instances are sent to ssm in chunks of at most chunksize
+        (send_command accepts 50) from a thread pool. Results are then collected with
+        paginated list_command_invocations calls, one per command and poll, instead of
+        one get_command_invocation call per instance. Polls back off (with jitter)
+        from pollinterval to maxpollinterval seconds.
+
+        Each result is a dictionary with instance_id, command_id, status,
+        status_details, response_code, output and error. Instances still running
+        after timeout seconds are yielded with a TimedOut status (status_details
+        'NotCollected').
+        """
+        instance_ids = list(OrderedDict((instanceid, None) for instanceid in instance_ids))
+        if not instance_ids:
+            return
+        chunksize = max(1, min(int(chunksize or SSM_MAX_INSTANCES), SSM_MAX_INSTANCES))
+        chunks = [instance_ids[index:index + chunksize] for index in range(0, len(instance_ids), chunksize)]
+        deadline = time.time() + timeout if timeout else None
+        ssm = self.get_client('ssm')
+        kwargs = {
+            'DocumentName': self.get_ssm_document_name(os),
+            'Parameters': {'commands': list(commands)}
+        }
+        if comment:
+            kwargs['Comment'] = str(comment)[:100]
+        if timeout:
+            kwargs['TimeoutSeconds'] = max(30, int(timeout))
+
+        def send(chunk):
+            return ssm.send_command(InstanceIds=chunk, **kwargs)['Command']['CommandId']
+
+        # Command id -> instances we are still waiting for
+        pending = OrderedDict()
+        workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(send, chunk), chunk) for chunk in chunks)
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    pending[future.result()] = set(chunk)
+                except ClientError as e:
+                    self._add_log(e, 'error')
+                    for instanceid in chunk:
+                        yield self._ssm_result(instanceid, status='Failed', statusdetails='NotSent', error=str(e))
+            self._add_log('Sent {0} ssm command(s) to {1} instance(s)'.format(len(pending), len(instance_ids)))
+
+            interval = pollinterval
+            while pending:
+                if deadline and time.time() >= deadline:
+                    break
+                # Sleep between pollinterval / 2 and the current interval, capped by the deadline
+                sleepfor = random.uniform(interval / 2.0, interval)
+                if deadline:
+                    sleepfor = min(sleepfor, max(0, deadline - time.time()))
+                time.sleep(sleepfor)
+                interval = min(maxpollinterval, interval * 2)
+
+                commandids = list(pending)
+                for commandid, invocations in zip(commandids, executor.map(self._list_command_invocations, commandids)):
+                    for invocation in invocations:
+                        instanceid = invocation['InstanceId']
+                        if instanceid in pending[commandid] and invocation['Status'] in SSM_FINAL_STATUSES:
+                            pending[commandid].discard(instanceid)
+                            yield self._ssm_invocation_result(commandid, invocation)
+                    if not pending[commandid]:
+                        del pending[commandid]
+
+        for commandid, instances in pending.items():
+            for instanceid in instances:
+                yield self._ssm_result(instanceid, commandid, status='TimedOut', statusdetails='NotCollected')
+
+    def _list_command_invocations(self, commandid):
+        """Returns all invocations (with output) of an ssm command, an empty list on errors"""
+        paginator = self.get_client('ssm').get_paginator('list_command_invocations')
+        invocations = []
+        try:
+            for page in paginator.paginate(CommandId=commandid, Details=True):
+                invocations.extend(page.get('CommandInvocations', []))
+        except ClientError as e:
+            self._add_log(e, 'warning')
+        return invocations
+
+    def _ssm_result(self, instanceid, commandid=None, status=None, statusdetails=None, responsecode=None, output=None, error=None):
+        """Returns an execute_commands_batch result"""
+        return {
+            'instance_id': instanceid,
+            'command_id': commandid,
+            'status': status,
+            'status_details': statusdetails,
+            'response_code': responsecode,
+            'output': output,
+            'error': error
+        }
+
+    def _ssm_invocation_result(self, commandid, invocation):
+        """Returns an execute_commands_batch result for a list_command_invocations entry"""
+        plugins = invocation.get('CommandPlugins', [])
+        responsecodes = [plugin['ResponseCode'] for plugin in plugins if plugin.get('ResponseCode') is not None]
+        return self._ssm_result(
+            invocation['InstanceId'],
+            commandid,
+            status=invocation['Status'],
+            statusdetails=invocation.get('StatusDetails'),
+            # The first failing plugin decides the response code
+            responsecode=next((code for code in responsecodes if code != 0), responsecodes[0]) if responsecodes else None,
+            output=''.join(plugin.get('Output', '') for plugin in plugins))
+
     def get_arn_from_key(self, key):
-        iam = self.session.client('iam')
+        """Returns the iam user name owning an access key, None if it cannot be resolved
+        (see resolve_access_keys for the reason)"""
+        key = str(key).strip()
+        return self.resolve_access_keys([key])[key].user_name
 
+    def resolve_access_keys(self, keys, maxworkers=DEFAULT_MAX_WORKERS):
+        """
+        Resolve the owners of many iam access keys at once. Duplicate keys are looked
+        up once, owners in the response cache are not looked up at all and the
+        remaining get_access_key_last_used calls run from a thread pool (through the
+        rate governor like every other call). Found owners are cached for every
+        account (key ids are unique), denied lookups only for this one and failed
+        lookups not at all. Returns an OrderedDict of access key id -> AccessKeyOwner
+        in input order.
+
+        All lookups share one rate governor bucket (this account and region, iam
+        GetAccessKeyLastUsed), so uncached keys resolve at about awsratelimit per
+        second (20 by default) after a burst of awsratelimitburst (40), whatever
+        maxworkers is: 1000 new keys take close to a minute, 5000 about four.
+        """
+        owners = OrderedDict((str(key).strip(), None) for key in keys)
+        missing = []
+        for key in owners:
+            owners[key] = self._get_cached_access_key(key)
+            if owners[key] is None:
+                missing.append(key)
+
+        if missing:
+            self._add_log('Resolving {0} access key(s) ({1} cached)'.format(len(missing), len(owners) - len(missing)))
+            workers = max(1, min(int(maxworkers or DEFAULT_MAX_WORKERS), len(missing)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for key, owner in zip(missing, executor.map(self._resolve_access_key, missing)):
+                    if self.responsecache and owner.status != 'failed':
+                        account = 'global' if owner.status == 'found' else self.get_account_id()
+                        self.responsecache.set(account, 'global', 'get_access_key_last_used', {'AccessKeyId': key}, tuple(owner))
+                    owners[key] = owner
+        return owners
+
+    def _get_cached_access_key(self, key):
+        """Returns the cached AccessKeyOwner of key (found in any account or denied in this one)"""
+        if not self.responsecache:
+            return None
+        for account in ('global', self.get_account_id()):
+            found, owner = self.responsecache.get(account, 'global', 'get_access_key_last_used', {'AccessKeyId': key})
+            if found:
+                return AccessKeyOwner(*owner)._replace(cached=True)
+        return None
+
+    def _resolve_access_key(self, key):
+        """Look up the owner of a single access key. Any error other than a denied
+        lookup (including our own credentials being invalid) is a failed lookup."""
         try:
-            key_info = iam.get_access_key_last_used(AccessKeyId=key)
-            return key_info['UserName']
+            response = self.get_client('iam').get_access_key_last_used(AccessKeyId=key)
         except ClientError as e:
+            code = str(e.response.get('Error', {}).get('Code'))
+            if code in ('AccessDenied', 'NoSuchEntity'):
+                error = 'Key does not exist in target account or you are not allowed to access it'
+                return AccessKeyOwner(key, None, 'denied', None, None, None, error, False)
             self._add_log('Received error: {0}'.format(e), 'error')
-            if e.response['Error']['Code'] == 'AccessDenied':
-                return "Key does not exist in target account or you are not allowed to access it"
+            return AccessKeyOwner(key, None, 'failed', None, None, None, str(e), False)
+        except Exception as e:
+            # ie. DeadlineExceeded or EndpointConnectionError, only fail this key
+            self._add_log('Unable to resolve access key {0}: {1}'.format(key, e), 'error')
+            return AccessKeyOwner(key, None, 'failed', None, None, None, str(e), False)
+        lastused = response.get('AccessKeyLastUsed', {})
+        lastuseddate = lastused.get('LastUsedDate')
+        return AccessKeyOwner(
+            key,
+            response.get('UserName'),
+            'found',
+            calendar.timegm(lastuseddate.utctimetuple()) if lastuseddate else None,
+            lastused.get('ServiceName'),
+            lastused.get('Region'),
+            None,
+            False)
 
 
 class mycompanyAWS(AWSAPI):
@@ -321,37 +2636,22 @@ class mycompanyAWS(AWSAPI):
         # pass through all args to the base class init
         super(mycompanyAWS, self).__init__(*args, **kwargs)
 
-    def cloudera_cdh_gateway_ips(self, namefilter='*'):
-        # Note: this only returns the first interface result of the first
-        #  instance found with the filter!
-        gwfilter = [{'Name': 'tag:Cloudera-Director-Template-Name',
-                     'Values': ['gateways']}]
-
-        reservations = self.aws_instances(namefilter=namefilter, otherfilters=gwfilter)
-        results = []
-
-        for reservation in reservations:
-            for instance in reservation['Instances']:
-                for interface in instance['NetworkInterfaces']:
-                    results.append(interface['PrivateIpAddress'])
-
-        return results
-
-    def cloudera_emr_gateway_ips(self, namefilter='*'):
-        # Note: this only returns the first interface result of the first
-        #  instance found with the filter!
-        gwfilter = [{'Name': 'tag:aws:elasticmapreduce:instance-group-role',
-                     'Values': ['MASTER']}]
-
-        instances = self.aws_instances(namefilter=namefilter, otherfilters=gwfilter)
-        results = []
+    def cloudera_cdh_gateway_ips(self, namefilter='*', maxage=None):
+        """Returns the private ips of the cdh gateway instances whose name starts with namefilter"""
+        return get_instance_ips(self.aws_instances_by_role('cdh', 'gateways', namefilter, maxage))
 
-        # for reservation in reservations:
-        for instance in instances:
-            for interface in instance['NetworkInterfaces']:
-                results.append(interface['PrivateIpAddress'])
+    def cloudera_emr_gateway_ips(self, namefilter='*', maxage=None):
+        """Returns the private ips of the emr master instances whose name starts with namefilter"""
+        return get_instance_ips(self.aws_instances_by_role('emr', 'MASTER', namefilter, maxage))
 
-        return results
+    def cluster_gateway_ips(self, clusters, kind='cdh', maxage=None):
+        """
+        Returns an OrderedDict of cluster (name prefix) -> gateway private ips for
+        many cdh or emr clusters at once, all answered from one instance index.
+        """
+        role = 'gateways' if kind == 'cdh' else 'MASTER'
+        index = self.get_instance_index(maxage, named=True)
+        return OrderedDict((cluster, get_instance_ips(index.by_role(kind, role, cluster))) for cluster in clusters)
 
     def get_emr_response_filename(self,
                                   cluster,
@@ -398,43 +2698,90 @@ class mycompanyAWS(AWSAPI):
             bucketrootfolder,
             cluster)
 
-    def get_emr_response_content(self, bucket, cluster, bucketrootfolder='path'):
+    def get_emr_response_content(self, bucket, cluster, bucketrootfolder='path', cached=True):
         filename = self.get_emr_response_filename(cluster, bucketrootfolder)
-        s3 = self.session.client('s3')
-        self._add_log('downloading data: bucket - {0} ; file - {1}'.format(bucket, filename))
-        data = s3.get_object(Bucket=bucket, Key=filename)
-        return data
+        return self._get_response_content(bucket, filename, cached)
 
-    def get_cdh_response_content(self, bucket, cluster, bucketrootfolder='path'):
+    def get_cdh_response_content(self, bucket, cluster, bucketrootfolder='path', cached=True):
         filename = self.get_cdh_response_filename(cluster, bucketrootfolder)
-        s3 = self.session.client('s3')
+        return self._get_response_content(bucket, filename, cached)
+
+    def _get_response_content(self, bucket, filename, cached=True):
+        """
+        Returns a get_object style response for a cluster response file. Cached
+        files come from the s3 object cache (see prefetch_cluster_responses). A
+        file known to be missing raises a NoSuchKey ClientError without asking
+        s3 again.
+        """
         self._add_log('downloading data: bucket - {0} ; file - {1}'.format(bucket, filename))
+        if cached:
+            result = self.get_s3_object_cached(bucket, filename)
+            if result['body'] is not None:
+                return {
+                    'Body': StreamingBody(io.BytesIO(result['body']), len(result['body'])),
+                    'ContentLength': len(result['body']),
+                    'ETag': '"{0}"'.format(result['etag'])
+                }
+            if result['status'] == 'missing':
+                raise ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.', 'Key': filename}},
+                    'GetObject')
+        # Uncached (or failed, so the caller gets the actual error)
+        s3 = self.get_client('s3')
         data = s3.get_object(Bucket=bucket, Key=filename)
         return data
 
+    def prefetch_cluster_responses(self, bucket, clusters, bucketrootfolder='path', maxworkers=DEFAULT_MAX_WORKERS):
+        """
+        Fetch the emr (emr-response.json) and cdh (response.yml) response files of
+        many clusters at once into the s3 object cache. Later get_emr_response_content
+        and get_cdh_response_content calls are served from the cache.
+
+        clusters is a list of cluster names (both files are fetched) or a dictionary
+        of cluster -> kinds ('emr' and/or 'cdh') to fetch. Returns a dictionary of
+        cluster -> {kind: result} (see get_s3_object_cached).
+        """
+        if not isinstance(clusters, dict):
+            clusters = dict((cluster, ('emr', 'cdh')) for cluster in clusters)
+        filenames = {'emr': self.get_emr_response_filename, 'cdh': self.get_cdh_response_filename}
+        owners = []
+        objects = []
+        for cluster in sorted(cluster for cluster in clusters if cluster):
+            for kind in ('emr', 'cdh'):
+                if kind in clusters[cluster]:
+                    owners.append((cluster, kind))
+                    objects.append((bucket, filenames[kind](cluster, bucketrootfolder)))
+        self._add_log('Prefetching {0} response file(s) for {1} cluster(s)'.format(
+            len(objects), len(set(cluster for cluster, _ in owners))))
+        results = self.prefetch_s3_objects(objects, maxworkers=maxworkers)
+        responses = {}
+        for (cluster, kind), result in zip(owners, results):
+            responses.setdefault(cluster, {})[kind] = result
+        return responses
+
     def download_emr_response_file(self, bucket, bucketrootfolder, cluster, destpath):
         filename = self.get_emr_response_filename(cluster, bucketrootfolder)
-        self.download_s3_file(bucket, filename, destpath)
+        return self.download_s3_file(bucket, filename, destpath)
 
-    def download_emr_fabfile(self, bucket, bucketrootfolder, destpath, fabfile='fabfile.py', skipchecks=False):
+    def download_emr_fabfile(self, bucket, bucketrootfolder, destpath, fabfile='fabfile.py', skipchecks=False, cacheprefix=None):
+        """Download an emr fabfile from S3, skipped if the local copy is current (unless skipchecks)"""
         fabfilename = self.get_emr_fabfile_name(
             bucketrootfolder=bucketrootfolder,
             fabfilename=fabfile)
-        if not skipchecks:
-            if self.s3_file_exists(bucket, fabfilename):
-                return self.download_s3_file(bucket, fabfilename, destpath)
-        else:
-            return self.download_s3_file(bucket, fabfilename, destpath)
+        return self._download_emr_file(bucket, fabfilename, destpath, skipchecks, cacheprefix)
 
-    def download_emr_defaultparamfile(self, bucket, bucketrootfolder, destpath, paramfile='defaultparams.yml', skipchecks=False):
-        """Download an emr default parameter file from S3"""
+    def download_emr_defaultparamfile(self, bucket, bucketrootfolder, destpath, paramfile='defaultparams.yml', skipchecks=False, cacheprefix=None):
+        """Download an emr default parameter file from S3, skipped if the local copy is current (unless skipchecks)"""
         paramfilename = "{0}/{1}".format(bucketrootfolder, paramfile)
+        return self._download_emr_file(bucket, paramfilename, destpath, skipchecks, cacheprefix)
 
-        if not skipchecks:
-            if self.s3_file_exists(bucket, paramfilename):
-                return self.download_s3_file(bucket, paramfilename, destpath)
-        else:
-            return self.download_s3_file(bucket, paramfilename, destpath)
+    def _download_emr_file(self, bucket, key, destpath, skipchecks=False, cacheprefix=None):
+        """Download one emr helper file through download_s3_files, returns True if the local file is current"""
+        result = self.download_s3_files(
+            [(bucket, key, destpath)],
+            skipexisting=not skipchecks,
+            cacheprefix=cacheprefix)[0]
+        return result['status'] in ('downloaded', 'skipped')
 
     def random_generator(self, size=6, chars=None):
         if not chars:
@@ -443,6 +2790,11 @@ class mycompanyAWS(AWSAPI):
         return ''.join(random.choice(chars) for x in range(size))
 
     def get_cluster_uniqueid(self, clusterbase='', maxlen=28, maxretry=10, waittime=10):
+        """
+        Returns a random unique id (suffix) for a new cluster name under clusterbase
+        that no existing instance name starts with. Existing names are looked up
+        once, candidates are checked locally. waittime is no longer used.
+        """
         if len(clusterbase) >= maxlen:
             raise Exception('Cluster base name length ({0}) is already equal or greater than the maximum length defined ({1})'.format(len(clusterbase), maxlen))
         if not clusterbase:
@@ -456,18 +2808,23 @@ class mycompanyAWS(AWSAPI):
         if uniqueidlen <= 0:
             raise Exception('Unique ID is not able to be generated as all characters have already been used up in the base cluster name (plus an additional hyphen divider)')
 
+        # Fetch every Name under the cluster base once, a candidate is taken if
+        # any of them starts with the resulting cluster name
+        prefixlen = len(clusterbase) + 1 + uniqueidlen
+        self._add_log('Looking up existing instance names under {0}-'.format(clusterbase))
+        takenprefixes = set(
+            name[:prefixlen] for _, name in self.iter_instance_names('{0}-'.format(clusterbase))
+            if len(name) >= prefixlen)
+
         retries = 0
         while retries < maxretry:
             retries = retries + 1
             self._add_log('Unique ID generation attempt {0} of {1}'.format(retries, maxretry))
             uniqueid = self.random_generator(size=uniqueidlen)
             clustername = '{0}-{1}'.format(clusterbase, uniqueid)
-            self._add_log('Generated unique ID of {0}. Looking for any other instances that may already be using it.'.format(uniqueid))
-            existingcount = self.aws_node_count(clustername)
-            if existingcount == 0:
+            if clustername not in takenprefixes:
                 return uniqueid
-            self._add_log('Found {0} aws instances with the uniqueid of {1}, waiting for {2} seconds then trying again'.format(existingcount, clustername, waittime))
-            time.sleep(waittime)
+            self._add_log('Found existing aws instances with the uniqueid of {0}, trying again'.format(clustername))
 
 
 if __name__ == "__main__":
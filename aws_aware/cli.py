@@ -17,7 +17,8 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'], max_content_width=12
 @click.group(context_settings=CONTEXT_SETTINGS, invoke_without_command=True)
 @click.version_option()
 @click.option('-configfile', '--configfile', help='Load a custom configuration file')
-def main(cmd=None, configfile=None):
+@click.option('-nocache', '--no-cache', 'nocache', is_flag=True, default=False, help='Send every AWS call to AWS instead of the response cache (for debugging).')
+def main(cmd=None, configfile=None, nocache=False):
     """
     Console script for aws-aware.
     """
@@ -32,6 +33,9 @@ def main(cmd=None, configfile=None):
             OUTPUT.error('Unable to load configuration file - {0}'.format(configfile))
             sys.exit(1)
 
+    if nocache:
+        CFG.values['awscache'] = False
+
     try:
         ctx = click.get_current_context()
         if cmd:
@@ -13,6 +13,7 @@ from aws_aware.monitorclass import MonitorTasks
 # @click.option('-appname', '--appname', help='Application Name')
 @click.option('-monitorconfig', '--monitorconfig', default=CFG.values.get('monitoringconfig'), help='Path to YAML monitor definition file.')
 @click.option('-skipprobe', '--skipprobe', is_flag=True, default=False, help='Skips reaching out to AWS to probe for data and uses existing cached data instead.')
+@click.option('-incremental', '--incremental', is_flag=True, default=False, help='Only fetch changes since the last saved snapshot (full poll on the configured full sync interval).')
 @click.option('-includeundefined', '--includeundefined', is_flag=True, default=False, help='Instances not in your monitor set are are included and evaluated as zero threshold alerts')
 @click.option('-sendwarnings', '--sendwarnings', is_flag=True, default=False, help='Send notices if the warning threshold has been reached.')
 @click.option('-sendalerts', '--sendalerts', is_flag=True, default=False, help='Send notices if the alert threshold has been reached.')
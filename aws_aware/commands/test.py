@@ -57,19 +57,23 @@ def aws():
     except Exception as awsawareexception:
         raise awsawareexception
 
-@test.command('awsdownload', help='Test AWS ability to download specific file')
-@click.option('-sourcefile', '--sourcefile', help='File name to download from an s3 path (defined in the test arguments as -s3path')
-@click.option('-destpath', '--destpath', help='Destination path/file to save download as.')
-def awsdownload(sourcefile, destpath=None):
+@test.command('awsdownload', help='Test AWS ability to download specific files')
+@click.option('-sourcefile', '--sourcefile', multiple=True, help='File name to download from an s3 path (defined in the test arguments as -s3path). Can be passed several times.')
+@click.option('-destpath', '--destpath', help='Destination path/file to save download as (a folder when several source files are passed).')
+@click.option('-force', '--force', is_flag=True, default=False, help='Download even if the local file is already current.')
+def awsdownload(sourcefile, destpath=None, force=False):
     """
-    Test aws ability to download a specific file
+    Test aws ability to download specific files
     """
     OUTPUT.info('TEST: Validating aws file download ability')
     if destpath is None:
-        destpath = os.path.join(os.path.abspath(os.path.curdir), sourcefile)
-        OUTPUT.info('Using current directory and source file name as destination file path: {0}'.format(destpath))
+        destfolder = os.path.abspath(os.path.curdir)
+        OUTPUT.info('Using current directory and source file names as destination file paths: {0}'.format(destfolder))
+        destpaths = [os.path.join(destfolder, filename) for filename in sourcefile]
+    elif len(sourcefile) > 1:
+        destpaths = [os.path.join(os.path.abspath(destpath), filename) for filename in sourcefile]
     else:
-        destpath = os.path.abspath(destpath)
+        destpaths = [os.path.abspath(destpath)]
 
     try:
         monitortask = MonitorTasks(runargs=TESTARGS)
@@ -79,15 +83,20 @@ def awsdownload(sourcefile, destpath=None):
     except Exception as awsawareexception:
         raise awsawareexception
 
-    s3fullfilepath = '{0}/{1}'.format(TESTARGS['s3path'], sourcefile)
-    OUTPUT.info('Attempting to download file - {0}'.format(s3fullfilepath))
-    s3url = urlparse(s3fullfilepath)
-    downloaded = monitortask.aws.download_s3_file(
-        bucket=s3url.netloc,
-        path=s3url.path.lstrip('/'),
-        destpath=destpath)
+    manifest = []
+    for filename, filedestpath in zip(sourcefile, destpaths):
+        s3fullfilepath = '{0}/{1}'.format(TESTARGS['s3path'], filename)
+        OUTPUT.info('Attempting to download file - {0}'.format(s3fullfilepath))
+        s3url = urlparse(s3fullfilepath)
+        manifest.append((s3url.netloc, s3url.path.lstrip('/'), filedestpath))
+    results = monitortask.aws.download_s3_files(
+        manifest,
+        maxworkers=CFG.values.get('awss3downloadworkers'),
+        skipexisting=not force)
 
-    if downloaded:
+    for result in results:
+        OUTPUT.info('{0}: {1} ({2} bytes in {3}s)'.format(result['key'], result['status'], result['bytes'], result['seconds']))
+    if results and all(result['status'] in ('downloaded', 'skipped') for result in results):
         OUTPUT.echo('..SUCCESS!', color='green')
     else:
         OUTPUT.echo('..FAILED!', color='red')
@@ -24,3 +24,8 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+
+try:
+    string_types = basestring  # NOQA
+except NameError:  # Python 3
+    string_types = str
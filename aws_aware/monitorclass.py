@@ -3,6 +3,11 @@ Monitor base and sub-classes
 """
 from __future__ import absolute_import
 from datetime import date
+from collections import OrderedDict
+import fnmatch
+import hashlib
+import json
+import time
 import sys
 import os
 import yaml
@@ -10,15 +15,17 @@ import yaml
 # Allow for use outside of this module like a nice guy
 try:
     from aws_aware.scriptconfig import CFG, RUNARGS, MONITORARGS, SCRIPTPATH, OUTPUT
-    from aws_aware.compat import MutableMapping
-    from aws_aware.awslibrary import mycompanyAWS
+    from aws_aware.compat import MutableMapping, string_types
+    from aws_aware.awslibrary import mycompanyAWS, TagProjection, BRIEF_ATTRIBUTES, CLUSTER_ROLE_TAGS, aws_instances_brief_all, aws_instances_changes_all, aws_auto_scaling_map_all, aws_instance_health_all, prewarm_service_models, set_deadline, CREDENTIAL_CACHE, S3_OBJECT_CACHE, RATE_GOVERNOR, CALL_STATS
+    from aws_aware.awscache import RESPONSE_CACHE, MemoryCache, DiskCache
     from aws_aware.slack import SlackPoster
 except:
     from outputclass import Output as outstream
     OUTPUT = outstream()
     from scriptconfig import CFG, RUNARGS, MONITORARGS, SCRIPTPATH
-    from compat import MutableMapping
-    from awslibrary import mycompanyAWS
+    from compat import MutableMapping, string_types
+    from awslibrary import mycompanyAWS, TagProjection, BRIEF_ATTRIBUTES, CLUSTER_ROLE_TAGS, aws_instances_brief_all, aws_instances_changes_all, aws_auto_scaling_map_all, aws_instance_health_all, prewarm_service_models, set_deadline, CREDENTIAL_CACHE, S3_OBJECT_CACHE, RATE_GOVERNOR, CALL_STATS
+    from awscache import RESPONSE_CACHE, MemoryCache, DiskCache
     from slack import SlackPoster
 
 # Allowed to be exported
@@ -31,8 +38,43 @@ MONITOR_ATTRIBUTES = {
     'alertthreshold': 0,
     'enabled': False,
     'count': 0,
+    # 'org' evaluates thresholds against the total count, 'account' against each account
+    'scope': 'org',
+    'accountcounts': {},
+    # thresholdtype subnet: subnet ids/CIDR blocks and/or a vpc to check available ip addresses of
+    'subnets': [],
+    'vpc': None,
+    'subnetcounts': {},
+    # thresholdtype health: which checks make an instance unhealthy (see HEALTH_CHECKS)
+    'checks': [],
 }
 
+# Health monitor checks: an impaired system or instance status check, or a scheduled event
+HEALTH_CHECKS = ('system', 'instance', 'events')
+
+# Record columns the cluster role tags (see CLUSTER_ROLE_TAGS) are collected under
+# when cluster response files are prefetched, by cluster kind
+CLUSTER_ROLE_COLUMNS = {'cdh': 'cdh_template', 'emr': 'emr_role'}
+
+
+def split_config_list(values):
+    """Returns a list setting given as a list or comma separated string (ie. monitor subnets or checks) as a list"""
+    if not values:
+        return []
+    if isinstance(values, string_types):
+        values = values.split(',')
+    return [str(value).strip() for value in values if str(value).strip()]
+
+
+def get_health_checks(checks):
+    """Returns a health monitor checks setting (a list or comma separated string) as a list, all checks by default"""
+    checks = [check.lower() for check in split_config_list(checks)]
+    unknown = [check for check in checks if check not in HEALTH_CHECKS]
+    if unknown:
+        raise ValueError('Unknown health checks: {0} (use {1})'.format(', '.join(unknown), ', '.join(HEALTH_CHECKS)))
+    return checks or list(HEALTH_CHECKS)
+
+
 class Monitor(MutableMapping):
     """
     Monitor object that consists of data representing various AWS monitoring thresholds.
@@ -45,6 +87,10 @@ class Monitor(MutableMapping):
         All Monitor specific attributes.
         """
         self.monitor_attributes = MONITOR_ATTRIBUTES.copy()
+        self.monitor_attributes['accountcounts'] = {}
+        self.monitor_attributes['subnets'] = []
+        self.monitor_attributes['subnetcounts'] = {}
+        self.monitor_attributes['checks'] = []
 
         # Initialize the data dictionary for the default settings
         allowedattribs = {}
@@ -126,7 +172,11 @@ class Monitor(MutableMapping):
                         thresholdtype=monitor['thresholdtype'],
                         warningthreshold=monitor['warningthreshold'],
                         alertthreshold=monitor['alertthreshold'],
-                        enabled=monitor['enabled']
+                        enabled=monitor['enabled'],
+                        scope=monitor.get('scope', 'org'),
+                        subnets=split_config_list(monitor.get('subnets')),
+                        vpc=monitor.get('vpc'),
+                        checks=get_health_checks(monitor.get('checks'))
                     )
                 )
 
@@ -161,7 +211,7 @@ class MonitorTasks(object):
         self.monitorconfig = kwargs.pop('monitorconfig', os.path.join(SCRIPTPATH, ('config' + os.sep + 'default-monitor.yml')))
         self.monargs = kwargs.pop('monargs', MONITORARGS)
         self.runargs = kwargs.pop('runargs', RUNARGS)
-        self.includeundefined = kwargs.pop('includeundefined', False)
+        self.includeundefined = kwargs.pop('includeundefined', self.monargs.get('includeundefined', False))
         self.aws = None
         self.monitorjobs = []
         self.warningthresholdreached = False
@@ -174,6 +224,17 @@ class MonitorTasks(object):
         self.datapath = None
         self.view = None
         self.filters = None
+        self.accounts = []
+        # Instance record keys already enforced by server side (ec2) filters
+        self.serverfilters = set()
+        # (typecounts, accountcounts) kept up to date by the last poll
+        self.instancecounts = None
+        # Snapshot metadata (sync times, counts) written next to the instance data
+        self.metadata = {}
+        # Account/regions that failed or missed the poll deadline (last snapshot data used)
+        self.stalescopes = []
+        # describe_subnets results for subnet monitors (None until polled)
+        self.subnets = None
 
         # Load monitor definitions
         try:
@@ -207,6 +268,92 @@ class MonitorTasks(object):
                 result = str(self.filters[argname])
         return result
 
+    def get_filter_names(self):
+        """Returns the names of all defined filters"""
+        if isinstance(self.filters, dict):
+            return list(self.filters.keys())
+        return []
+
+    def get_filter_values(self, filtername):
+        """
+        Returns a list of values (wildcards allowed) for a filter or None
+        if the filter does not restrict anything.
+        """
+        value = self.filters.get(filtername) if isinstance(self.filters, dict) else None
+        if isinstance(value, (list, tuple)):
+            values = [str(val) for val in value if val is not None and str(val) != '']
+        else:
+            values = [self.eval_filter(filtername)]
+        values = [val for val in values if val not in ('', 'None')]
+        if not values or '*' in values:
+            return None
+        return values
+
+    def match_filter(self, value, patterns):
+        """True if value matches any of the (wildcard) filter patterns"""
+        if value is None:
+            return False
+        return any(fnmatch.fnmatchcase(str(value), pattern) for pattern in patterns)
+
+    def get_monitored_instancetypes(self):
+        """Returns instance types of all enabled instance monitors"""
+        types = set()
+        for monitor in self.monitorjobs:
+            if monitor['enabled'] and monitor['name'] != 'Other':
+                if str(monitor['thresholdtype']).lower() == 'instance':
+                    types.add(str(monitor['name']))
+        return sorted(types)
+
+    def compile_instance_filters(self):
+        """
+        Compile the monitor configuration into ec2 describe_instances filters.
+        Returns the filters plus the set of instance record keys they enforce
+        so client side filtering can skip those checks.
+
+        Unless undefined instances are included the instance type filter keeps
+        unmonitored types out of the saved snapshot too, so reports and exports
+        only ever see monitored instance types.
+        """
+        ec2filters = []
+        enforced = set()
+
+        # Running instances (or whatever states the view asks for)
+        if self.view.get('instance_state'):
+            ec2filters.append({'Name': 'instance-state-name', 'Values': list(self.view['instance_state'])})
+            enforced.add('state')
+
+        # Tag filters, multiple values and wildcards are supported by ec2 as is
+        for filtername in self.get_filter_names():
+            values = self.get_filter_values(filtername)
+            if values:
+                self._add_log('Other Filter Added - {0}: {1}'.format(filtername, ', '.join(values)))
+                ec2filters.append({'Name': 'tag:{0}'.format(filtername), 'Values': values})
+                enforced.add(filtername)
+
+        # Only pull monitored instance types unless we also report on undefined ones
+        if not (self.includeundefined or self.view.get('include_undefined')):
+            instancetypes = self.get_monitored_instancetypes()
+            if instancetypes:
+                self._add_log('Instance type filter added: {0}'.format(', '.join(instancetypes)))
+                ec2filters.append({'Name': 'instance-type', 'Values': instancetypes})
+                enforced.add('instance_type')
+
+        return ec2filters, enforced
+
+    def filter_instances(self, instances):
+        """Apply any filters not already enforced by ec2 to a list of instances"""
+        results = instances
+        # Filters name tag keys, records hold [key, alias] tags under their alias
+        aliases = TagProjection((self.view or {}).get('instance_tags')).aliases
+        for filtername in self.get_filter_names():
+            if filtername in self.serverfilters:
+                continue
+            values = self.get_filter_values(filtername)
+            if values:
+                column = aliases.get(filtername, filtername)
+                results = [i for i in results if self.match_filter(i.get(column), values)]
+        return results
+
     # def costcenter(self):
     #     """Returns evaluated cost center"""
     #     return self.eval_filter('costcenter')
@@ -250,12 +397,17 @@ class MonitorTasks(object):
                     thresholdtype=monitor['thresholdtype'],
                     warningthreshold=monitor['warningthreshold'],
                     alertthreshold=monitor['alertthreshold'],
-                    enabled=monitor['enabled']
+                    enabled=monitor['enabled'],
+                    scope=monitor.get('scope', 'org'),
+                    subnets=split_config_list(monitor.get('subnets')),
+                    vpc=monitor.get('vpc'),
+                    checks=get_health_checks(monitor.get('checks'))
                 )
             )
 
         self.view = monitorconfig['view']
         self.filters = monitorconfig['filters']
+        self.accounts = monitorconfig.get('accounts') or []
 
         if not self.view['column_lookup']:
             self.view['column_lookup'] = {
@@ -269,6 +421,12 @@ class MonitorTasks(object):
                 'public_ip_address': 'Public IP',
                 'private_ip_address': 'Private IP',
                 'cluster': 'Cluster',
+                'asg': 'Auto Scaling Group',
+                'system_status': 'System Status',
+                'instance_status': 'Instance Status',
+                'scheduled_events': 'Scheduled Events',
+                'region': 'Region',
+                'account_id': 'Account',
                 'instance_type': 'Instance Type',
                 'name': 'Name',
             }
@@ -329,6 +487,7 @@ class MonitorTasks(object):
                     "emailtitle": "AWS Aware Status: {0}".format(status),
                     "date": date.today().strftime('%m/%d/%Y'),
                     "monitors": self.monitorjobs,
+                    "stalescopes": self.stalescopes,
                     "costcenter": self.eval_filter('costcenter'),
                     "environment": self.eval_filter('environment'),
                     "appname": self.eval_filter('appname'),
@@ -369,6 +528,7 @@ class MonitorTasks(object):
                     "title": 'All Instances',
                     "date": date.today().strftime('%m/%d/%Y'),
                     "monitors": self.monitorjobs,
+                    "stalescopes": self.stalescopes,
                     "costcenter": '*',
                     "environment": '*',
                     "appname": '*',
@@ -385,6 +545,7 @@ class MonitorTasks(object):
                     "emailtitle": "AWS Aware Status: {0}".format(status),
                     "date": date.today().strftime('%m/%d/%Y'),
                     "monitors": self.monitorjobs,
+                    "stalescopes": self.stalescopes,
                     "costcenter": self.eval_filter('costcenter'),
                     "environment": self.eval_filter('environment'),
                     "appname": self.eval_filter('appname'),
@@ -426,6 +587,7 @@ class MonitorTasks(object):
                 "date": date.today().strftime('%m/%d/%Y'),
                 "view": self.view,
                 "monitors": self.monitorjobs,
+                "stalescopes": self.stalescopes,
                 "costcenter": self.eval_filter('costcenter'),
                 "environment": self.eval_filter('environment'),
                 "appname": self.eval_filter('appname'),
@@ -444,6 +606,7 @@ class MonitorTasks(object):
                 "date": date.today().strftime('%m/%d/%Y'),
                 "view": self.view,
                 "monitors": self.monitorjobs,
+                "stalescopes": self.stalescopes,
                 "costcenter": self.eval_filter('costcenter'),
                 "environment": self.eval_filter('environment'),
                 "appname": self.eval_filter('appname'),
@@ -501,6 +664,12 @@ class MonitorTasks(object):
                 "short": True
             }
         ]
+        if self.stalescopes:
+            monitorinfo.append({
+                "title": "Stale Data (last snapshot used)",
+                "value": ', '.join(self.get_scope_name(scope) for scope in self.stalescopes),
+                "short": False
+            })
 
         slacknotice = {
             "attachments": [
@@ -529,10 +698,61 @@ class MonitorTasks(object):
     def instantiate_aws(self):
         """Connect to AWS"""
         # create a new connection with AWS
+        CREDENTIAL_CACHE.set_cachepath(CFG.values.get('awscredentialcache') or None)
+        S3_OBJECT_CACHE.set_cachepath(CFG.values.get('awss3cachepath') or None)
+        S3_OBJECT_CACHE.maxentries = int(CFG.values.get('awss3cachemaxentries') or 1000)
+        self.configure_response_cache()
+        sharedloader = str(CFG.values.get('awssharedmodelcache')).lower() != 'false'
+        if sharedloader and str(CFG.values.get('awsprewarmmodels')).lower() == 'true':
+            prewarm_service_models()
+        ratelimit = CFG.values.get('awsratelimit')
+        # A rate of 0 disables the governor as well
+        RATE_GOVERNOR.configure(
+            rate=ratelimit if str(ratelimit).lower() != 'false' else None,
+            burst=CFG.values.get('awsratelimitburst'),
+            maxrate=CFG.values.get('awsratelimitmax'),
+            enabled=str(ratelimit).lower() != 'false')
         try:
-            self.aws = mycompanyAWS(awsid=self.runargs['awsid'], awssecret=self.runargs['awssecret'], profileid=self.runargs['awsprofile'], region=self.runargs['awsregion'])
+            self.aws = mycompanyAWS(awsid=self.runargs['awsid'], awssecret=self.runargs['awssecret'], profileid=self.runargs['awsprofile'], region=self.runargs['awsregion'], clientconfig=self.get_aws_clientconfig(), transferconfig=self.get_aws_transferconfig(), sharedloader=sharedloader)
         except:
             self.exit_with_exception('AWS Connection Failure')
+        if CFG.values.get('awsinstanceindexage') not in (None, ''):
+            self.aws.indexmaxage = float(CFG.values.get('awsinstanceindexage'))
+
+    def configure_response_cache(self):
+        """Set up the AWS response cache backend, ttls and on/off switch from the global configuration"""
+        maxentries = int(CFG.values.get('awscachemaxentries') or 10000)
+        cachepath = CFG.values.get('awscachepath')
+        if str(CFG.values.get('awscachebackend')).lower() == 'disk' and cachepath:
+            if not (isinstance(RESPONSE_CACHE.backend, DiskCache) and RESPONSE_CACHE.backend.cachepath == cachepath):
+                RESPONSE_CACHE.configure(backend=DiskCache(cachepath, maxentries))
+        elif not isinstance(RESPONSE_CACHE.backend, MemoryCache):
+            RESPONSE_CACHE.configure(backend=MemoryCache(maxentries))
+        RESPONSE_CACHE.backend.maxentries = maxentries
+        RESPONSE_CACHE.configure(
+            ttls=CFG.values.get('awscachettls') or {},
+            enabled=str(CFG.values.get('awscache')).lower() != 'false')
+
+    def get_aws_clientconfig(self):
+        """Returns botocore client settings from the global configuration"""
+        return {
+            'max_pool_connections': CFG.values.get('awsmaxpoolconnections'),
+            'retry_mode': CFG.values.get('awsretrymode'),
+            'max_attempts': CFG.values.get('awsmaxattempts'),
+            'connect_timeout': CFG.values.get('awsconnecttimeout'),
+            'read_timeout': CFG.values.get('awsreadtimeout'),
+        }
+
+    def get_aws_transferconfig(self):
+        """Returns s3 transfer settings from the global configuration (sizes are in MB)"""
+        megabyte = 1024 * 1024
+        threshold = CFG.values.get('awss3multipartthreshold')
+        chunksize = CFG.values.get('awss3multipartchunksize')
+        return {
+            'multipart_threshold': int(float(threshold) * megabyte) if threshold not in (None, '') else None,
+            'multipart_chunksize': int(float(chunksize) * megabyte) if chunksize not in (None, '') else None,
+            'max_concurrency': CFG.values.get('awss3maxconcurrency'),
+        }
 
     def awsinstancename_to_clustername(self, awsid=''):
         """ Convert aws ids into cluster names 
@@ -556,16 +776,9 @@ class MonitorTasks(object):
             except Exception as monitorclassexception:
                 raise monitorclassexception
             
-            self.instances = self.allinstances
-            for filtername in self.filters.keys():
-                if self.eval_filter(filtername) != '*':
-                    results = [i for i in results if i[filtername] == self.eval_filter(filtername)]
-            # if self.eval_filter('environment') != '*':
-            #     self.instances = [i for i in self.instances if i['Environment'] == self.eval_filter('environment')]
-            # if self.eval_filter('appname') != '*':
-            #     self.instances = [i for i in self.instances if i['ApplicationName'] == self.eval_filter('appname')]
-            # if self.eval_filter('costcenter') != '*':
-            #     self.instances = [i for i in self.instances if i['CostCenter'] == self.eval_filter('costcenter')]
+            # Nothing was enforced server side for previously saved data
+            self.serverfilters = set()
+            self.instances = self.get_instances(filtered=True)
         else:
             self._add_log('Polling AWS for instance data')
             # Get aws going
@@ -575,49 +788,537 @@ class MonitorTasks(object):
             except Exception as monitorclassexception:
                 raise monitorclassexception
 
-            otherfilters = []
+            # Push as much of the monitor configuration down to ec2 as we can
+            otherfilters, serverfilters = self.compile_instance_filters()
+            self.serverfilters = serverfilters
+            self._add_log('Instance filters applied: {0}'.format(len(otherfilters)))
 
-            # Other filter definitions
-            # Running instances
-            otherfilters.append({'Name': 'instance-state-name', 'Values': self.view['instance_state']})
-            if len(self.filters) > 0:
-                for filtername in self.filters.keys():
-                    if self.eval_filter(filtername) != '*':
-                        self._add_log('Other Filter Added - {0}'.format(filtername))
-                        otherfilters.append({'Name': 'tag:{0}'.format(filtername), 'Values': [self.eval_filter(filtername)]})
+            syncstart = time.time()
+            deadline = syncstart + float(self.view['poll_deadline']) if self.view.get('poll_deadline') else None
+            failures = []
 
-            # # Particular cost center
-            # tag_cc = str(self.eval_filter('costcenter'))
-            # self._add_log('Other Filter - CostCenter: {0}'.format(tag_cc))
-            # otherfilters.append({'Name': 'tag:CostCenter', 'Values': [tag_cc]})
+            # Poll all requested accounts and regions at once and merge the results
+            if self.accounts:
+                self._add_log('Assuming roles for {0} account(s)'.format(len(self.accounts)))
+                apis = self.aws.assume_roles(self.accounts, maxworkers=self.view.get('region_workers'), failures=failures)
+            else:
+                apis = [self.aws]
+
+            filterhash = self.get_filter_hash(otherfilters)
+            baseline = self.get_sync_baseline(filterhash) if self.is_incremental() else None
+            # Filled by incremental syncs, which scan every instance status anyway
+            healthmap = None
+            if baseline:
+                healthmap = {} if self.get_health_monitors() else None
+                self.sync_instances(apis, otherfilters, *baseline, deadline=deadline, failures=failures, healthmap=healthmap)
+                lastfullsync = baseline[1]['lastfullsync']
+                # Re-read the window of any stale scope next time
+                lastsync = baseline[1]['lastsync'] if failures else syncstart
+            else:
+                self.poll_all_instances(apis, otherfilters, deadline=deadline, failures=failures)
+                # An incomplete full poll is repeated next time
+                lastfullsync = 0 if failures else syncstart
+                lastsync = syncstart
 
-            # # ApplicationName
-            # tag_app = str(self.eval_filter('appname'))
-            # self._add_log('Other Filter - ApplicationName: {0}'.format(tag_app))
-            # otherfilters.append({'Name': 'tag:ApplicationName', 'Values': [tag_app]})
+            if self.view.get('asg_enrichment'):
+                self.enrich_asg_membership(apis, deadline=deadline, failures=failures)
 
-            # # Environment
-            # tag_env = str(self.eval_filter('environment'))
-            # self._add_log('Other Filter - Environment: {0}'.format(tag_env))
-            # otherfilters.append({'Name': 'tag:Environment', 'Values': [tag_env]})
+            if self.get_health_monitors():
+                self.poll_health_data(apis, deadline=deadline, healthmap=healthmap, failures=failures)
 
-            self._add_log('Instance filters applied: {0}'.format(len(otherfilters)))
-            # Basic instance dictionary list result with some additional tags.
-            self.allinstances = self.aws.aws_instances_brief(
-                otherfilters=otherfilters, 
-                tags=self.view['instance_tags'])
+            self.stalescopes = failures
+            if failures:
+                self._add_log('Stale (last snapshot) data used for: {0}'.format(
+                    ', '.join(self.get_scope_name(scope) for scope in failures)), 'warning')
 
             self._add_log('AWS instances found: {0}'.format(
                 len(self.allinstances)))
-
-            if self.allinstances:
-                self._add_log('Inferring clustername attributes...')
-                for instance in self.allinstances:
-                    instance['cluster'] = self.awsinstancename_to_clustername(instance['name'])
-            else:
+            if not self.allinstances:
                 self._add_log('Zero AWS Instances found!')
 
+            self.instances = self.get_instances(filtered=True)
+
+            self.metadata = {
+                'lastsync': lastsync,
+                'lastfullsync': lastfullsync,
+                'incremental': bool(baseline),
+                'filterhash': filterhash,
+                'typecounts': self.instancecounts[0],
+                'accountcounts': self.instancecounts[1],
+                'stalescopes': self.stalescopes,
+            }
+            self.poll_subnet_data(deadline=deadline)
+            self.prefetch_cluster_responses(deadline=deadline)
+            # Only now, so the subnet and prefetch calls are included
+            self.metadata.update({
+                'callstats': CALL_STATS.stats(),
+                'ratestats': RATE_GOVERNOR.stats(),
+                'cachestats': RESPONSE_CACHE.stats(),
+                'objectcachestats': S3_OBJECT_CACHE.stats(),
+            })
+
             self.save_instance_data(filepath=self.runargs['datapath'])
+            self.save_instance_metadata(filepath=self.runargs['datapath'])
+            self.log_aws_stats()
+
+    def get_health_monitors(self):
+        """Returns all enabled health monitors"""
+        return [monitor for monitor in self.monitorjobs
+                if monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'health']
+
+    def poll_health_data(self, apis, deadline=None, healthmap=None, failures=None):
+        """
+        Join the status checks and scheduled events of every instance onto the instance
+        records (system_status, instance_status and scheduled_events) from paginated
+        describe_instance_status scans, one per account/region. A healthmap already
+        collected by an incremental sync is used instead of scanning again, together
+        with the failures of that sync. Account/regions whose scan fails keep their
+        last values and are added to the failures list of the poll.
+        """
+        failures = failures if failures is not None else []
+        if healthmap is None:
+            scanfailures = []
+            healthmap = aws_instance_health_all(
+                apis,
+                regions=self.view.get('regions'),
+                maxworkers=self.view.get('region_workers'),
+                deadline=deadline,
+                timeout=self.view.get('scope_timeout'),
+                failures=scanfailures)
+            self.add_stale_scopes(failures, scanfailures)
+        unknown = {'system_status': None, 'instance_status': None, 'scheduled_events': []}
+        for instance in self.allinstances or []:
+            if any(self.in_scope(instance, scope) for scope in failures):
+                continue
+            instance.update(healthmap.get(instance['id'], unknown))
+        self._add_log('Instance statuses found: {0}'.format(len(healthmap)))
+        return healthmap
+
+    def is_unhealthy(self, instance, checks=HEALTH_CHECKS):
+        """True if an instance record fails any of the health checks"""
+        if 'system' in checks and instance.get('system_status') == 'impaired':
+            return True
+        if 'instance' in checks and instance.get('instance_status') == 'impaired':
+            return True
+        if 'events' in checks and instance.get('scheduled_events'):
+            return True
+        return False
+
+    def update_health_count(self, monitor):
+        """
+        Set a health monitor count to the number of (filtered) instances failing its
+        checks, also per account. None if instance health has not been polled.
+        """
+        instances = self.instances or []
+        if instances and not any('system_status' in instance for instance in instances):
+            self._add_log('No instance health data for health monitor: {0}'.format(monitor['name']), 'warning')
+            monitor['count'] = None
+            monitor['accountcounts'] = {}
+            return
+        accountcounts = {}
+        for instance in instances:
+            if self.is_unhealthy(instance, monitor['checks']):
+                account = str(instance.get('account_id'))
+                accountcounts[account] = accountcounts.get(account, 0) + 1
+        monitor['count'] = sum(accountcounts.values())
+        monitor['accountcounts'] = accountcounts
+
+    def get_subnet_monitors(self):
+        """Returns all enabled subnet monitors"""
+        return [monitor for monitor in self.monitorjobs
+                if monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'subnet']
+
+    def poll_subnet_data(self, deadline=None):
+        """
+        Look up the subnets of every subnet monitor with (at most) two batched
+        describe_subnets lookups. Lookups not done before the deadline (epoch
+        seconds) leave their subnets out.
+        """
+        monitors = self.get_subnet_monitors()
+        if not monitors:
+            return
+        queries = sorted(set(query for monitor in monitors for query in monitor['subnets']))
+        vpcids = sorted(set(monitor['vpc'] for monitor in monitors if monitor['vpc'] and not monitor['subnets']))
+        self._add_log('Polling {0} subnet(s) and {1} vpc(s) for available ip addresses'.format(len(queries), len(vpcids)))
+        self.subnets = []
+        previous = set_deadline(deadline)
+        try:
+            if queries:
+                self.subnets.extend(self.aws.get_subnets(queries))
+            if vpcids:
+                self.subnets.extend(self.aws.get_subnets(vpcids=vpcids))
+        finally:
+            set_deadline(previous)
+
+    def update_subnet_count(self, monitor):
+        """
+        Set a subnet monitor count to the lowest number of available ip addresses
+        of its subnets (None if they were not polled or not found).
+        """
+        matches = {}
+        for subnet in self.subnets or []:
+            if monitor['subnets'] and not (subnet['SubnetId'] in monitor['subnets'] or subnet.get('CidrBlock') in monitor['subnets']):
+                continue
+            if monitor['vpc'] and subnet.get('VpcId') != monitor['vpc']:
+                continue
+            matches[subnet['SubnetId']] = int(subnet['AvailableIpAddressCount'])
+        monitor['subnetcounts'] = matches
+        if matches:
+            monitor['count'] = min(matches.values())
+        else:
+            if self.subnets is not None:
+                self._add_log('No subnets found for subnet monitor: {0}'.format(monitor['name']), 'warning')
+            monitor['count'] = None
+
+    def get_poll_tags(self):
+        """Returns the tags to collect: the view instance_tags plus, when cluster response
+        files are prefetched, the cluster role tags (see CLUSTER_ROLE_COLUMNS)"""
+        tags = list(self.view.get('instance_tags') or [])
+        if self.view.get('response_bucket'):
+            tags.extend([CLUSTER_ROLE_TAGS[kind], column] for kind, column in sorted(CLUSTER_ROLE_COLUMNS.items()))
+        return tags
+
+    def get_response_clusters(self):
+        """
+        Returns cluster -> kinds ('emr'/'cdh') of the response files to prefetch. Only
+        clusters with instances carrying a cluster role tag or in an auto scaling
+        group are included, the name based guess alone is not enough. An auto scaling
+        group member without a role tag gets both files.
+        """
+        clusters = {}
+        for instance in self.allinstances or []:
+            cluster = instance.get('cluster')
+            if not cluster:
+                continue
+            kinds = [kind for kind, column in CLUSTER_ROLE_COLUMNS.items() if instance.get(column)]
+            if not kinds and instance.get('asg'):
+                kinds = list(CLUSTER_ROLE_COLUMNS)
+            if kinds:
+                clusters.setdefault(cluster, set()).update(kinds)
+        return clusters
+
+    def prefetch_cluster_responses(self, deadline=None):
+        """
+        Fetch the emr/cdh response files of every cluster at once (when a view
+        response_bucket is configured, see get_response_clusters). Unchanged files
+        are revalidated from the local s3 object cache instead of being downloaded
+        again and missing ones are not asked for again for a while. Files not
+        fetched before the deadline (epoch seconds) are failed results. Later
+        response file lookups are served from that cache, the results (see
+        AWSAPI.prefetch_cluster_responses) are only returned for logging.
+        """
+        bucket = self.view.get('response_bucket')
+        if not bucket:
+            return {}
+        clusters = self.get_response_clusters()
+        previous = set_deadline(deadline)
+        try:
+            clusterresponses = self.aws.prefetch_cluster_responses(
+                bucket,
+                clusters,
+                bucketrootfolder=self.view.get('response_root') or 'path',
+                maxworkers=CFG.values.get('awss3downloadworkers'))
+        finally:
+            set_deadline(previous)
+        statuses = {}
+        for responses in clusterresponses.values():
+            for result in responses.values():
+                statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        self._add_log('Cluster response files: {0}'.format(
+            ', '.join('{0} {1}'.format(count, status) for status, count in sorted(statuses.items())) or 'none'))
+        return clusterresponses
+
+    def run_instance_commands(self, commands, os='linux', states=('running',), timeout=600, filtered=True):
+        """
+        Run commands through ssm on every (filtered) instance of the loaded snapshot
+        in one of states and yield the per instance results as they come in (see
+        AWSAPI.execute_commands_batch). Instances are batched per region, only
+        instances of the connected account are included.
+        """
+        accountid = self.aws.get_account_id()
+        regions = OrderedDict()
+        for instance in self.get_instances(filtered=filtered):
+            if states and instance.get('state') not in states:
+                continue
+            if instance.get('account_id', accountid) != accountid:
+                continue
+            regions.setdefault(instance.get('region') or self.aws.region, []).append(instance['id'])
+        deadline = time.time() + timeout if timeout else None
+        for region, instanceids in regions.items():
+            remaining = max(1, deadline - time.time()) if deadline else None
+            self._add_log('Running {0} command(s) on {1} instance(s) in {2}'.format(len(commands), len(instanceids), region))
+            for result in self.aws.get_region_api(region).execute_commands_batch(commands, instanceids, os=os, timeout=remaining):
+                result['region'] = region
+                yield result
+
+    def log_aws_stats(self):
+        """Log per operation AWS call stats, response and s3 object cache counters and the api rate governor counters"""
+        stats = CALL_STATS.stats()
+        self._add_log('AWS calls: {0} in {1}s, errors: {2}, retries: {3}, throttles: {4}, response bytes: {5}'.format(
+            stats['calls'], stats['seconds'], stats['errors'], stats['retries'], stats['throttles'], stats['bytes']))
+        # Slowest operations (by total time spent) first
+        operations = sorted(stats['operations'].items(), key=lambda item: item[1]['avglatencyms'] * item[1]['calls'], reverse=True)
+        for operation, opstats in operations:
+            self._add_log('  {0}: {1} calls, avg {2}ms, p90 <={3}ms, max {4}ms, retries: {5}, throttles: {6}, bytes: {7}'.format(
+                operation, opstats['calls'], opstats['avglatencyms'], opstats['p90ms'], opstats['maxlatencyms'],
+                opstats['retries'], opstats['throttles'], opstats['bytes']))
+
+        stats = RESPONSE_CACHE.stats()
+        if stats['enabled']:
+            self._add_log('AWS response cache ({0}): {1} hits, {2} misses, {3} entries, {4} evictions'.format(
+                stats['backend'], stats['hits'], stats['misses'], stats['entries'], stats['evictions']))
+            for operation, opstats in sorted(stats['operations'].items()):
+                self._add_log('  {0}: {1} hits, {2} misses'.format(operation, opstats['hits'], opstats['misses']))
+
+        stats = S3_OBJECT_CACHE.stats()
+        if stats['hits'] or stats['revalidations'] or stats['misses']:
+            self._add_log('S3 object cache ({0}): {1} hits, {2} revalidated, {3} misses, {4} entries, {5} missing, {6} evictions'.format(
+                stats['backend'], stats['hits'], stats['revalidations'], stats['misses'], stats['entries'], stats['missing'], stats['evictions']))
+
+        stats = RATE_GOVERNOR.stats()
+        self._add_log('AWS api calls: {0} ({1}/s), throttled: {2}, rate limited waits: {3} ({4:.1f}s)'.format(
+            stats['requests'], stats['rps'], stats['throttles'], stats['waits'], stats['waitseconds']))
+        for api, apistats in sorted(stats['apis'].items()):
+            if apistats['throttles'] or apistats['waits']:
+                self._add_log('  {0}: {1} calls, throttled: {2}, waits: {3}, current rate: {4}/s'.format(
+                    api, apistats['requests'], apistats['throttles'], apistats['waits'], apistats['rate']))
+
+    def get_poll_args(self, deadline=None, failures=None):
+        """Returns the deadline and timeout arguments for account/region polling"""
+        return {
+            'deadline': deadline,
+            'timeout': self.view.get('scope_timeout'),
+            'failures': failures,
+            'hedgeafter': self.view.get('hedge_after'),
+        }
+
+    def needs_instance_attributes(self):
+        """True if any enabled monitor counts instances by type (or undefined types are reported)"""
+        if self.includeundefined or self.view.get('include_undefined'):
+            return True
+        return any(monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'instance'
+                   for monitor in self.monitorjobs)
+
+    def get_poll_engine(self):
+        """
+        Returns the instance collection engine from the view. The tags engine
+        cannot return instance types, so tags and auto are only used when no
+        monitor counts instances by type (ie. only health and subnet monitors),
+        otherwise client is used.
+        """
+        engine = str(self.view.get('engine') or 'client').lower()
+        if engine in ('tags', 'auto') and self.needs_instance_attributes():
+            self._add_log('engine: {0} cannot return the instance types monitors count, using client'.format(engine), 'warning')
+            engine = 'client'
+        elif engine not in ('client', 'resource', 'tags', 'auto'):
+            self._add_log('Unknown engine: {0}, using client'.format(engine), 'warning')
+            engine = 'client'
+        return engine
+
+    def get_poll_attributes(self):
+        """
+        Returns the instance attributes to collect. Nothing beyond the id, state
+        and tags every record has when no monitor needs more, so the tags engine
+        can serve the poll.
+        """
+        engine = str(self.view.get('engine') or 'client').lower()
+        if engine in ('tags', 'auto') and not self.needs_instance_attributes():
+            return []
+        return list(BRIEF_ATTRIBUTES)
+
+    def get_scope_name(self, scope):
+        """Returns account/region for a stale scope"""
+        return '{0}/{1}'.format(scope.get('account_id') or '*', scope.get('region') or '*')
+
+    def add_stale_scopes(self, failures, scopes):
+        """Append the failed account/region scopes that are not in the failures list yet"""
+        known = set((scope.get('account_id'), scope.get('region')) for scope in failures)
+        for scope in scopes:
+            if (scope.get('account_id'), scope.get('region')) not in known:
+                known.add((scope.get('account_id'), scope.get('region')))
+                failures.append(scope)
+
+    def in_scope(self, instance, scope):
+        """True if an instance record belongs to a (stale) account/region scope"""
+        if scope.get('region') and instance.get('region') != scope['region']:
+            return False
+        if scope.get('account_id') and str(instance.get('account_id')) != str(scope['account_id']):
+            return False
+        return True
+
+    def poll_all_instances(self, apis, otherfilters, deadline=None, failures=None):
+        """
+        Full poll of every account/region, replaces all instance data and counts.
+        Account/regions that fail or miss the deadline keep their records from
+        the previous snapshot (if there is one).
+        """
+        self._add_log('Running a full instance poll')
+        if failures is None:
+            failures = []
+        self.allinstances = aws_instances_brief_all(
+            apis,
+            regions=self.view.get('regions'),
+            maxworkers=self.view.get('region_workers'),
+            otherfilters=otherfilters,
+            attributes=self.get_poll_attributes(),
+            tags=self.get_poll_tags(),
+            engine=self.get_poll_engine(),
+            page_size=self.view.get('page_size'),
+            segmentkey=self.view.get('segment_key'),
+            segmentvalues=self.view.get('segment_values'),
+            segmentworkers=self.view.get('segment_workers'),
+            **self.get_poll_args(deadline, failures))
+
+        if failures:
+            previous = self.load_previous_snapshot()[0] or []
+            stale = [instance for instance in previous if any(self.in_scope(instance, scope) for scope in failures)]
+            self._add_log('Using {0} instance(s) from the last snapshot for failed account/regions'.format(len(stale)), 'warning')
+            self.allinstances.extend(stale)
+
+        if self.allinstances:
+            self._add_log('Inferring clustername attributes...')
+            for instance in self.allinstances:
+                instance['cluster'] = self.awsinstancename_to_clustername(instance['name'])
+
+        self.instancecounts = self.count_instances(self.get_instances(filtered=True))
+
+    def sync_instances(self, apis, otherfilters, previous, metadata, deadline=None, failures=None, healthmap=None):
+        """
+        Incremental poll. Starts from the previous snapshot and applies only
+        the changes since the last sync, counts are updated from the same delta.
+        Account/regions that fail or miss the deadline are left as they were.
+        A healthmap dictionary is filled from the same describe_instance_status
+        scans (see poll_health_data).
+        """
+        self._add_log('Running an incremental instance sync (last sync: {0})'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metadata['lastsync']))))
+        upserts, removed = aws_instances_changes_all(
+            apis,
+            previous,
+            metadata['lastsync'],
+            regions=self.view.get('regions'),
+            maxworkers=self.view.get('region_workers'),
+            otherfilters=otherfilters,
+            attributes=self.get_poll_attributes(),
+            tags=self.get_poll_tags(),
+            engine=self.get_poll_engine(),
+            page_size=self.view.get('page_size'),
+            healthmap=healthmap,
+            **self.get_poll_args(deadline, failures))
+
+        instances = OrderedDict((instance['id'], instance) for instance in previous)
+        counts = (dict(metadata['typecounts']), dict((itype, dict(accounts)) for itype, accounts in metadata['accountcounts'].items()))
+
+        for instanceid in removed:
+            instance = instances.pop(instanceid, None)
+            if instance:
+                self.apply_count_delta(counts, instance, -1)
+
+        for instance in upserts:
+            instance['cluster'] = self.awsinstancename_to_clustername(instance['name'])
+            if instance['id'] in instances:
+                self.apply_count_delta(counts, instances[instance['id']], -1)
+            instances[instance['id']] = instance
+            self.apply_count_delta(counts, instance, 1)
+
+        self._add_log('Instance changes applied: {0} new or changed, {1} removed'.format(len(upserts), len(removed)))
+        self.allinstances = list(instances.values())
+        self.instancecounts = counts
+
+    def enrich_asg_membership(self, apis, deadline=None, failures=None):
+        """
+        Attach the auto scaling group name (or None) of every instance as 'asg', from one
+        paginated describe_auto_scaling_instances scan per account/region joined by
+        instance id. With the view asg_cluster option the group name also replaces the
+        name based cluster guess. Account/regions whose scan fails keep their last values
+        and are added to the failures list of the poll (see add_stale_scopes).
+        """
+        scanfailures = []
+        asgmap = aws_auto_scaling_map_all(
+            apis,
+            regions=self.view.get('regions'),
+            maxworkers=self.view.get('region_workers'),
+            deadline=deadline,
+            timeout=self.view.get('scope_timeout'),
+            failures=scanfailures)
+        if failures is not None:
+            self.add_stale_scopes(failures, scanfailures)
+        asgcluster = self.view.get('asg_cluster')
+        for instance in self.allinstances or []:
+            if any(self.in_scope(instance, scope) for scope in scanfailures):
+                continue
+            instance['asg'] = asgmap.get(instance['id'])
+            if asgcluster and instance['asg']:
+                instance['cluster'] = instance['asg']
+        if asgcluster:
+            # Clusters can be filtered on, recount with the new values
+            self.instancecounts = self.count_instances(self.get_instances(filtered=True))
+        self._add_log('Auto scaling group members: {0} of {1} instance(s)'.format(
+            sum(1 for instance in self.allinstances or [] if instance.get('asg')), len(self.allinstances or [])))
+        return asgmap
+
+    def is_incremental(self):
+        """True if incremental syncs are enabled on the command line or in the view"""
+        return bool(self.monargs.get('incremental') or self.view.get('incremental'))
+
+    def get_filter_hash(self, otherfilters):
+        """
+        Returns a hash of everything that decides which instances end up in the
+        snapshot (and its counts). A changed hash forces a full poll.
+        """
+        definition = [
+            otherfilters,
+            self.filters,
+            self.get_poll_tags(),
+            self.get_poll_attributes(),
+            self.view.get('regions'),
+            [account.get('role_arn') for account in self.accounts],
+            self.includeundefined,
+        ]
+        return hashlib.sha1(json.dumps(definition, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get_sync_baseline(self, filterhash):
+        """
+        Returns the previous (instances, metadata) to sync from or None when a
+        full poll is required: no usable snapshot, a changed monitor
+        configuration or the full sync interval has passed.
+        """
+        previous, metadata = self.load_previous_snapshot()
+        if previous is None:
+            self._add_log('No usable previous snapshot found, a full poll is required')
+            return None
+
+        if not all(key in metadata for key in ('lastsync', 'lastfullsync', 'filterhash', 'typecounts', 'accountcounts')):
+            self._add_log('Snapshot metadata incomplete, a full poll is required')
+            return None
+        if metadata['filterhash'] != filterhash:
+            self._add_log('Monitor configuration changed, a full poll is required')
+            return None
+
+        fullsyncinterval = float(self.view.get('full_sync_interval') or 360) * 60
+        if (time.time() - float(metadata['lastfullsync'])) >= fullsyncinterval:
+            self._add_log('Full sync interval reached, a full poll is required')
+            return None
+
+        return previous, metadata
+
+    def load_previous_snapshot(self):
+        """Returns the last saved (instances, metadata) or (None, {}) if there are none"""
+        datapath = self.runargs['datapath'] or os.path.join(os.getcwd(), 'instance-output.yml')
+        metapath = self.get_metadata_path(datapath)
+        if not (os.path.isfile(datapath) and os.path.isfile(metapath)):
+            return None, {}
+        try:
+            metadata = yaml.safe_load(open(metapath)) or {}
+            previous = yaml.safe_load(open(datapath)) or []
+        except Exception as monitorclassexception:
+            self._add_log('Unable to load previous snapshot ({0})'.format(monitorclassexception), 'warning')
+            return None, {}
+        return previous, metadata
+
+    def get_metadata_path(self, datapath):
+        """Returns the snapshot metadata file that goes with an instance data file"""
+        return os.path.splitext(datapath)[0] + '.meta.yml'
 
     def icount(self, seq, pred):
         """Used for summing data"""
@@ -629,23 +1330,57 @@ class MonitorTasks(object):
         if self.allinstances:
             results = self.allinstances
         if filtered:
-            for filtername in self.filters.keys():
-                if self.eval_filter(filtername) != '*':
-                    results = [i for i in results if i[filtername] == self.eval_filter(filtername)]
-
-            # if self.eval_filter('environment') != '*':
-            #     results = [i for i in results if i['Environment'] == self.eval_filter('environment')]
-            # if self.eval_filter('appname') != '*':
-            #     results = [i for i in results if i['ApplicationName'] == self.eval_filter('appname')]
-            # if self.eval_filter('costcenter') != '*':
-            #     results = [i for i in results if i['CostCenter'] == self.eval_filter('costcenter')]
+            results = self.filter_instances(results)
         
         return results
 
+    def count_instances(self, instances):
+        """Returns (typecounts, accountcounts) for instances in a single pass"""
+        counts = ({}, {})
+        for instance in instances or []:
+            self.apply_count_delta(counts, instance, 1, filtered=False)
+        return counts
+
+    def apply_count_delta(self, counts, instance, step, filtered=True):
+        """
+        Adds step (1 or -1) for one instance to a (typecounts, accountcounts)
+        pair. With filtered the instance is only counted if it passes the
+        client side filters.
+        """
+        if filtered and not self.filter_instances([instance]):
+            return
+        typecounts, accountcounts = counts
+        itype = instance.get('instance_type')
+        if itype is None:
+            # Not collected (tags engine polls), nothing counts by type then
+            return
+        accountid = instance.get('account_id')
+        typecounts[itype] = typecounts.get(itype, 0) + step
+        accounts = accountcounts.setdefault(itype, {})
+        accounts[accountid] = accounts.get(accountid, 0) + step
+        # Drop anything that was counted down to nothing
+        if accounts[accountid] <= 0:
+            del accounts[accountid]
+        if typecounts[itype] <= 0:
+            del typecounts[itype]
+            accountcounts.pop(itype, None)
+
     def update_instance_counts(self):
-        """Update instance counts"""
+        """Update instance counts (org wide and per account). Uses the counts
+        kept by the last poll when there are any, otherwise counts in a single pass."""
+        if self.instancecounts is not None:
+            typecounts, accountcounts = self.instancecounts
+        else:
+            typecounts, accountcounts = self.count_instances(self.instances)
+
         for monitor in self.monitorjobs:
-            if monitor['enabled']:
+            if monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'subnet':
+                self._add_log('Getting available ip addresses for subnet monitor: {0}'.format(monitor['name']))
+                self.update_subnet_count(monitor)
+            elif monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'health':
+                self._add_log('Getting unhealthy instance count for health monitor: {0}'.format(monitor['name']))
+                self.update_health_count(monitor)
+            elif monitor['enabled']:
                 if (monitor['name'] == 'Other'):
                     if self.includeundefined:
                         self._add_log('Getting undefined instance types')
@@ -657,13 +1392,11 @@ class MonitorTasks(object):
                 
                 self._add_log('Getting count for instance type: {0}'.format(monitor['name']))
                 
-                if self.instances:
-                    newcount = self.icount(self.instances, lambda i, monitorname=monitor['name']: i['instance_type'] == monitorname)
-                else:
+                if not self.instances:
                     self._add_log('  no instances to filter!')
-                    newcount=0
 
-                monitor['count'] = newcount
+                monitor['count'] = typecounts.get(monitor['name'], 0)
+                monitor['accountcounts'] = accountcounts.get(monitor['name'], {})
     
     def get_all_instance_counts(self, instances=None,  attribute='instance_type'):
         """Retrieve a count of all instances based on the passed attribute"""
@@ -725,12 +1458,29 @@ class MonitorTasks(object):
     def check_threshold_triggers(self):
         """Check if any thresholds have been reached"""
         for monitor in self.monitorjobs:
-            if monitor['enabled']:
+            if monitor['enabled'] and str(monitor['thresholdtype']).lower() == 'subnet':
+                # Inverse thresholds, triggered by too few available ip addresses
+                if monitor['count'] is None:
+                    continue
+                if str(monitor['warningthreshold']) != '0':
+                    if monitor['count'] <= monitor['warningthreshold']:
+                        self.warningthresholdreached = True
+                if str(monitor['alertthreshold']) != '0':
+                    if monitor['count'] < monitor['alertthreshold']:
+                        self.alertthresholdreached = True
+            elif monitor['enabled']:
+                if monitor['count'] is None:
+                    continue
+                # Per account monitors trigger if any single account reaches the threshold
+                if str(monitor['scope']).lower() == 'account':
+                    counts = list(monitor['accountcounts'].values()) or [0]
+                else:
+                    counts = [monitor['count']]
                 if str(monitor['warningthreshold']) != '0':
-                    if monitor['count'] >= monitor['warningthreshold']:
+                    if max(counts) >= monitor['warningthreshold']:
                         self.warningthresholdreached = True
                 if str(monitor['alertthreshold']) != '0':
-                    if monitor['count'] > monitor['alertthreshold']:
+                    if max(counts) > monitor['alertthreshold']:
                         self.alertthresholdreached = True
 
     def save_instance_data(self, filepath=None):
@@ -741,6 +1491,15 @@ class MonitorTasks(object):
         with open(filepath, 'wb') as outfile:
             yaml.safe_dump(self.allinstances, outfile, encoding='utf-8', allow_unicode=True, default_flow_style=False)
 
+    def save_instance_metadata(self, filepath=None):
+        """Save snapshot metadata (sync times, counts) next to the instance data"""
+        if filepath is None:
+            filepath = os.path.join(os.getcwd(), 'instance-output.yml')
+        filepath = self.get_metadata_path(filepath)
+        self._add_log('Saving instance metadata to: {0}'.format(filepath))
+        with open(filepath, 'wb') as outfile:
+            yaml.safe_dump(self.metadata, outfile, encoding='utf-8', allow_unicode=True, default_flow_style=False)
+
     def save_html_report(self, 
         filteredinstances=False, reportname='instance_details.html'):
         """
@@ -760,6 +1519,7 @@ class MonitorTasks(object):
             "title": "AWS Aware Status - {0}".format(status),
             "date": date.today().strftime('%m/%d/%Y'),
             "monitors": self.monitorjobs,
+            "stalescopes": self.stalescopes,
             "costcenter": self.eval_filter('costcenter'),
             "environment": self.eval_filter('environment'),
             "appname": self.eval_filter('appname'),
@@ -58,6 +58,7 @@ MONITORARGS = {
     'monitorconfig': MONITORCONFIGPATH,
     'includeundefined': False,
     'skipprobe': False,
+    'incremental': False,
     'sendwarnings': False,
     'sendalerts': False
 }
@@ -82,6 +83,29 @@ DEFAULTAPPCONFIG = {
     'awsprofile': '',
     'awsid': '',
     'awssecret': '',
+    'awscredentialcache': os.path.join(os.path.expanduser('~'), '.aws-aware', 'credential-cache'),
+    'awscache': True,
+    'awscachebackend': 'disk',
+    'awscachepath': os.path.join(os.path.expanduser('~'), '.aws-aware', 'response-cache'),
+    'awscachemaxentries': 10000,
+    'awscachettls': {},
+    'awsmaxpoolconnections': 50,
+    'awsretrymode': '',
+    'awsmaxattempts': 10,
+    'awsconnecttimeout': 10,
+    'awsreadtimeout': 60,
+    'awssharedmodelcache': True,
+    'awsprewarmmodels': False,
+    'awsratelimit': 20,
+    'awsratelimitburst': 40,
+    'awsratelimitmax': 100,
+    'awss3multipartthreshold': 8,
+    'awss3multipartchunksize': 8,
+    'awss3maxconcurrency': 10,
+    'awss3downloadworkers': 8,
+    'awsinstanceindexage': 300,
+    'awss3cachepath': os.path.join(os.path.expanduser('~'), '.aws-aware', 's3-cache'),
+    'awss3cachemaxentries': 1000,
     'suppressconsoleoutput': False,
     'slack_notifications': False,
     'slack_webhooks': (),
@@ -0,0 +1,88 @@
+"""
+Benchmark the aws_instances_brief engines against a stubbed describe_instances fixture.
+
+Compares the per-instance cost of the boto3 resource engine with the raw client
+engine, which projects attributes with plain dictionary lookups. No AWS calls are
+made; all pages are served by a botocore Stubber.
+
+Usage: python scripts/bench-instances-brief.py [instancecount] [pagesize]
+"""
+import os
+import sys
+import time
+import datetime
+from pprint import pprint
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from aws_aware.awslibrary import AWSAPI
+
+INSTANCECOUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+PAGESIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+TAGS = ['CostCenter', 'ApplicationName', 'Environment', 'ProcessName']
+
+
+def make_instance(index):
+    """A describe_instances instance entry similar in size to a real one"""
+    ipaddress = '10.{0}.{1}.{2}'.format((index >> 16) & 255, (index >> 8) & 255, index & 255)
+    instance = {
+        'InstanceId': 'i-{0:017x}'.format(index),
+        'InstanceType': ['m5.large', 'r3.4xlarge', 'i3.xlarge'][index % 3],
+        'LaunchTime': datetime.datetime(2020, 1, 1),
+        'PrivateIpAddress': ipaddress,
+        'State': {'Code': 16, 'Name': 'running'},
+        'Placement': {'AvailabilityZone': 'us-east-1a', 'Tenancy': 'default'},
+        'NetworkInterfaces': [{'PrivateIpAddress': ipaddress, 'NetworkInterfaceId': 'eni-{0:017x}'.format(index)}],
+        'Tags': [
+            {'Key': 'Name', 'Value': 'team1-prod-stb-{0}-worker'.format(index % 500)},
+            {'Key': 'CostCenter', 'Value': '0123456789'},
+            {'Key': 'ApplicationName', 'Value': 'team1'},
+            {'Key': 'Environment', 'Value': 'prod'},
+            {'Key': 'ProcessName', 'Value': 'worker'},
+        ],
+    }
+    # Only every other instance is public (missing attributes must come back as None)
+    if index % 2 == 0:
+        instance['PublicIpAddress'] = '54.0.{0}.{1}'.format((index >> 8) & 255, index & 255)
+    return instance
+
+
+def make_pages():
+    """Split the fixture into describe_instances pages"""
+    pages = []
+    for start in range(0, INSTANCECOUNT, PAGESIZE):
+        instances = [make_instance(index) for index in range(start, min(start + PAGESIZE, INSTANCECOUNT))]
+        page = {'Reservations': [{'ReservationId': 'r-{0:017x}'.format(start), 'Instances': instances}]}
+        if start + PAGESIZE < INSTANCECOUNT:
+            page['NextToken'] = str(start + PAGESIZE)
+        pages.append(page)
+    return pages
+
+
+def run_engine(aws, client, engine, pages):
+    """Time a single aws_instances_brief run for an engine"""
+    stubber = Stubber(client)
+    for page in pages:
+        stubber.add_response('describe_instances', page)
+    with stubber:
+        start = time.time()
+        results = aws.aws_instances_brief(tags=TAGS, engine=engine)
+        elapsed = time.time() - start
+    return results, elapsed
+
+
+AWS = AWSAPI(awsid='testing', awssecret='testing', region='us-east-1', accountid='123456789012')
+PAGES = make_pages()
+
+RESOURCERESULTS, RESOURCETIME = run_engine(AWS, AWS.ec2resource.meta.client, 'resource', PAGES)
+CLIENTRESULTS, CLIENTTIME = run_engine(AWS, AWS.ec2, 'client', PAGES)
+
+pprint({
+    'instances': INSTANCECOUNT,
+    'identical_output': RESOURCERESULTS == CLIENTRESULTS,
+    'resource_seconds': round(RESOURCETIME, 3),
+    'client_seconds': round(CLIENTTIME, 3),
+    'resource_us_per_instance': round(RESOURCETIME / INSTANCECOUNT * 1000000, 2),
+    'client_us_per_instance': round(CLIENTTIME / INSTANCECOUNT * 1000000, 2),
+    'speedup': round(RESOURCETIME / CLIENTTIME, 2) if CLIENTTIME else None,
+})
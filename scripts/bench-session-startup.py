@@ -0,0 +1,73 @@
+"""
+Benchmark AWSAPI connection (session + ec2 client/resource) creation with and
+without the shared botocore loader / service model cache.
+
+No AWS calls are made, only session and client construction is timed.
+
+Usage: python scripts/bench-session-startup.py [sessioncount]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from pprint import pprint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from aws_aware.awslibrary import AWSAPI, prewarm_service_models
+
+SESSIONCOUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1']
+
+
+def create_sessions(sharedloader):
+    """Create connections the same way a multi-region poll does"""
+    connections = []
+    for index in range(SESSIONCOUNT):
+        aws = AWSAPI(
+            awsid='testing',
+            awssecret='testing',
+            region=REGIONS[index % len(REGIONS)],
+            accountid='123456789012',
+            sharedloader=sharedloader)
+        # Most polls also touch s3 and ssm
+        aws.get_client('s3')
+        aws.get_client('ssm')
+        connections.append(aws)
+    return connections
+
+
+def time_sessions(sharedloader):
+    """Seconds taken to create all connections"""
+    start = time.time()
+    create_sessions(sharedloader)
+    return time.time() - start
+
+
+def measure_sessions(sharedloader):
+    """Bytes still allocated while all connections are alive (timed separately,
+    tracemalloc slows everything down)"""
+    tracemalloc.start()
+    connections = create_sessions(sharedloader)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del connections
+    return memory
+
+
+UNSHAREDTIME = time_sessions(sharedloader=False)
+UNSHAREDMEMORY = measure_sessions(sharedloader=False)
+
+PREWARMSTART = time.time()
+prewarm_service_models()
+PREWARMTIME = time.time() - PREWARMSTART
+SHAREDTIME = time_sessions(sharedloader=True)
+SHAREDMEMORY = measure_sessions(sharedloader=True)
+
+pprint({
+    'sessions': SESSIONCOUNT,
+    'unshared_ms_per_session': round(UNSHAREDTIME / SESSIONCOUNT * 1000, 2),
+    'unshared_mb': round(UNSHAREDMEMORY / 1048576.0, 2),
+    'prewarm_ms': round(PREWARMTIME * 1000, 2),
+    'shared_ms_per_session': round(SHAREDTIME / SESSIONCOUNT * 1000, 2),
+    'shared_mb': round(SHAREDMEMORY / 1048576.0, 2),
+})
@@ -24,6 +24,7 @@ requirements = [
     'seria',
     'xmltodict',
     'awscli',
+    'futures; python_version < "3.0"',
 ]
 
 setup_requirements = [ ]
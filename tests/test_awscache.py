@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `aws_aware.awscache` response cache."""
+
+import os
+import shutil
+import tempfile
+import io
+import unittest
+
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from aws_aware.awscache import MemoryCache, DiskCache, ResponseCache
+from aws_aware.awslibrary import AWSAPI, NotCacheable, S3ObjectCache
+
+
+class TestMemoryCache(unittest.TestCase):
+    """Tests for the in-memory LRU backend."""
+
+    def test_get_set(self):
+        """Stored values are returned until they expire."""
+        cache = MemoryCache()
+        cache.set('key', 'value', 60)
+        self.assertEqual(cache.get('key'), (True, 'value'))
+        self.assertEqual(cache.get('other'), (False, None))
+
+    def test_expired(self):
+        """Expired entries are misses and are dropped."""
+        cache = MemoryCache()
+        cache.set('key', 'value', -1)
+        self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted first."""
+        cache = MemoryCache(maxentries=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        # Reading a makes b the least recently used entry
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual(cache.evictions, 1)
+
+
+class TestDiskCache(unittest.TestCase):
+    """Tests for the on-disk backend."""
+
+    def setUp(self):
+        self.cachepath = os.path.join(tempfile.mkdtemp(), 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.cachepath), ignore_errors=True)
+
+    def test_get_set(self):
+        """Values survive a new backend instance on the same path."""
+        DiskCache(self.cachepath).set('key', {'a': [1, 2]}, 60)
+        self.assertEqual(DiskCache(self.cachepath).get('key'), (True, {'a': [1, 2]}))
+
+    def test_expired(self):
+        """Expired entries are misses and their files are removed."""
+        cache = DiskCache(self.cachepath)
+        cache.set('key', 'value', -1)
+        self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        """Files least recently used (by modification time) are evicted down to 90% of maxentries."""
+        cache = DiskCache(self.cachepath, maxentries=10)
+        for index in range(10):
+            cache.set('key{0}'.format(index), index, 60)
+            filename = os.path.join(self.cachepath, 'key{0}.cache'.format(index))
+            os.utime(filename, (1000 + index, 1000 + index))
+        cache.set('key10', 10, 60)
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.get('key0'), (False, None))
+        self.assertEqual(cache.get('key1'), (False, None))
+        self.assertEqual(cache.get('key2'), (True, 2))
+        self.assertEqual(cache.get('key10'), (True, 10))
+
+    def test_clear(self):
+        """Clearing removes every entry."""
+        cache = DiskCache(self.cachepath)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for the response cache."""
+
+    def test_key_normalization(self):
+        """Parameter order does not change the key, values and scope do."""
+        cache = ResponseCache()
+        key = cache.get_key('111122223333', 'us-east-1', 'describe_subnets', {'SubnetIds': ['a'], 'Filters': []})
+        self.assertEqual(key, cache.get_key('111122223333', 'us-east-1', 'describe_subnets', {'Filters': [], 'SubnetIds': ['a']}))
+        self.assertNotEqual(key, cache.get_key('111122223333', 'us-east-1', 'describe_subnets', {'SubnetIds': ['b'], 'Filters': []}))
+        self.assertNotEqual(key, cache.get_key('444455556666', 'us-east-1', 'describe_subnets', {'SubnetIds': ['a'], 'Filters': []}))
+        self.assertNotEqual(key, cache.get_key('111122223333', 'us-west-2', 'describe_subnets', {'SubnetIds': ['a'], 'Filters': []}))
+
+    def test_cached(self):
+        """The loader only runs on a miss, hits and misses are counted."""
+        cache = ResponseCache(MemoryCache())
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return 'value'
+
+        for _ in range(3):
+            self.assertEqual(cache.cached('111122223333', 'us-east-1', 'describe_subnets', {}, loader), 'value')
+        self.assertEqual(len(calls), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_maxage(self):
+        """Values older than maxage are misses, maxage 0 always calls the loader."""
+        cache = ResponseCache(MemoryCache())
+        cache.set('111122223333', 'us-east-1', 'describe_subnets', {}, 'old')
+        self.assertEqual(cache.get('111122223333', 'us-east-1', 'describe_subnets', {}, maxage=60), (True, 'old'))
+        self.assertEqual(cache.get('111122223333', 'us-east-1', 'describe_subnets', {}, maxage=0), (False, None))
+        self.assertEqual(cache.cached('111122223333', 'us-east-1', 'describe_subnets', {}, lambda: 'new', maxage=0), 'new')
+
+    def test_ttls(self):
+        """A ttl of 0 or a disabled cache never stores values."""
+        cache = ResponseCache(MemoryCache(), ttls={'describe_subnets': 0})
+        cache.set('111122223333', 'us-east-1', 'describe_subnets', {}, 'value')
+        self.assertEqual(len(cache.backend), 0)
+        cache = ResponseCache(MemoryCache(), enabled=False)
+        cache.set('111122223333', 'us-east-1', 'head_object', {}, 'value')
+        self.assertEqual(len(cache.backend), 0)
+
+    def test_not_cacheable(self):
+        """A loader raising NotCacheable returns its value without caching it."""
+        api = AWSAPI(awsid='testing', awssecret='testing', accountid='111122223333', responsecache=ResponseCache(MemoryCache()))
+        calls = []
+
+        def loader():
+            calls.append(1)
+            raise NotCacheable('failed')
+
+        self.assertEqual(api.cached_call('describe_subnets', {}, loader), 'failed')
+        self.assertEqual(api.cached_call('describe_subnets', {}, loader), 'failed')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(api.responsecache.backend), 0)
+
+
+class TestS3ObjectCache(unittest.TestCase):
+    """Tests for the s3 object cache counters."""
+
+    def setUp(self):
+        self.api = AWSAPI(awsid='testing', awssecret='testing', accountid='111122223333', responsecache=ResponseCache(MemoryCache()))
+
+    def get_object(self, stub, body=b'data'):
+        stub.add_response('get_object', {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': '"etag1"'})
+
+    def test_stats(self):
+        """Fresh and known missing objects are hits, downloads and 404s misses, 304s revalidations."""
+        objectcache = S3ObjectCache()
+        with Stubber(self.api.get_client('s3')) as stub:
+            self.get_object(stub)
+            stub.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+            statuses = [self.api.get_s3_object_cached('bucket', key, objectcache)['status'] for key in ('a', 'a', 'b', 'b')]
+            objectcache.maxage = 0
+            stub.add_client_error('get_object', service_error_code='304', http_status_code=304)
+            statuses.append(self.api.get_s3_object_cached('bucket', 'a', objectcache)['status'])
+            stub.assert_no_pending_responses()
+        self.assertEqual(statuses, ['downloaded', 'cached', 'missing', 'missing', 'notmodified'])
+        stats = objectcache.stats()
+        self.assertEqual((stats['hits'], stats['revalidations'], stats['misses']), (2, 1, 2))
+        self.assertEqual((stats['entries'], stats['missing']), (1, 1))
+        objectcache.reset_stats()
+        self.assertEqual(objectcache.stats()['hits'], 0)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `aws_aware.awslibrary` helpers that need no AWS access."""
+
+import calendar
+import datetime
+import time
+import unittest
+from collections import OrderedDict
+
+from botocore.stub import Stubber
+
+from aws_aware.awscache import MemoryCache, ResponseCache
+from aws_aware.awslibrary import AWSAPI, mycompanyAWS, RateGovernor, TagProjection, TokenBucket, INSTANCE_STATES, get_instance_health, launch_time_patterns
+
+
+def epoch(*args):
+    """Returns the epoch seconds of a UTC date/time"""
+    return calendar.timegm(args + (0,) * (6 - len(args)))
+
+
+def utc_datetime(seconds):
+    """Returns a naive UTC datetime for epoch seconds"""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+
+
+def get_api():
+    """Returns a connection with a known account id, so no sts call is made"""
+    return AWSAPI(awsid='testing', awssecret='testing', accountid='111122223333')
+
+
+def raw_instance(instanceid, tags=None, state='running', **members):
+    """Returns a minimal describe_instances instance"""
+    instance = {'InstanceId': instanceid, 'State': {'Name': state, 'Code': 16}, 'Tags': tags or []}
+    instance.update(members)
+    return instance
+
+
+def instance_page(*instances):
+    """Returns a describe_instances page with one reservation holding instances"""
+    return {'Reservations': [{'ReservationId': 'r-1', 'Instances': list(instances)}]}
+
+
+class TestTagProjection(unittest.TestCase):
+    """Tests for per-instance tag projection."""
+
+    def test_aliases(self):
+        """[key, alias] entries store the value under alias, missing tags are None."""
+        projection = TagProjection(['Owner', ['Cloudera-Director-Template-Name', 'cdh_template']])
+        name, taginfo = projection.project([
+            {'Key': 'Name', 'Value': 'team1-dev-1'},
+            {'Key': 'Cloudera-Director-Template-Name', 'Value': 'gateways'},
+            {'Key': 'Other', 'Value': 'ignored'},
+        ])
+        self.assertEqual(name, 'team1-dev-1')
+        self.assertEqual(taginfo, {'Owner': None, 'cdh_template': 'gateways'})
+
+    def test_no_leaks(self):
+        """Tags of one instance never show up on the next one of the same scan."""
+        api = get_api()
+        with Stubber(api.ec2) as stub:
+            stub.add_response('describe_instances', instance_page(
+                raw_instance('i-1', [{'Key': 'Name', 'Value': 'first'}, {'Key': 'Owner', 'Value': 'alice'}]),
+                raw_instance('i-2', [{'Key': 'Name', 'Value': 'second'}])))
+            instances = api.aws_instances_brief(attributes=[], tags=['Owner'])
+        self.assertEqual([(i['id'], i['name'], i['Owner']) for i in instances], [('i-1', 'first', 'alice'), ('i-2', 'second', None)])
+
+
+class TestSegmentedScan(unittest.TestCase):
+    """Tests for segmented (sharded) describe_instances scans."""
+
+    def test_segment_filters(self):
+        """Given filter values are sharded, never widened."""
+        api = get_api()
+        filters = [{'Name': 'tag:Name', 'Values': ['**']}, {'Name': 'instance-type', 'Values': ['m5.large', 'r3.xlarge', 'm5.xlarge']}]
+        self.assertEqual(api.get_segment_filters(filters, 'instance-type-family'), [
+            [{'Name': 'tag:Name', 'Values': ['**']}, {'Name': 'instance-type', 'Values': ['m5.large', 'm5.xlarge']}],
+            [{'Name': 'tag:Name', 'Values': ['**']}, {'Name': 'instance-type', 'Values': ['r3.xlarge']}],
+        ])
+        self.assertRaises(ValueError, api.get_segment_filters, filters, 'vpc-id')
+
+    def test_scan(self):
+        """Every shard is scanned with its own filter and results are de-duplicated by instance id."""
+        api = get_api()
+        with Stubber(api.ec2) as stub:
+            for zone, instanceids in (('us-east-1a', ['i-1', 'i-2']), ('us-east-1b', ['i-2', 'i-3'])):
+                filters = [{'Name': 'tag:Name', 'Values': ['**']}, {'Name': 'availability-zone', 'Values': [zone]}]
+                stub.add_response('describe_instances', instance_page(*[raw_instance(i) for i in instanceids]), {'Filters': filters})
+            instances = api.aws_instances_brief(
+                attributes=[],
+                segmentkey='availability-zone',
+                segmentvalues=['us-east-1a', 'us-east-1b'],
+                segmentworkers=1)
+            stub.assert_no_pending_responses()
+        self.assertEqual([instance['id'] for instance in instances], ['i-1', 'i-2', 'i-3'])
+
+
+class TestLaunchTimePatterns(unittest.TestCase):
+    """Tests for the incremental sync launch-time filter values."""
+
+    def test_hours(self):
+        """Short windows are covered hour by hour."""
+        patterns = launch_time_patterns(epoch(2018, 3, 1, 22, 30), epoch(2018, 3, 2, 1, 5))
+        self.assertEqual(patterns, ['2018-03-01T22:*', '2018-03-01T23:*', '2018-03-02T00:*', '2018-03-02T01:*'])
+
+    def test_days(self):
+        """Windows longer than two days are covered by whole days."""
+        patterns = launch_time_patterns(epoch(2018, 3, 1, 12), epoch(2018, 3, 4, 1))
+        self.assertEqual(patterns, ['2018-03-01T*', '2018-03-02T*', '2018-03-03T*', '2018-03-04T*'])
+
+
+class TestInstanceChanges(unittest.TestCase):
+    """Tests for incremental sync changes against a stubbed region."""
+
+    def test_changes(self):
+        """Launches in the window, state transitions and tag changes are found."""
+        since = time.time() - 600
+        known = {
+            'i-1': {'id': 'i-1', 'name': 'web1', 'state': 'running', 'Owner': 'alice'},
+            'i-2': {'id': 'i-2', 'name': 'web2', 'state': 'running', 'Owner': 'alice'},
+        }
+        api = get_api()
+        with Stubber(api.ec2) as stub:
+            # i-1 was launched long before the window, the hour pattern still matches it
+            stub.add_response('describe_instances', instance_page(
+                raw_instance('i-1', [{'Key': 'Name', 'Value': 'web1'}], LaunchTime=utc_datetime(since - 7200)),
+                raw_instance('i-3', [{'Key': 'Name', 'Value': 'web3'}], LaunchTime=utc_datetime(since + 60))))
+            stub.add_response('describe_instance_status', {'InstanceStatuses': [
+                {'InstanceId': 'i-2', 'InstanceState': {'Name': 'stopped', 'Code': 80}},
+            ]}, {
+                'IncludeAllInstances': True,
+                'Filters': [{'Name': 'instance-state-name', 'Values': [state for state in INSTANCE_STATES if state != 'running']}],
+            })
+            stub.add_response('describe_tags', {'Tags': [
+                {'ResourceId': 'i-1', 'ResourceType': 'instance', 'Key': 'Name', 'Value': 'web1'},
+                {'ResourceId': 'i-1', 'ResourceType': 'instance', 'Key': 'Owner', 'Value': 'bob'},
+                {'ResourceId': 'i-2', 'ResourceType': 'instance', 'Key': 'Name', 'Value': 'web2'},
+            ]}, {'Filters': [{'Name': 'resource-type', 'Values': ['instance']}, {'Name': 'key', 'Values': ['Name', 'Owner']}]})
+            upserts, removed = api.aws_instances_changes(
+                known,
+                since,
+                otherfilters=[{'Name': 'instance-state-name', 'Values': ['running']}],
+                attributes=['launch_time'],
+                tags=['Owner'])
+            stub.assert_no_pending_responses()
+        self.assertEqual(removed, set(['i-2']))
+        self.assertEqual(sorted((i['id'], i['name'], i['Owner']) for i in upserts), [('i-1', 'web1', 'bob'), ('i-3', 'web3', None)])
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Tests for the rate governor token bucket."""
+
+    def test_burst(self):
+        """A full bucket serves its burst without waiting, then waits."""
+        bucket = TokenBucket(rate=1000, burst=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_aimd(self):
+        """Throttles halve the rate down to minrate, successes raise it up to maxrate."""
+        bucket = TokenBucket(rate=8, burst=8, minrate=2, maxrate=9)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 4)
+        self.assertLessEqual(bucket.tokens, 0)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 2)
+        for _ in range(100):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 9)
+
+    def test_zero_rate(self):
+        """A bucket needs a positive rate, a governor with rate 0 is disabled."""
+        self.assertRaises(ValueError, TokenBucket, rate=0)
+        governor = RateGovernor()
+        governor.configure(rate=0, enabled=True)
+        self.assertFalse(governor.enabled)
+        governor.configure(rate=5, enabled=True)
+        self.assertTrue(governor.enabled)
+        self.assertEqual(governor.settings['rate'], 5)
+
+
+def name_tags(*names):
+    """Returns a describe_tags page with the Name tag of instances i-0, i-1 ..."""
+    return {'Tags': [{'ResourceId': 'i-{0}'.format(index), 'ResourceType': 'instance', 'Key': 'Name', 'Value': name}
+                     for index, name in enumerate(names)]}
+
+
+class TestNodeCount(unittest.TestCase):
+    """Tests for id-only instance counting and unique cluster ids."""
+
+    def test_name_tags_only(self):
+        """Without other filters only Name tags are read and paging stops at maxcount."""
+        api = get_api()
+        nametags = name_tags('web1', 'web2')
+        nametags['NextToken'] = 'more'
+        with Stubber(api.ec2) as stub:
+            stub.add_response('describe_tags', nametags, {'Filters': [
+                {'Name': 'resource-type', 'Values': ['instance']},
+                {'Name': 'key', 'Values': ['Name']},
+                {'Name': 'value', 'Values': ['web*']},
+            ]})
+            self.assertEqual(api.aws_node_count('web', maxcount=2), 2)
+            stub.assert_no_pending_responses()
+
+    def test_other_filters(self):
+        """With other filters describe_instances pages are streamed."""
+        api = get_api()
+        with Stubber(api.ec2) as stub:
+            stub.add_response('describe_instances', instance_page(raw_instance('i-1'), raw_instance('i-2')), {'Filters': [
+                {'Name': 'tag:Name', 'Values': ['web*']},
+                {'Name': 'instance-state-name', 'Values': ['running']},
+            ]})
+            self.assertEqual(api.aws_node_count('web', otherfilters=[{'Name': 'instance-state-name', 'Values': ['running']}]), 2)
+
+    def test_cluster_uniqueid(self):
+        """Existing names are read once, taken candidates are retried without more calls."""
+        api = mycompanyAWS(awsid='testing', awssecret='testing', accountid='111122223333')
+        candidates = iter(['ab', 'cd'])
+        api.random_generator = lambda size: next(candidates)
+        with Stubber(api.ec2) as stub:
+            stub.add_response('describe_tags', name_tags('team1-dev-ab-master', 'team1-dev-xy'))
+            self.assertEqual(api.get_cluster_uniqueid('team1-dev', maxlen=12), 'cd')
+            stub.assert_no_pending_responses()
+
+
+class TestS3Exists(unittest.TestCase):
+    """Tests for s3 existence checks."""
+
+    def setUp(self):
+        self.api = AWSAPI(awsid='testing', awssecret='testing', accountid='111122223333', responsecache=ResponseCache(MemoryCache()))
+        self.s3 = self.api.get_client('s3')
+
+    def test_file_exists(self):
+        """Files are checked with head_object, found and missing answers are cached."""
+        with Stubber(self.s3) as stub:
+            stub.add_response('head_object', {'ContentLength': 1}, {'Bucket': 'bucket', 'Key': 'path/a'})
+            stub.add_client_error('head_object', service_error_code='404', http_status_code=404, expected_params={'Bucket': 'bucket', 'Key': 'path/b'})
+            for _ in range(2):
+                self.assertTrue(self.api.s3_file_exists('bucket', 'path/a'))
+                self.assertFalse(self.api.s3_file_exists('bucket', 'path/b'))
+            stub.assert_no_pending_responses()
+
+    def test_file_exists_error(self):
+        """Other errors are not found answers that are never cached."""
+        with Stubber(self.s3) as stub:
+            for _ in range(2):
+                stub.add_client_error('head_object', service_error_code='403', http_status_code=403)
+                self.assertFalse(self.api.s3_file_exists('bucket', 'path/a'))
+            stub.assert_no_pending_responses()
+
+    def test_folder_exists(self):
+        """Folders are checked with a single key listing."""
+        with Stubber(self.s3) as stub:
+            stub.add_response('list_objects_v2', {'KeyCount': 1}, {'Bucket': 'bucket', 'Prefix': 'path/', 'MaxKeys': 1})
+            stub.add_response('list_objects_v2', {'KeyCount': 0}, {'Bucket': 'bucket', 'Prefix': 'other/', 'MaxKeys': 1})
+            self.assertTrue(self.api.s3_folder_exists('bucket', 'path/'))
+            self.assertFalse(self.api.s3_folder_exists('bucket', 'other/'))
+            stub.assert_no_pending_responses()
+
+    def test_cacheprefix(self):
+        """Checks under cacheprefix are answered from one listing."""
+        with Stubber(self.s3) as stub:
+            stub.add_response('list_objects_v2', {'Contents': [{'Key': 'path/a/file.yml', 'Size': 1}]}, {'Bucket': 'bucket', 'Prefix': 'path/'})
+            self.assertTrue(self.api.s3_file_exists('bucket', 'path/a/file.yml', cacheprefix='path/'))
+            self.assertFalse(self.api.s3_file_exists('bucket', 'path/b/file.yml', cacheprefix='path/'))
+            self.assertTrue(self.api.s3_folder_exists('bucket', 'path/a/', cacheprefix='path/'))
+            self.assertFalse(self.api.s3_folder_exists('bucket', 'path/b/', cacheprefix='path/'))
+            stub.assert_no_pending_responses()
+
+
+class TestSSMInvocationResult(unittest.TestCase):
+    """Tests for turning list_command_invocations entries into command results."""
+
+    def setUp(self):
+        self.aws = get_api()
+
+    def test_first_failing_plugin(self):
+        """The first non-zero plugin response code wins and outputs are joined."""
+        result = self.aws._ssm_invocation_result('command-1', {
+            'InstanceId': 'i-1',
+            'Status': 'Failed',
+            'StatusDetails': 'Failed',
+            'CommandPlugins': [
+                {'ResponseCode': 0, 'Output': 'first '},
+                {'ResponseCode': 2, 'Output': 'second '},
+                {'ResponseCode': 1, 'Output': 'third'},
+            ],
+        })
+        self.assertEqual(result['instance_id'], 'i-1')
+        self.assertEqual(result['command_id'], 'command-1')
+        self.assertEqual(result['status'], 'Failed')
+        self.assertEqual(result['response_code'], 2)
+        self.assertEqual(result['output'], 'first second third')
+
+    def test_no_response_code(self):
+        """Pending invocations have no response code or output yet."""
+        result = self.aws._ssm_invocation_result('command-1', {'InstanceId': 'i-1', 'Status': 'InProgress'})
+        self.assertIsNone(result['response_code'])
+        self.assertEqual(result['output'], '')
+        self.assertEqual(result['status_details'], None)
+
+
+def gateway_instance(instanceid, name, address, role='gateways'):
+    """Returns a describe_instances instance of a cdh cluster role with one private ip"""
+    return raw_instance(
+        instanceid,
+        [{'Key': 'Name', 'Value': name}, {'Key': 'Cloudera-Director-Template-Name', 'Value': role}],
+        PrivateIpAddress=address,
+        NetworkInterfaces=[{'PrivateIpAddress': address, 'PrivateIpAddresses': [{'PrivateIpAddress': address}]}])
+
+
+class TestInstanceIndex(unittest.TestCase):
+    """Tests for ip, tag and role lookups from the instance index."""
+
+    def setUp(self):
+        self.api = mycompanyAWS(awsid='testing', awssecret='testing', accountid='111122223333')
+        self.page = instance_page(
+            gateway_instance('i-1', 'team1-dev-1-gw', '10.0.0.1'),
+            gateway_instance('i-2', 'team2-dev-1-gw', '10.0.0.2'),
+            gateway_instance('i-3', 'team1-dev-1-worker', '10.0.0.3', role='workers'))
+
+    def test_lookups_after_poll(self):
+        """Lookups after an unfiltered poll make no describe_instances call."""
+        with Stubber(self.api.ec2) as stub:
+            stub.add_response('describe_instances', self.page, {'Filters': [{'Name': 'tag:Name', 'Values': ['**']}]})
+            self.assertEqual(len(self.api.aws_instances_brief()), 3)
+            # Any further describe_instances call would fail on the empty stub
+            self.assertEqual([i['InstanceId'] for i in self.api.aws_instance_by_private_ip('10.0.0.2')], ['i-2'])
+            self.assertEqual(self.api.cloudera_cdh_gateway_ips('team1'), ['10.0.0.1'])
+            self.assertEqual(self.api.cluster_gateway_ips(['team1', 'team2', 'team3']), OrderedDict(
+                [('team1', ['10.0.0.1']), ('team2', ['10.0.0.2']), ('team3', [])]))
+            stub.assert_no_pending_responses()
+
+    def test_filtered_poll(self):
+        """A filtered poll leaves the index alone, single lookups use a filtered call."""
+        with Stubber(self.api.ec2) as stub:
+            stub.add_response('describe_instances', self.page)
+            self.api.aws_instances_brief(otherfilters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+            stub.add_response('describe_instances', instance_page(gateway_instance('i-2', 'team2-dev-1-gw', '10.0.0.2')), {'Filters': [
+                {'Name': 'tag:Name', 'Values': ['**']},
+                {'Name': 'network-interface.addresses.private-ip-address', 'Values': ['10.0.0.2']},
+            ]})
+            self.assertEqual([i['InstanceId'] for i in self.api.aws_instance_by_private_ip('10.0.0.2')], ['i-2'])
+            stub.assert_no_pending_responses()
+
+    def test_batch_lookups(self):
+        """Batch lookups build the index from one full scan, tag lookups never use a named only index."""
+        with Stubber(self.api.ec2) as stub:
+            stub.add_response('describe_instances', self.page, {'Filters': [{'Name': 'tag:Name', 'Values': ['**']}]})
+            self.api.aws_instances_brief()
+            stub.add_response('describe_instances', self.page, {'Filters': []})
+            byip = self.api.aws_instances_by_private_ips(['10.0.0.1', '10.0.0.3', '10.0.0.9'])
+            self.assertEqual([[i['InstanceId'] for i in instances] for instances in byip.values()], [['i-1'], ['i-3'], []])
+            bytag = self.api.aws_instances_by_tag('Cloudera-Director-Template-Name', ['gateways', 'workers'])
+            self.assertEqual([[i['InstanceId'] for i in instances] for instances in bytag.values()], [['i-1', 'i-2'], ['i-3']])
+            # The full scan index serves tag lookups from now on
+            self.api.aws_instances_by_tag('Cloudera-Director-Template-Name', ['gateways'])
+            stub.assert_no_pending_responses()
+
+
+class TestInstanceHealth(unittest.TestCase):
+    """Tests for describe_instance_status health projection."""
+
+    def test_status_checks(self):
+        """Status checks and open scheduled events are returned."""
+        status = {
+            'InstanceId': 'i-1',
+            'SystemStatus': {'Status': 'impaired'},
+            'InstanceStatus': {'Status': 'ok'},
+            'Events': [
+                {'Code': 'system-reboot', 'Description': 'scheduled reboot'},
+                {'Code': 'instance-stop', 'Description': '[Completed] instance stop'},
+                {'Code': 'instance-retirement', 'Description': '[Canceled] retirement'},
+            ],
+        }
+        self.assertEqual(get_instance_health(status), {
+            'system_status': 'impaired',
+            'instance_status': 'ok',
+            'scheduled_events': ['system-reboot'],
+        })
+
+    def test_stopped(self):
+        """Instances without status checks (ie. stopped) have no statuses or events."""
+        self.assertEqual(get_instance_health({'InstanceId': 'i-1'}), {
+            'system_status': None,
+            'instance_status': None,
+            'scheduled_events': [],
+        })